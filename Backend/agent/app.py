@@ -12,6 +12,11 @@ import pandas as pd
 import requests
 import logging
 
+from common.buckets import BUCKET_COLLECTION, LAYOUT_BUCKETS, STORAGE_LAYOUT, find_latest_bucketed_readings
+from common.schema import bootstrap_schema
+from common.versions import ALERTS_VERSION, MAINTENANCE_VERSION, VERSIONS, bump_versions
+from cycles import PendingChecks
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -25,15 +30,19 @@ DEFAUL_MAINTEANCE_FILTER = 21
 DAYS_BETWEEN_SAME_ALERTS = 1
 PUMP_MALFUNCTION_ALERT_DAYS = 5
 DELAY_FILTER_LIFE = 4 #(CYCLE)
+NEW_SESSIONS_TIMEOUT = 5  # (SECOND)
+MIN_LENGTH_SESSION = 15  # (SECOND) must match MIN_LENGTH_SESSION of the api
+# a closed cycle waits that long for its session: the gap that ends it, the detection by the api and a loop of the agent
+PENDING_CHECK_TIMEOUT = 4 * MIN_LENGTH_SESSION  # (SECOND)
 
 ZEROS_THRESHOLD = 5
 
 # ! It should be set to a reletively high value compared to the period of the pump speed
 DELAY = 15  # Also Window size (SECOND)
 BEGINNING_WINDOW_SIZE_FOR_BLOCKAGE_CHECK = 5  # (SECOND)
-PER_SECONDS_READS = 10
+PER_SECONDS_READS = 10  # must match SAMPLE_RATE_HZ of the rotary script
 
-ALL_COLUMNS = ['_id', 'time', 'Barr_pulses', 'Gelcoat_pulses', 'Barrier_speedRPM',
+ALL_COLUMNS = ['_id', 'time', 'timestamp', 'device', 'seq', 'Barr_pulses', 'Gelcoat_pulses', 'Barrier_speedRPM',
                'Gelcoat_speedRPM', 'WaterLevel_1', 'WaterLevel_2', 'Pressure']
 
 COLUMNS_TO_CHECK_SPEED = {
@@ -76,6 +85,8 @@ except:
 
 db_sensor_data = client["Sensor_Data"]
 collection_sensor_data = db_sensor_data["test_28_march"]
+# readings of the bucketed layout, used instead of collection_sensor_data if STORAGE_LAYOUT is LAYOUT_BUCKETS
+collection_sensor_buckets = db_sensor_data[BUCKET_COLLECTION]
 
 db_agent_nominal_values = client["Agent_Nominal_Values"]
 collection_nominal_gelcoat = db_agent_nominal_values["gelcoat"]
@@ -94,6 +105,12 @@ collection_sessions = db_sessions["sessions"]
 collection_products = db_sessions["products"]
 collection_delete_useless_reads = db_sessions["delete_useless_reads"]
 
+# versions of the data cached by the api, bumped after the alerts and the maintenance records are written
+collection_versions = client[VERSIONS[0]][VERSIONS[1]]
+
+# create the missing indexes and log the hot queries that would scan a whole collection
+bootstrap_schema(client)
+
 
 def add_alert(message, more_info=None, nominal_value=False):
     """
@@ -117,6 +134,7 @@ def add_alert(message, more_info=None, nominal_value=False):
     else:
         collection_alerts.insert_one(alert)
         logging.info(f"Alert Added\n Time: {time_now}\n Message: {message}\n More Info: {more_info}")
+    bump_versions(collection_versions, ALERTS_VERSION)
     pass
 
 
@@ -379,6 +397,7 @@ def add_first_maintenance_recored():
                 "pump_type": "barrier"
             }
         )
+        bump_versions(collection_versions, MAINTENANCE_VERSION)
     if collection_maintenance_filter.count_documents({}) < 2:
         # add the default maintenance record, start time is now and end time is 21 days later
         collection_maintenance_filter.insert_one(
@@ -395,6 +414,7 @@ def add_first_maintenance_recored():
                 "pump_type": "barrier"
             }
         )
+        bump_versions(collection_versions, MAINTENANCE_VERSION)
 
 def check_pump_malfunction(pump_type):
     """
@@ -414,8 +434,6 @@ def check_pump_malfunction(pump_type):
         # check the last 10 records of the cycle data
         # if the deviation in the sprayed amount of 2 consecutive cycles from nominal values are more than 15%,  add an alert for maintenance.
         
-        requests.get("http://api:5000/api/get_new_sessions")       
-        
         if pump_type == "gelcoat":
             nominal_value = get_nominal_value_sprayed_gelcoat()
         elif pump_type == "barrier":
@@ -441,6 +459,7 @@ def check_pump_malfunction(pump_type):
                     {"_id": maintenance_record['_id']},
                     {"$set": {"end_time": datetime.now() + timedelta(days=PUMP_MALFUNCTION_ALERT_DAYS)}}
                 )
+                bump_versions(collection_versions, MAINTENANCE_VERSION)
                 add_alert(f"{pump_type} Pump Malfunction (Immediate)",
                     f"More than 5 records with deviation more than 15%: {recent_sessions['spray_deviation']}")
             # in case there are less than 1 day remaining for maintenance, check if there is already an alert added whithin last 24 hours for maintenance in order to prevent spamming
@@ -463,6 +482,7 @@ def check_pump_malfunction(pump_type):
                     {"_id": maintenance_record['_id']},
                     {"$set": {"end_time": datetime.now() + timedelta(days=PUMP_MALFUNCTION_ALERT_DAYS)}}
                 )
+                bump_versions(collection_versions, MAINTENANCE_VERSION)
         
                 add_alert(f"{pump_type} Pump Malfunction (Check in 5 Days)",
                     f"Deviation from nominal value for 2 consecutive cycles: {recent_sessions['spray_deviation'].iloc[0]} and {recent_sessions['spray_deviation'].iloc[1]}")
@@ -480,6 +500,46 @@ def check_pump_malfunction(pump_type):
         pass
     pass
 
+def request_new_sessions():
+    """
+    Asks the api to detect the new sessions in the background, without waiting for them.
+    """
+    try:
+        requests.get("http://api:5000/api/get_new_sessions", timeout=NEW_SESSIONS_TIMEOUT)
+    except requests.RequestException as e:
+        logging.error(f"request_new_sessions < Exception: {str(e)} >")
+
+
+def close_cycle(pump_type, cycle):
+    """
+    Called when a cycle of the pump is over: starts the detection of its session and defers the checks of the
+    pump until the session is stored, see run_pending_checks.
+
+    Args:
+        pump_type (str): The type of pump, either "gelcoat" or "barrier".
+        cycle (pandas.DataFrame): The readings of the cycle.
+    """
+    end = cycle["timestamp"].iloc[-1] if "timestamp" in cycle else None
+    pending_checks.close(pump_type, datetime.now() if pd.isna(end) else pd.Timestamp(end).to_pydatetime())
+    request_new_sessions()
+
+
+def run_cycle_checks(pump_type):
+    check_pump_malfunction(pump_type)
+    check_filter_life(pump_type)
+
+
+# the closed cycles waiting for their session, see agent/cycles.py
+pending_checks = PendingChecks(collection_sessions, run_cycle_checks, PENDING_CHECK_TIMEOUT)
+
+
+def run_pending_checks():
+    """
+    Runs the checks of the closed cycles whose session is stored, called on every iteration of the main loop.
+    """
+    pending_checks.run()
+
+
 def estimate_filter_life(pump_type, nominal_value_speed, maintenance_record_start_date):
     """
     Estimates the remaining filter life based on pump type, nominal value speed, and maintenance record start date.
@@ -487,27 +547,16 @@ def estimate_filter_life(pump_type, nominal_value_speed, maintenance_record_star
     Args:
         pump_type (str): The type of pump.
         nominal_value_speed (float): The nominal value speed of the pump.
-        maintenance_record_start_date (str): The start date of the maintenance record in the format 'YYYY-MM-DD HH:MM:SS AM/PM'.
+        maintenance_record_start_date (datetime): The start date of the maintenance record.
 
     Returns:
         float: The estimated remaining filter life in days.
     """
      
     # get all sessions after the start date
-    recent_sessions = []
-
-    all_sessions = list(collection_sessions.find({
-        # "start_time": {"$gte": start_day, "$lte": end_day}
-    }, {}).sort('id', -1))
-    
-    for session in all_sessions:
-        # if the session is before the maintenance_record_start_date, we break the loop
-        if datetime.strptime(session['start_time'], '%Y-%m-%d %I:%M:%S %p') < maintenance_record_start_date:
-            break
-        else:
-            recent_sessions.append(session)
-
-    recent_sessions = pd.DataFrame(recent_sessions)
+    recent_sessions = pd.DataFrame(list(collection_sessions.find({
+        "start_datetime": {"$gte": maintenance_record_start_date}
+    }, {}).sort('id', -1)))
 
     ### if the number of the sessions are lower than 20, we can't estimate the filter life using ML accurately, and we resort to simple calculations
     if len(recent_sessions) < 2:
@@ -548,7 +597,7 @@ def check_filter_life(pump_type):
     """
     try:
         maintenance_record = collection_maintenance_filter.find_one({"pump_type": pump_type})
-        maintenance_record_start_date = datetime.strptime(maintenance_record['start_time'], '%Y-%m-%d %I:%M:%S %p')
+        maintenance_record_start_date = maintenance_record['start_time']
 
         if datetime.now() - maintenance_record_start_date < timedelta(days=1):
             return True
@@ -568,6 +617,7 @@ def check_filter_life(pump_type):
                 {"_id": maintenance_record['_id']},
                 {"$set": {"end_time": datetime.now() + timedelta(days=remaining_days)}}
             )
+            bump_versions(collection_versions, MAINTENANCE_VERSION)
 
             if remaining_days < 5:
                 last_alert = collection_alerts.find_one({"message": f"{pump_type} Filter Life less than 5 days"})
@@ -593,15 +643,19 @@ if __name__ == '__main__':
     time.sleep(3)
     print("Sending a request to the API to get new sessions", file=sys.stderr)
     logging.debug("Sending a request to the API to get new sessions")
-    requests.get("http://api:5000/api/get_new_sessions")
+    request_new_sessions()
     logging.debug("Request sent to get new sessions")
     print("Request sent", file=sys.stderr)
 
     while True:
         
         time.sleep(DELAY)
+        run_pending_checks()
         # get the latest document from the sensor data collection
-        latest_data = pd.DataFrame(collection_sensor_data.find({}, sort=[("_id", -1)]).limit(int(DELAY * PER_SECONDS_READS)))
+        if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+            latest_data = pd.DataFrame(find_latest_bucketed_readings(collection_sensor_buckets, int(DELAY * PER_SECONDS_READS)))
+        else:
+            latest_data = pd.DataFrame(collection_sensor_data.find({}, sort=[("_id", -1)]).limit(int(DELAY * PER_SECONDS_READS)))
         latest_data = latest_data[::-1].reset_index(drop=True)
 
         # check whether gelcoat and barrier are on
@@ -614,20 +668,16 @@ if __name__ == '__main__':
             # Check Whether the cycles are empty or not
             if not current_cycle_gelcoat.empty:
                 # add_cycle_record_to_db(current_cycle_gelcoat, "gelcoat")
-                # check PUMP MALFUNCTION function
-                check_pump_malfunction("gelcoat")
-                # check FILTER LIFE function
-                check_filter_life("gelcoat")
+                # the checks run once the session of the cycle is detected, see run_pending_checks
+                close_cycle("gelcoat", current_cycle_gelcoat)
                 # Empty the cycle
                 current_cycle_gelcoat = pd.DataFrame(columns=ALL_COLUMNS)
                 pass
 
             elif not current_cycle_barrier.empty:
                 # add_cycle_record_to_db(current_cycle_barrier, "barrier")
-                # check PUMP MALFUNCTION function
-                check_pump_malfunction("barrier")
-                # check FILTER LIFE function
-                check_filter_life("barrier")
+                # the checks run once the session of the cycle is detected, see run_pending_checks
+                close_cycle("barrier", current_cycle_barrier)
                 # Empty the cycle
                 current_cycle_barrier = pd.DataFrame(columns=ALL_COLUMNS)
                 pass
@@ -668,10 +718,8 @@ if __name__ == '__main__':
                 last_non_zero_value_idx = latest_data[latest_data.Gelcoat_pulses > 0].index[-1]
                 latest_data = latest_data.loc[:last_non_zero_value_idx]
                 current_cycle_gelcoat = pd.concat([current_cycle_gelcoat, deepcopy(latest_data)]).reset_index(drop=True)
-                # check PUMP MALFUNCTION function
-                check_pump_malfunction("gelcoat")
-                # check FILTER LIFE function
-                check_filter_life("gelcoat")
+                # the checks run once the session of the cycle is detected, see run_pending_checks
+                close_cycle("gelcoat", current_cycle_gelcoat)
                 current_cycle_gelcoat = pd.DataFrame(columns=ALL_COLUMNS)
                     
                     
@@ -696,10 +744,8 @@ if __name__ == '__main__':
                 last_non_zero_value_idx = latest_data[latest_data.Barr_pulses > 0].index[-1]
                 latest_data = latest_data.loc[:last_non_zero_value_idx]
                 current_cycle_barrier = pd.concat([current_cycle_barrier, deepcopy(latest_data)]).reset_index(drop=True)
-                # check PUMP MALFUNCTION function
-                check_pump_malfunction("barrier")
-                # check FILTER LIFE function
-                check_filter_life("barrier")
+                # the checks run once the session of the cycle is detected, see run_pending_checks
+                close_cycle("barrier", current_cycle_barrier)
                 current_cycle_barrier = pd.DataFrame(columns=ALL_COLUMNS)
 
         elif latest_data[-1*ZEROS_THRESHOLD:].Gelcoat_pulses.sum() == 0 and latest_data[:ZEROS_THRESHOLD].Gelcoat_pulses.sum() > 0:
@@ -718,11 +764,8 @@ if __name__ == '__main__':
                 current_cycle_gelcoat = deepcopy(latest_data)
 
             # add_cycle_record_to_db(current_cycle_gelcoat, "gelcoat")
-            # check PUMP MALFUNCTION function
-            check_pump_malfunction("gelcoat")
-
-            # check FILTER LIFE function
-            check_filter_life("gelcoat")
+            # the checks run once the session of the cycle is detected, see run_pending_checks
+            close_cycle("gelcoat", current_cycle_gelcoat)
             
             
             # Empty the current cycle
@@ -743,11 +786,8 @@ if __name__ == '__main__':
                 current_cycle_barrier = deepcopy(latest_data)
 
             # add_cycle_record_to_db(current_cycle_barrier, "barrier")
-            # check PUMP MALFUNCTION function
-            check_pump_malfunction("barrier")
-
-            # check FILTER LIFE function
-            check_filter_life("barrier")
+            # the checks run once the session of the cycle is detected, see run_pending_checks
+            close_cycle("barrier", current_cycle_barrier)
             
             # Empty the current cycle
             current_cycle_barrier = pd.DataFrame(columns=ALL_COLUMNS)
@@ -0,0 +1,64 @@
+"""
+Checks of the pumps that run once the session of a cycle is stored.
+
+The agent sees a cycle end in the latest readings, the api stores the session of that cycle later, in the
+background. A closed cycle waits with the time of its last reading until a session of the pump covers that
+time: the session starts at or before the end of the cycle and ends at or after it, whether the api stored it
+before or after the agent closed the cycle. A cycle that never becomes a session, e.g. one shorter than
+MIN_LENGTH_SESSION of the api, is dropped after the timeout instead of waiting for an unrelated session.
+"""
+import logging
+from datetime import datetime, timedelta
+
+
+class PendingChecks:
+    """
+    Closed cycles waiting for their session.
+
+    Args:
+        sessions (pymongo.collection.Collection): The sessions collection of the api.
+        check (callable): Called with the pump type once the session of one of its cycles is stored.
+        timeout (float): Seconds a closed cycle waits for its session.
+        clock (callable, optional): Returns the current time. Defaults to datetime.now.
+    """
+
+    def __init__(self, sessions, check, timeout, clock=datetime.now):
+        self.sessions = sessions
+        self.check = check
+        self.timeout = timeout
+        self.clock = clock
+        # (pump type, time of the last reading of the cycle, time after which the cycle is dropped)
+        self._cycles = []
+
+    def close(self, pump_type, end):
+        """
+        Records a cycle of the pump that is over, see run.
+
+        Args:
+            pump_type (str): The type of pump, either "gelcoat" or "barrier".
+            end (datetime): The time of the last reading of the cycle.
+        """
+        self._cycles.append((pump_type, end, self.clock() + timedelta(seconds=self.timeout)))
+
+    def run(self):
+        """
+        Runs the checks of the cycles whose session is stored, once per session, and drops the expired cycles.
+        """
+        now = self.clock()
+        waiting = []
+        matched = {}
+        for pump_type, end, expires in self._cycles:
+            session = self.sessions.find_one(
+                {"pump_type": pump_type, "start_datetime": {"$lte": end}, "end_datetime": {"$gte": end}}, {"_id": 1})
+            if session is not None:
+                matched[session["_id"]] = pump_type
+            elif now > expires:
+                logging.info(f"PendingChecks < dropped: {pump_type}, end: {end} >")
+            else:
+                waiting.append((pump_type, end, expires))
+        self._cycles = waiting
+        for pump_type in matched.values():
+            self.check(pump_type)
+
+    def __len__(self):
+        return len(self._cycles)
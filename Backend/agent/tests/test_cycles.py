@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+
+import mongomock
+
+from cycles import PendingChecks
+
+T0 = datetime(2024, 4, 7, 11, 0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = T0
+
+    def __call__(self):
+        return self.now
+
+
+def pending(timeout=60):
+    sessions = mongomock.MongoClient().Sessions.sessions
+    checked = []
+    clock = Clock()
+    return PendingChecks(sessions, checked.append, timeout, clock), sessions, checked, clock
+
+
+def store_session(sessions, pump_type, start, end):
+    sessions.insert_one({"pump_type": pump_type, "start_datetime": T0 + timedelta(seconds=start),
+                         "end_datetime": T0 + timedelta(seconds=end)})
+
+
+def test_session_stored_before_the_cycle_is_closed():
+    checks, sessions, checked, clock = pending()
+    store_session(sessions, "gelcoat", 0, 120)
+    checks.close("gelcoat", T0 + timedelta(seconds=119))
+    checks.run()
+    assert checked == ["gelcoat"]
+    assert len(checks) == 0
+
+
+def test_session_stored_after_the_cycle_is_closed():
+    checks, sessions, checked, clock = pending()
+    store_session(sessions, "gelcoat", 0, 60)
+    checks.close("gelcoat", T0 + timedelta(seconds=300))
+    checks.run()
+    assert checked == []
+
+    store_session(sessions, "barrier", 200, 300)
+    checks.run()
+    assert checked == []
+
+    store_session(sessions, "gelcoat", 200, 301)
+    checks.run()
+    assert checked == ["gelcoat"]
+    assert len(checks) == 0
+
+
+def test_cycle_without_session_is_dropped():
+    checks, sessions, checked, clock = pending(timeout=60)
+    # shorter than MIN_LENGTH_SESSION, never stored as a session
+    checks.close("barrier", T0 + timedelta(seconds=10))
+    clock.now = T0 + timedelta(seconds=30)
+    checks.run()
+    assert len(checks) == 1
+
+    clock.now = T0 + timedelta(seconds=100)
+    checks.run()
+    assert len(checks) == 0
+
+    # the session of a later cycle doesn't run the checks of the dropped one
+    store_session(sessions, "barrier", 90, 200)
+    checks.close("barrier", T0 + timedelta(seconds=200))
+    checks.run()
+    assert checked == ["barrier"]
+
+
+def test_cycles_merged_in_one_session_are_checked_once():
+    checks, sessions, checked, clock = pending()
+    checks.close("gelcoat", T0 + timedelta(seconds=50))
+    checks.close("gelcoat", T0 + timedelta(seconds=100))
+    store_session(sessions, "gelcoat", 0, 100)
+    checks.run()
+    assert checked == ["gelcoat"]
@@ -1,14 +1,31 @@
 from __future__ import print_function
-from flask import Flask, jsonify, request
-from pymongo import MongoClient
+from flask import Flask, Response, jsonify, request
+from pymongo import InsertOne, MongoClient, UpdateOne
+from bson import ObjectId
 from flask_cors import CORS
 from copy import deepcopy
 from datetime import datetime
 from datetime import timedelta
 import os.path
 import sys
-import pandas as pd
+import json
+import queue
 import logging
+import threading
+import time
+
+from common.readings import bucket_start, format_time, parse_time
+from common.rollups import query_rollups
+from common.schema import bootstrap_schema
+from common.versions import (ALERTS_VERSION, MAINTENANCE_VERSION, NOMINAL_VERSION, PRODUCTS_VERSION, SESSIONS_VERSION,
+                             VERSIONS, bump_versions)
+from cache import ResponseCache
+from live import LiveFeed
+from downsample import METHOD_MINMAX, check_downsampling, lttb_readings, minmax_readings, minmax_stages
+from segmenter import SessionSegmenter, find_segments, to_sessions
+from jobs import JOB_DONE, JOB_FAILED, JobRunner
+from common.buckets import (BUCKET_COLLECTION, BUCKET_SECONDS, FIELD_KEYS, IDLE_SPEED, LAYOUT_BUCKETS, STORAGE_LAYOUT,
+                            delete_idle_buckets, find_bucketed_readings, find_latest_bucketed_readings, iter_bucketed_readings)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,16 +39,44 @@ DEFAUL_MAINTEANCE_PUMP = 45
 DEFAUL_MAINTEANCE_FILTER = 21
 
 MIN_LENGTH_SESSION = 15  # Seconds
-IS_GET_NEW_SESSIONS_RUNNING = 0
-IS_DELETE_USELESS_READS_RUNNING = 0
-IS_UPDATE_PRODUCT_DB_RUNNING = 0
-IS_ADD_NEW_NOMINAL_SESSION_RUNNING = 0
+# jobs that run at the same time, and how long an endpoint waits for its job by default before answering 202
+JOB_WORKERS = 2
+JOB_WAIT_TIMEOUT = 30  # (SECOND)
+JOB_MAX_WAIT = 300  # (SECOND)
 
-PER_SECONDS_READS = 10
+PER_SECONDS_READS = 10  # must match SAMPLE_RATE_HZ of the rotary script
 
 num_datapoints_sent = 5 * PER_SECONDS_READS
+# the live feed behind /api/stream polls for new readings every LIVE_POLL_INTERVAL seconds
+LIVE_POLL_INTERVAL = 0.25  # (SECOND)
+LIVE_KEEPALIVE_INTERVAL = 15  # (SECOND)
+# every /api/stream client holds a thread of its worker, at most LIVE_STREAMS_MAX per worker (gunicorn.conf.py adds
+# as many threads), the clients above it are sent the window and reconnect after LIVE_STREAM_RETRY seconds
+LIVE_STREAMS_MAX = int(os.environ.get("API_STREAMS", 8))
+LIVE_STREAM_RETRY = 2  # (SECOND)
+# the new sessions are detected in the background when new readings arrived since the last check
+SESSION_REFRESH_INTERVAL = 10  # (SECOND)
+# lease held by the api worker that runs refresh_sessions
+SESSION_REFRESHER = "session refresher"
+# headers of the session lists, the time of the latest reading and the position of the last reading segmented
+FRESH_AS_OF_HEADER = "X-Fresh-As-Of"
+FRESH_CURSOR_HEADER = "X-Fresh-Cursor"
+# header of a page of the session and product lists, the "before" of the next page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+# largest "limit" of a page of the session and product lists
+PAGE_LIMIT_MAX = 1000
+# the days left before the maintenance change with the time, get_maintenance is computed again after that long
+MAINTENANCE_CACHE_SECONDS = 60  # (SECOND)
+# largest window of latest readings kept in memory for get_20 and /api/stream
+LIVE_WINDOW_MAX = 60 * PER_SECONDS_READS
+# sessions whose metrics are computed by one aggregation
+SESSION_METRICS_BATCH_SIZE = 500
+# readings per chunk of the streamed /api/history response
+HISTORY_CHUNK_SIZE = 1000
+# number of points returned by /api/history_rollup when the request doesn't ask for a number
+DEFAULT_ROLLUP_POINTS = 500
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=[FRESH_AS_OF_HEADER, FRESH_CURSOR_HEADER, NEXT_CURSOR_HEADER])
 
 client = MongoClient("mongodb://db:27017")
 
@@ -44,7 +89,7 @@ except:
     logging.critical("FLASK API CANNOT CONNECT TO MONGODB")
 
 
-ALL_COLUMNS = ['_id', 'time', 'Barr_pulses', 'Gelcoat_pulses', 'Barrier_speedRPM',
+ALL_COLUMNS = ['_id', 'time', 'timestamp', 'device', 'seq', 'Barr_pulses', 'Gelcoat_pulses', 'Barrier_speedRPM',
                'Gelcoat_speedRPM', 'WaterLevel_1', 'WaterLevel_2', 'Pressure']
 
 COLUMNS_TO_CHECK_SPEED = {
@@ -52,6 +97,10 @@ COLUMNS_TO_CHECK_SPEED = {
     "barrier": "Barrier_speedRPM"
 }
 
+PUMP_TYPES = ("barrier", "gelcoat")
+# _id of the checkpoint of update_product_db in collection_session_checkpoints
+PRODUCTS_CHECKPOINT = "products"
+
 COLUMNS_TO_CHECK_PULSES = {
     "gelcoat": "Gelcoat_pulses",
     "barrier": "Barr_pulses"
@@ -71,8 +120,27 @@ COLUMNS_WEIGHT_PER_PULSE = {
     "barrier": WEIGHT_PER_PULSE_BARRIER
 }
 
+# fields that are only used internally and can't be serialized to JSON by jsonify
+READING_EXCLUDED_FIELDS = ('_id', 'timestamp')
+# fields of the readings sent by get_20 and /api/stream, plus the _id used as cursor
+LIVE_PROJECTION = {'_id': 1, 'time': 1, 'Barr_pulses': 1, 'Gelcoat_pulses': 1, 'Barrier_speedRPM': 1,
+                   'Gelcoat_speedRPM': 1, 'WaterLevel_1': 1, 'WaterLevel_2': 1, 'Pressure': 1}
+SESSION_PROJECTION = {'_id': 0, 'start_datetime': 0, 'end_datetime': 0, 'start_id': 0, 'end_id': 0}
+# fields of the sessions and products that can be asked for with the "fields" query parameter, see find_list_page
+SESSION_FIELDS = ('id', 'start_time', 'end_time', 'pump_type', 'length', 'total_sprayed_amount', 'avg_speed',
+                  'avg_pressure', 'comments', 'is_trash')
+PRODUCT_FIELDS = ('id', 'start_time', 'end_time', 'gelcoat_material', 'barrier_material', 'comments', 'hide')
+# fields of the sessions read to match the products
+PRODUCT_SESSION_PROJECTION = {'_id': 0, 'id': 1, 'pump_type': 1, 'start_time': 1, 'end_time': 1, 'start_datetime': 1,
+                              'end_datetime': 1, 'total_sprayed_amount': 1}
+# fields of the products that are only used internally
+PRODUCT_PROJECTION = {'_id': 0, 'key': 0, 'session_ids': 0, 'start_datetime': 0, 'end_datetime': 0,
+                      'product_unique_identifier': 0}
+
 db = client["Sensor_Data"]
 collection = db["test_28_march"]
+# readings of the bucketed layout, used instead of collection if STORAGE_LAYOUT is LAYOUT_BUCKETS
+bucket_collection = db[BUCKET_COLLECTION]
 
 db_agent_nominal_values = client["Agent_Nominal_Values"]
 collection_nominal_gelcoat = db_agent_nominal_values["gelcoat"]
@@ -91,16 +159,39 @@ db_sessions = client["Sessions"]
 collection_sessions = db_sessions["sessions"]
 collection_products = db_sessions["products"]
 collection_delete_useless_reads = db_sessions["delete_useless_reads"]
+# checkpoints of the session segmenter and of the products (PRODUCTS_CHECKPOINT)
+collection_session_checkpoints = db_sessions["session_checkpoints"]
+
+db_api = client["Api"]
+collection_jobs = db_api["jobs"]
+# one lease per running job key, shared by the gunicorn workers
+collection_job_leases = db_api["job_leases"]
+# versions of the data of the cached endpoints, bumped by the writes of the api and the agent
+collection_versions = client[VERSIONS[0]][VERSIONS[1]]
+
+# create the missing indexes and log the hot queries that would scan a whole collection
+bootstrap_schema(client)
+
+jobs = JobRunner(collection_jobs, collection_job_leases, JOB_WORKERS)
+try:
+    jobs.recover()
+except Exception as e:
+    logging.error(f"JobRunner recover < Exception: {str(e)} >")
+
+response_cache = ResponseCache(collection_versions)
 
 
 @app.route('/api/get_20', methods=['GET'])
 def get_20():
     """
-    Retrieves the latest num_datapoints_sent data points from the collection and calculates various metrics.
+    Retrieves the latest num_datapoints_sent data points and calculates various metrics.
+
+    The data points are served from the in-memory window of the live feed, no query is run per request.
+    The optional "n" query parameter asks for another number of data points, up to LIVE_WINDOW_MAX.
 
     Returns:
         A JSON response containing the following information:
-        - data: A list of the latest num_datapoints_sent data points retrieved from the collection.
+        - data: A list of the latest num_datapoints_sent data points, newest first.
         - total_weight_barr: The total weight of barrier pulses calculated based on the sum of 'Barr_pulses' field in the data.
         - total_weight_gel: The total weight of gelcoat pulses calculated based on the sum of 'Gelcoat_pulses' field in the data.
         - pressure: The average pressure calculated based on the 'Pressure' field in the data.
@@ -108,34 +199,13 @@ def get_20():
     Raises:
         Exception: If an error occurs while retrieving the data or calculating the metrics.
     """
-    
-    global num_datapoints_sent
     try:
-        data_20 = list(collection.find({}, {
-            '_id': 0,
-            'time': 1,
-            'Barr_pulses': 1,
-            'Gelcoat_pulses': 1,
-            'Barrier_speedRPM': 1,
-            'Gelcoat_speedRPM': 1,
-            'WaterLevel_1': 1,
-            'WaterLevel_2': 1,
-            'Pressure': 1
-        }).sort('_id', -1).limit(num_datapoints_sent)) 
-        
-        data = pd.DataFrame(data_20)
-        barr_pulses = data['Barr_pulses'].sum()
-        gelcoat_pulses = data['Gelcoat_pulses'].sum()
-        weight_per_pulse_barr = COLUMNS_WEIGHT_PER_PULSE["barrier"]
-        weight_per_pulse_gel = COLUMNS_WEIGHT_PER_PULSE["gelcoat"]
-        avg_pressure = data["Pressure"].mean()
-        total_weight_barr = barr_pulses * weight_per_pulse_barr
-        total_weight_gel = gelcoat_pulses * weight_per_pulse_gel
+        snapshot = live_feed.snapshot(live_window_size())
         response = {
-            "data": data_20,
-            "total_weight_barr": int(total_weight_barr),
-            "total_weight_gel": int(total_weight_gel),
-            "pressure": avg_pressure
+            "data": snapshot["data"],
+            "total_weight_barr": snapshot["total_weight_barr"],
+            "total_weight_gel": snapshot["total_weight_gel"],
+            "pressure": snapshot["pressure"]
         }
         return jsonify(response), 200
     except Exception as e:
@@ -143,117 +213,543 @@ def get_20():
         return jsonify({"error get_20": str(e)}), 500
 
 
-def binary_search_history(all_sessions, start_date, end_date):
+def live_window_size():
+    """
+    Returns the window asked for with the "n" query parameter, num_datapoints_sent by default, within 1..LIVE_WINDOW_MAX.
+    """
+    return max(1, min(request.args.get('n', default=num_datapoints_sent, type=int), LIVE_WINDOW_MAX))
+
+
+def fetch_live_readings(cursor, limit):
+    """
+    Reads the readings after cursor for the live feed, in the format of get_20.
+
+    Args:
+        cursor: The position (see find_reading_id) of the last reading already in the feed, or None.
+        limit (int): The maximum number of readings.
+
+    Returns:
+        tuple: The readings in time order and the position of the last one. Without cursor the latest readings are returned.
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        if cursor is None:
+            readings = find_latest_bucketed_readings(bucket_collection, limit, exclude=('device', 'seq'))[::-1]
+        else:
+            readings = [reading for reading in find_bucketed_readings(bucket_collection, cursor, exclude=('device', 'seq'))
+                        if reading['timestamp'] > cursor][:limit]
+        position = 'timestamp'
+    else:
+        if cursor is None:
+            readings = list(collection.find({}, LIVE_PROJECTION).sort('_id', -1).limit(limit))[::-1]
+        else:
+            readings = list(collection.find({'_id': {'$gt': cursor}}, LIVE_PROJECTION).sort('_id', 1).limit(limit))
+        position = '_id'
+    if readings:
+        cursor = readings[-1][position]
+    for reading in readings:
+        del reading[position]
+    return readings, cursor
+
+
+def summarize_live_window(sums, count):
+    """
+    Computes the totals of get_20 from the running sums of the live feed window.
+    """
+    return {
+        "total_weight_barr": int(sums['Barr_pulses'] * COLUMNS_WEIGHT_PER_PULSE["barrier"]),
+        "total_weight_gel": int(sums['Gelcoat_pulses'] * COLUMNS_WEIGHT_PER_PULSE["gelcoat"]),
+        "pressure": sums['Pressure'] / count if count else None
+    }
+
+
+live_feed = LiveFeed(fetch_live_readings, summarize_live_window, LIVE_WINDOW_MAX, LIVE_POLL_INTERVAL,
+                     max_clients=LIVE_STREAMS_MAX)
+
+
+@app.route('/api/stream', methods=['GET'])
+def stream():
+    """
+    Streams the latest readings with Server-Sent Events.
+
+    Every client first receives the current window (like get_20, with "reset": true) and then one message per
+    batch of new readings with the updated totals of the window. All clients share the same tailer of the database.
+    The optional "n" query parameter sets the size of the window, as for get_20.
+
+    A worker holds at most LIVE_STREAMS_MAX streams open, so they can't take all the threads of the normal
+    requests. Above it the client gets the current window and the stream is closed, the browser reconnects
+    after LIVE_STREAM_RETRY seconds: it polls until a stream is free.
+
+    Returns:
+        A text/event-stream response.
+    """
+    window = live_window_size()
+    subscription = live_feed.subscribe(window)
+    logging.info(f"stream < clients: {live_feed.clients()} >")
+    if subscription is None:
+        return Response(f"retry: {LIVE_STREAM_RETRY * 1000}\ndata: {json.dumps(live_feed.snapshot(window))}\n\n",
+                        mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    def events():
+        try:
+            while True:
+                try:
+                    message = subscription.get(timeout=LIVE_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(message)}\n\n"
+        finally:
+            live_feed.unsubscribe(subscription)
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def find_reading_id(timestamp, last=False):
+    """
+    Finds the position of the reading closest to the given time.
+
+    The position of a reading is its _id in the documents layout. In the bucketed layout readings have no _id
+    and are located by their timestamp, so the given time is returned as is.
+
+    Args:
+        timestamp (datetime): The time to look up.
+        last (bool, optional): If True, the last reading taken at or before the given time is returned,
+            otherwise the first reading taken at or after it. Defaults to False.
+
+    Returns:
+        ObjectId: The _id of the reading (the timestamp in the bucketed layout), or None if there is no such reading.
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        return timestamp
+    if last:
+        reading = collection.find_one({"timestamp": {"$lte": timestamp}}, {"_id": 1},
+                                      sort=[("timestamp", -1), ("_id", -1)])
+    else:
+        reading = collection.find_one({"timestamp": {"$gte": timestamp}}, {"_id": 1},
+                                      sort=[("timestamp", 1), ("_id", 1)])
+    return reading["_id"] if reading else None
+
+
+def find_readings(first, last, exclude=READING_EXCLUDED_FIELDS):
     """
-    Performs binary search on a list of sessions to find the index of a session that falls within a given date range.
+    Returns the readings between two positions (see find_reading_id), both included, sorted by time.
+
+    Args:
+        first: The position of the first reading.
+        last: The position of the last reading.
+        exclude (tuple, optional): Fields left out of the readings. Defaults to the fields jsonify can't serialize.
+
+    Returns:
+        list: The readings, in the documents layout.
+    """
+    return list(iter_readings(first, last, exclude))
+
+
+def iter_readings(first, last, exclude=READING_EXCLUDED_FIELDS):
+    """
+    Same as find_readings, but yields the readings as they are read from the database instead of loading them all.
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        return iter_bucketed_readings(bucket_collection, first, last, exclude=exclude)
+    projection = {key: 0 for key in exclude} or None
+    return collection.find({'_id': {'$gte': first, '$lte': last}}, projection, sort=[('_id', 1)],
+                           batch_size=HISTORY_CHUNK_SIZE)
+
+
+def reading_time(position):
+    """
+    Returns the time of the reading at the given position (see find_reading_id).
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        return position
+    return collection.find_one({"_id": position}, {"timestamp": 1})["timestamp"]
+
+
+def aggregate_readings(first, last, stages):
+    """
+    Runs aggregation stages over the readings between two positions (see find_reading_id), both included.
+
+    The stages get one document per reading with its "timestamp", in the bucketed layout the buckets are
+    unpacked inside MongoDB into {timestamp, device, seq, <fields>} documents.
+
+    Returns:
+        pymongo.command_cursor.CommandCursor: The documents returned by the stages.
+    """
+    if STORAGE_LAYOUT != LAYOUT_BUCKETS:
+        return collection.aggregate([{"$match": {"_id": {"$gte": first, "$lte": last}}}] + stages, allowDiskUse=True)
+
+    fields = list(FIELD_KEYS.items())
+    pipeline = [
+        {"$match": {"s": {"$gte": bucket_start(first, BUCKET_SECONDS), "$lte": last}, "e": {"$gte": first}}},
+        {"$project": {"_id": 0, "s": 1, "d": 1,
+                      "r": {"$zip": {"inputs": ["$t", "$q"] + [f"$v.{key}" for _, key in fields]}}}},
+        {"$unwind": "$r"},
+        {"$project": {"timestamp": {"$add": ["$s", {"$arrayElemAt": ["$r", 0]}]},
+                      "device": "$d",
+                      "seq": {"$arrayElemAt": ["$r", 1]},
+                      **{field: {"$arrayElemAt": ["$r", i + 2]} for i, (field, _) in enumerate(fields)}}},
+        {"$match": {"timestamp": {"$gte": first, "$lte": last}}},
+    ]
+    return bucket_collection.aggregate(pipeline + stages, allowDiskUse=True)
+
+
+def downsample_history(first, last, max_points, method):
+    """
+    Downsamples the readings between two positions (see find_reading_id), see downsample.py.
+
+    Returns:
+        tuple: (at most max_points readings in the format of /api/history, the number of readings read).
+    """
+    check_downsampling(method, max_points)
+    if method == METHOD_MINMAX:
+        stages = minmax_stages(reading_time(first), reading_time(last), max_points)
+        readings, count = minmax_readings(aggregate_readings(first, last, stages))
+    else:
+        readings, count = lttb_readings(lambda: iter_readings(first, last, exclude=('_id',)), max_points)
+
+    for reading in readings:
+        reading.pop("_id", None)
+        # the bucketed layout doesn't store the formatted time
+        reading.setdefault("time", format_time(reading["timestamp"]))
+        reading.pop("timestamp")
+    return readings, count
+
+
+def delete_readings_before(position):
+    """
+    Deletes every reading before the given position (see find_reading_id).
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        bucket_collection.delete_many({"e": {"$lt": position}})
+    else:
+        collection.delete_many({"_id": {"$lt": position}})
+
+
+def delete_idle_readings(after, before):
+    """
+    Deletes the readings strictly between two positions (see find_reading_id) where both pumps are stopped.
+
+    In the bucketed layout only whole minutes where both pumps are stopped are deleted.
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        delete_idle_buckets(bucket_collection, after, before)
+    else:
+        collection.delete_many({
+            "_id": {
+                "$gt": after,
+                "$lt": before
+            },
+            # and they must also have almost zero barrier speed and gelcoat speed
+            "Barrier_speedRPM": {"$lt": IDLE_SPEED},
+            "Gelcoat_speedRPM": {"$lt": IDLE_SPEED}
+        })
+
+
+def find_overlapping_sessions(start_date, end_date):
+    """
+    Returns the sessions that overlap a given date range, with a single query on the end_start index.
 
     Args:
-        all_sessions (list): A list of sessions, where each session is a dictionary containing "start_time" and "end_time" keys.
         start_date (datetime): The start date of the desired date range.
         end_date (datetime): The end date of the desired date range.
 
     Returns:
-        int: The index of the session that falls within the given date range. Returns -1 if no session is found.
+        list: The sessions with their "start_datetime", "end_datetime", "start_id" and "end_id", sorted by start time.
+    """
+    sessions = collection_sessions.find(
+        {"end_datetime": {"$gte": start_date}, "start_datetime": {"$lte": end_date}},
+        {"_id": 0, "start_datetime": 1, "end_datetime": 1, "start_id": 1, "end_id": 1},
+        sort=[("end_datetime", 1)])
+    return sorted(sessions, key=lambda session: session["start_datetime"])
 
-    Raises:
-        ValueError: If the start_date is greater than the end_date.
+
+def stream_json_array(items, on_done=None):
     """
-    
-    left_cursor = 0
-    right_cursor = len(all_sessions) - 1
-    
-    while left_cursor <= right_cursor:
+    Yields a JSON array of the given items in chunks of HISTORY_CHUNK_SIZE items, for a streamed Response.
 
-        mid = left_cursor + (right_cursor - left_cursor) // 2
-        session_end_time = datetime.strptime(all_sessions[mid]["end_time"], '%Y-%m-%d %I:%M:%S %p')
-        session_start_time = datetime.strptime(all_sessions[mid]["start_time"], '%Y-%m-%d %I:%M:%S %p')
-        
-        if session_end_time >= start_date and session_start_time <= end_date:
-            # Check if x is present at mid
-            return mid
-        elif session_end_time < start_date:
-            # we should go right, ignore left half
-            left_cursor = mid + 1
-        else:
-            # we should go left, ignore right half
-            right_cursor = mid - 1
-    # If we reach here, then the element was not present
-    return -1
+    Args:
+        items (iterable): JSON serializable items, e.g. a cursor.
+        on_done (callable, optional): Called with the number of items once they are all sent.
+    """
+    count = 0
+    chunk = []
+    yield "["
+    for item in items:
+        chunk.append(json.dumps(item))
+        if len(chunk) == HISTORY_CHUNK_SIZE:
+            yield ("," if count else "") + ",".join(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        yield ("," if count else "") + ",".join(chunk)
+        count += len(chunk)
+    yield "]"
+    if on_done is not None:
+        on_done(count)
 
 
 @app.route('/api/history', methods=['POST'])
 def get_history():
     """
     Retrieves the history of sessions between a given start date and end date.
-    
+
+    The sessions overlapping the range are found with one indexed query, the readings are streamed back as a
+    chunked JSON array.
+
+    With "max_points" in the request body the channels are downsampled on the server and at most that many
+    readings are returned in total. "method" is "minmax" (default, keeps the min and max of every time bucket
+    so spikes stay visible, computed inside MongoDB) or "lttb", see downsample.py.
+
     Returns:
-        A JSON response containing the list of sessions within the specified date range.
+        A JSON response containing the readings of the sessions within the specified date range.
         
     Raises:
         Exception: If an error occurs during the retrieval process.
     """
     try:
         data = request.get_json()
-        start_date = datetime.strptime(data['startDate'], '%Y-%m-%d %I:%M:%S %p')
-        end_date = datetime.strptime(data['endDate'], '%Y-%m-%d %I:%M:%S %p')
+        start_date = parse_time(data['startDate'])
+        end_date = parse_time(data['endDate'])
+        max_points = int(data.get('max_points') or 0)
+        method = data.get('method', METHOD_MINMAX)
         
         # if start_date is greater than end_date, we swap them
         if start_date > end_date:
             start_date, end_date = end_date, start_date
         
         # find all sessions between the start_date and end_date
-        sessions_to_show = []
+        sessions_to_show = find_overlapping_sessions(start_date, end_date)
 
-        all_sessions = list(collection_sessions.find({}).sort('_id', 1))
-        
-        ### The sessions are sorted by their _id which is equivalent to their start_time and id
-        ### first, we try to find a sessions that has an end_time greater than the start_date and a start_time less than the end_date
-        ### We want to find this session in log(n) time
-        
-        session_mid_index = binary_search_history(all_sessions, start_date, end_date)
-        
-        if session_mid_index == -1:
-            return jsonify([]), 200
-        else:
-            # we found the session, now we need to find the first session that has an end_time greater than the start_date
-            # and a start_time less than the end_date
-            left_cursor = session_mid_index
-            right_cursor = session_mid_index
-            while left_cursor >= 0 and datetime.strptime(all_sessions[left_cursor]["end_time"], '%Y-%m-%d %I:%M:%S %p') >= start_date:
-                left_cursor -= 1
-            while right_cursor < len(all_sessions) and datetime.strptime(all_sessions[right_cursor]["start_time"], '%Y-%m-%d %I:%M:%S %p') <= end_date:
-                right_cursor += 1
-            
-            sessions_to_show = all_sessions[left_cursor+1:right_cursor]
-        
         if not sessions_to_show:
             return jsonify([]), 200
-        
-        if datetime.strptime(sessions_to_show[0]["start_time"], '%Y-%m-%d %I:%M:%S %p') > start_date:
-            id_start = collection.find_one({"time": sessions_to_show[0]["start_time"]})["_id"]
+
+        if sessions_to_show[0]["start_datetime"] > start_date:
+            id_start = sessions_to_show[0].get("start_id") or find_reading_id(sessions_to_show[0]["start_datetime"])
         else:
-            id_start = collection.find_one({"time": data['startDate']} )["_id"]
-            
-        if datetime.strptime(sessions_to_show[-1]["end_time"], '%Y-%m-%d %I:%M:%S %p') < end_date:
-            id_end = collection.find_one({"time": sessions_to_show[-1]["end_time"]}, sort=[('_id', -1)])["_id"]
+            id_start = find_reading_id(start_date)
+
+        if sessions_to_show[-1]["end_datetime"] < end_date:
+            id_end = sessions_to_show[-1].get("end_id") or find_reading_id(sessions_to_show[-1]["end_datetime"], last=True)
         else:
-            id_end = collection.find_one({"time": data['endDate']})["_id"]
-        
-        results = collection.find({
-            '_id': {
-                '$gte': id_start, 
-                '$lte': id_end
-                }
-            }, {'_id': 0,}, sort=[('_id', 1)])
-        results_list = list(results)
-        logging.info(f"History tab < input_startDate: {start_date}, input_endDate: {end_date}, id_start: {id_start}, id_end: {id_end}, start_time: {results_list[0]['time']}, end_time: {results_list[-1]['time']} ,len_sessions: {len(sessions_to_show)} >")
-        
-        return jsonify(results_list), 200
+            id_end = find_reading_id(end_date, last=True)
+
+        if id_start is None or id_end is None:
+            return jsonify([]), 200
+
+        if max_points:
+            readings, count = downsample_history(id_start, id_end, max_points, method)
+            logging.info(f"History tab < input_startDate: {start_date}, input_endDate: {end_date}, id_start: {id_start}, id_end: {id_end}, len_readings: {count}, max_points: {max_points}, method: {method}, len_points: {len(readings)}, len_sessions: {len(sessions_to_show)} >")
+            return jsonify(readings), 200
+
+        def on_done(count):
+            logging.info(f"History tab < input_startDate: {start_date}, input_endDate: {end_date}, id_start: {id_start}, id_end: {id_end}, len_readings: {count}, len_sessions: {len(sessions_to_show)} >")
+
+        # the readings are sent while they are read from the cursor, a long range is never held in memory
+        return Response(stream_json_array(iter_readings(id_start, id_end), on_done), mimetype="application/json"), 200
+    except ValueError as e:
+        logging.error(f"History tab < ValueError: {str(e)} >")
+        return jsonify({"error get_history": str(e)}), 400
     except Exception as e:
         logging.error(f"History tab < Exception: {str(e)}, input_startDate: {start_date}, input_endDate: {end_date} >")
         return jsonify({"error get_history": str(e)}), 500
 
 
+@app.route('/api/history_rollup', methods=['POST'])
+def get_history_rollup():
+    """
+    Retrieves the rolled up readings between a given start date and end date.
+
+    The request body has "startDate" and "endDate" and optionally "points", the number of points the chart needs
+    (defaults to DEFAULT_ROLLUP_POINTS), and "device". The coarsest rollup tier that still gives that many points
+    is used, its name is returned in the X-Rollup-Tier header.
+
+    Returns:
+        A JSON response containing one point per bucket with the total of the pulses, the mean of the other
+        fields and their "min" and "max".
+
+    Raises:
+        Exception: If an error occurs during the retrieval process.
+    """
+    try:
+        data = request.get_json()
+        start_date = parse_time(data['startDate'])
+        end_date = parse_time(data['endDate'])
+        points = int(data.get('points', DEFAULT_ROLLUP_POINTS))
+
+        # if start_date is greater than end_date, we swap them
+        if start_date > end_date:
+            start_date, end_date = end_date, start_date
+
+        tier, results_list = query_rollups(db, start_date, end_date, points, data.get('device'))
+        logging.info(f"History rollup < input_startDate: {start_date}, input_endDate: {end_date}, points: {points}, tier: {tier}, len_results: {len(results_list)} >")
+
+        return jsonify(results_list), 200, {"X-Rollup-Tier": tier}
+    except Exception as e:
+        logging.error(f"History rollup < Exception: {str(e)} >")
+        return jsonify({"error get_history_rollup": str(e)}), 500
+
+
+def find_pump_sessions(pump_type, since=None):
+    """
+    Finds the sessions of a pump from the readings with a non-zero speed.
+
+    Args:
+        pump_type (str): The type of pump, either "gelcoat" or "barrier".
+        since (optional): The position (see find_reading_id) of the last seen record in the database. Defaults to None.
+
+    Returns:
+        list: The sessions sorted by their begin time, in the format returned by find_all_sessions.
+    """
+    return find_all_sessions(since, (pump_type,))
+
+
+def find_all_sessions(since=None, pump_types=PUMP_TYPES):
+    """
+    Finds the sessions of both pumps in a single pass over the readings, sorted by their begin time.
+
+    Args:
+        since (optional): The position (see find_reading_id) of the last seen record in the database. Defaults to None.
+        pump_types (tuple, optional): The pumps. Defaults to both.
+
+    Returns:
+        list: The sessions sorted by their begin time, each session is a dictionary with the following keys:
+            - begin (datetime): The time of the first reading of the session.
+            - end (datetime): The time of the last reading of the session.
+            - begin_id: The position of the first reading of the session.
+            - end_id: The position of the last reading of the session.
+            - pump_type (str): The type of pump used during the session.
+            - length (float): The duration of the session in seconds.
+    """
+    positions, timestamps, speeds = find_running_readings(since, pump_types)
+    # we allow for having MIN_LENGTH_SESSION consecutive zero values within a session
+    # and remove the sessions shorter than MIN_LENGTH_SESSION seconds
+    return to_sessions(find_segments(positions, timestamps, speeds, MIN_LENGTH_SESSION), MIN_LENGTH_SESSION)
+
+
+def find_running_readings(since=None, pump_types=PUMP_TYPES):
+    """
+    Returns the readings after since where any of the pumps runs, with one query projecting the speed of every pump.
+
+    Args:
+        since (optional): The position (see find_reading_id) of the last seen record in the database. Defaults to None.
+        pump_types (tuple, optional): The pumps. Defaults to both.
+
+    Returns:
+        tuple: (positions, timestamps, speeds) sorted by time, speeds is {pump_type: list of speeds}.
+    """
+    columns = {pump_type: COLUMNS_TO_CHECK_SPEED[pump_type] for pump_type in pump_types}
+    positions, timestamps = [], []
+    speeds = {pump_type: [] for pump_type in pump_types}
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        # the position of a reading is its timestamp, buckets where no pump runs are skipped
+        readings = (reading for reading in iter_bucketed_readings(bucket_collection, since, active=tuple(columns.values()))
+                    if since is None or reading['timestamp'] > since)
+        position_key = 'timestamp'
+    else:
+        # one branch per pump, each one served in _id order by the partial index of the running readings
+        query = {'$or': [{column: {'$gt': 0}} for column in columns.values()]}
+        if since is not None:
+            # since is the "_id" of the last seen record in the database
+            query['_id'] = {'$gt': since}
+        projection = dict({'_id': 1, 'timestamp': 1}, **{column: 1 for column in columns.values()})
+        readings = collection.find(query, projection).sort('_id', 1)
+        position_key = '_id'
+    for reading in readings:
+        positions.append(reading[position_key])
+        timestamps.append(reading['timestamp'])
+        for pump_type, column in columns.items():
+            speeds[pump_type].append(reading[column])
+    return positions, timestamps, speeds
+
+
+def find_latest_reading_time():
+    """
+    Returns the time of the latest reading, whatever the speed of the pumps, or None if there is no reading.
+    """
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        bucket = bucket_collection.find_one({}, {"e": 1}, sort=[("s", -1)])
+        return bucket["e"] if bucket else None
+    reading = collection.find_one({}, {"timestamp": 1}, sort=[("_id", -1)])
+    return reading["timestamp"] if reading else None
+
+
+session_segmenter = SessionSegmenter(collection_session_checkpoints, PUMP_TYPES, find_running_readings,
+                                     MIN_LENGTH_SESSION, MIN_LENGTH_SESSION)
+
+
+def find_ended_sessions(since=None):
+    """
+    Finds the sessions of both pumps that ended since the checkpoint of the session segmenter.
+
+    Only the readings after the checkpoint are read. A session still running is kept in the checkpoint and
+    returned once it is over. The checkpoint is saved by session_segmenter.commit().
+
+    Args:
+        since (optional): The position (see find_reading_id) to start from if there is no checkpoint. Defaults to None.
+
+    Returns:
+        list: The sessions sorted by their begin time, in the format returned by find_all_sessions.
+    """
+    return session_segmenter.advance(find_latest_reading_time(), since)
+
+
+def refresh_sessions():
+    """
+    Starts the detection of the new sessions whenever readings arrived since the last check, from its own thread.
+
+    Every api worker starts this thread but only the one holding the SESSION_REFRESHER lease polls, the others
+    wait to take the lease over if that worker goes away. The agent also asks for the detection when a cycle is
+    over. The session lists are served from the sessions collection as it is, see with_freshness.
+    """
+    while True:
+        try:
+            with jobs.lock(SESSION_REFRESHER, poll_interval=SESSION_REFRESH_INTERVAL):
+                logging.info(f"refresh_sessions < pid: {os.getpid()} >")
+                # matches the sessions stored before this start that no update matched yet, e.g. after a failure
+                jobs.submit("update_product_db", update_product_db)
+                latest_seen = None
+                while True:
+                    latest_time = find_latest_reading_time()
+                    if latest_time is not None and latest_time != latest_seen:
+                        jobs.submit("get_new_sessions", update_sessions)
+                        latest_seen = latest_time
+                    time.sleep(SESSION_REFRESH_INTERVAL)
+        except Exception as e:
+            logging.error(f"refresh_sessions < Exception: {str(e)} >")
+            time.sleep(SESSION_REFRESH_INTERVAL)
+
+
+def with_freshness(response):
+    """
+    Adds the headers telling how recent the sessions are to a response: the time of the latest reading and the
+    position of the last running reading when the sessions were last detected.
+
+    The cached session lists keep the headers of the moment they were computed, the checkpoint is not read again
+    on a cache hit: they tell how recent the sessions are at least, they are updated with the next new session.
+    """
+    checkpoint = session_segmenter.checkpoint() or {}
+    if checkpoint.get("fresh") is not None:
+        response.headers[FRESH_AS_OF_HEADER] = format_time(checkpoint["fresh"])
+    if checkpoint.get("cursor") is not None:
+        response.headers[FRESH_CURSOR_HEADER] = str(checkpoint["cursor"])
+    return response
+
+
+def serialize_sessions(sessions):
+    """
+    Converts sessions returned by find_pump_sessions to the JSON format sent by the get_starts_* endpoints.
+
+    Args:
+        sessions (list): The sessions to convert.
+
+    Returns:
+        list: A list of dictionaries with the keys begin, end (formatted time strings), pump_type and length.
+    """
+    return [{"begin": format_time(session["begin"]), "end": format_time(session["end"]),
+             "pump_type": session["pump_type"], "length": session["length"]}
+            for session in sessions]
+
+
 @app.route('/api/get_starts_gelcoat', methods=['GET'])
 def get_starts_gelcoat(since=None):
     """
@@ -273,52 +769,7 @@ def get_starts_gelcoat(since=None):
         Exception: If an error occurs while retrieving the gelcoat session information.
     """
     try:
-        starts_gel = []
-        ends_gel = []
-
-        if since is None:
-            # retrieve non-zero values
-            data = list(collection.find({'Gelcoat_speedRPM': {'$gt': 0}}, {
-                '_id': 0,
-                'time': 1,
-            }).sort('_id', 1))
-        else:
-            # since is the "_id" of the last seen record in the database
-            data = list(collection.find({'_id': {'$gt': since}, 'Gelcoat_speedRPM': {'$gt': 0}}, {
-                '_id': 0,
-                'time': 1,
-            }).sort('_id', 1))
-            
-
-        if not data:
-            return jsonify([]), 200
-        
-        for i in range(len(data) - 1):
-            if i == 0:
-                starts_gel.append(data[i]['time'])
-            # converting to datetime object
-            curr_time = datetime.strptime(
-                data[i]['time'], '%Y-%m-%d %I:%M:%S %p')
-            next_time = datetime.strptime(
-                data[i+1]['time'], '%Y-%m-%d %I:%M:%S %p')
-            # we allow for having MIN_LENGTH_SESSION consecutive zero values within a session
-            if (next_time - curr_time).total_seconds() > MIN_LENGTH_SESSION:
-                starts_gel.append(data[i+1]['time'])
-                ends_gel.append(data[i]['time'])
-        ends_gel.append(data[-1]['time'])
-
-        # removing session shorter than MIN_LENGTH_SESSION seconds
-        final_starts_gel = []
-        final_ends_gel = []
-        for i in range(len(starts_gel)):
-            if (datetime.strptime(ends_gel[i], '%Y-%m-%d %I:%M:%S %p') - datetime.strptime(starts_gel[i], '%Y-%m-%d %I:%M:%S %p')).total_seconds() > MIN_LENGTH_SESSION:
-                final_starts_gel.append(starts_gel[i])
-                final_ends_gel.append(ends_gel[i])
-
-        # creating response object
-        output = [{"begin": start, "end": end, 'pump_type': 'gelcoat', "length": (datetime.strptime(end, '%Y-%m-%d %I:%M:%S %p') - datetime.strptime(start, '%Y-%m-%d %I:%M:%S %p')).total_seconds()}
-                  for start, end in zip(final_starts_gel, final_ends_gel)]
-
+        output = serialize_sessions(find_pump_sessions("gelcoat", since))
         logging.info(f"get_starts_gelcoat < since: {since} >")
         return jsonify(output), 200
     except Exception as e:
@@ -335,60 +786,18 @@ def get_starts_barrier(since=None):
         since (optional): The "_id" of the last seen record in the database. Defaults to None.
     
     Returns:
-        tuple: A tuple containing the gelcoat session information in the following format:
+        tuple: A tuple containing the barrier session information in the following format:
             - begin (str): The start time of the session.
             - end (str): The end time of the session.
-            - pump_type (str): The type of pump used during the session (always 'gelcoat').
+            - pump_type (str): The type of pump used during the session (always 'barrier').
             - length (float): The duration of the session in seconds.
     
     Raises:
-        Exception: If an error occurs while retrieving the gelcoat session information.
+        Exception: If an error occurs while retrieving the barrier session information.
     """
     
     try:
-        starts_bar = []
-        ends_bar = []
-
-        if since is None:
-            # retrieve non-zero values
-            data = list(collection.find({'Barrier_speedRPM': {'$gt': 0}}, {
-                '_id': 0,
-                'time': 1,
-            }).sort('_id', 1))
-        else:
-            # since is the "_id" of the last seen record in the database
-            data = list(collection.find({'_id': {'$gt': since}, 'Barrier_speedRPM': {'$gt': 0}}, {
-                '_id': 0,
-                'time': 1,
-            }).sort('_id', 1))
-
-        if not data:
-            return jsonify([]), 200
-            
-
-        for i in range(len(data) - 1):
-            if i == 0:
-                starts_bar.append(data[i]['time'])
-            # converting to datetime object
-            curr_time = datetime.strptime(
-                data[i]['time'], '%Y-%m-%d %I:%M:%S %p')
-            next_time = datetime.strptime(
-                data[i+1]['time'], '%Y-%m-%d %I:%M:%S %p')
-            # we allow for having MIN_LENGTH_SESSION consecutive zero values within a session
-            if (next_time - curr_time).total_seconds() > MIN_LENGTH_SESSION:
-                starts_bar.append(data[i+1]['time'])
-                ends_bar.append(data[i]['time'])
-        ends_bar.append(data[-1]['time'])
-            
-        # removing session shorter than MIN_LENGTH_SESSION seconds
-        final_starts_bar = []
-        final_ends_bar = []
-        for i in range(len(starts_bar)):
-            if (datetime.strptime(ends_bar[i], '%Y-%m-%d %I:%M:%S %p') - datetime.strptime(starts_bar[i], '%Y-%m-%d %I:%M:%S %p')).total_seconds() > (MIN_LENGTH_SESSION):
-                final_starts_bar.append(starts_bar[i])
-                final_ends_bar.append(ends_bar[i])
-        output = [{"begin": start, "end": end, "pump_type": "barrier", "length": (datetime.strptime(end, '%Y-%m-%d %I:%M:%S %p') - datetime.strptime(start, '%Y-%m-%d %I:%M:%S %p')).total_seconds()}
-                  for start, end in zip(final_starts_bar, final_ends_bar)]
+        output = serialize_sessions(find_pump_sessions("barrier", since))
         logging.info(f"get_starts_barrier < since: {since} >")
         return jsonify(output), 200
     except Exception as e:
@@ -411,42 +820,89 @@ def get_starts_gelcoat_and_barrier(since=None):
         Exception: If an error occurs while retrieving the sessions.
     """
     try:
-        starts_gelcoat = get_starts_gelcoat(since)[0].json
-        starts_barrier = get_starts_barrier(since)[0].json
-        
-        ### these two lists are sorted by the begin time
-        ### now we need to merge them and the final list should also be sorted by the begin time
-        ### peform this merge in most eficient way (O(n))
-        all_sessions = []
-        i = 0
-        j = 0
-        while i < len(starts_gelcoat) and j < len(starts_barrier):
-            if datetime.strptime(starts_gelcoat[i]['begin'], '%Y-%m-%d %I:%M:%S %p') < datetime.strptime(starts_barrier[j]['begin'], '%Y-%m-%d %I:%M:%S %p'):
-                all_sessions.append(starts_gelcoat[i])
-                i += 1
-            else:
-                all_sessions.append(starts_barrier[j])
-                j += 1
-
-        # Add remaining elements from starts_gelcoat, if any
-        while i < len(starts_gelcoat):
-            all_sessions.append(starts_gelcoat[i])
-            i += 1
-    
-        # Add remaining elements from starts_barrier, if any
-        while j < len(starts_barrier):
-            all_sessions.append(starts_barrier[j])
-            j += 1
-            
-        
+        all_sessions = serialize_sessions(find_all_sessions(since))
         logging.info(f"get_starts_gelcoat_and_barrier < since: {since} >")
         return jsonify(all_sessions), 200
     except Exception as e:
         logging.error(f"get_starts_gelcoat_and_barrier < Exception: {str(e)}, since: {since} >")
         return jsonify({"error get_starts_gelcoat_and_barrier": str(e)}), 500
 
+def job_response(job, name, wait=0):
+    """
+    Answers a request that submitted a job.
+
+    Args:
+        job (dict): The status of the job, as returned by jobs.submit.
+        name (str): The name of the endpoint, used in the error message.
+        wait (float, optional): Seconds to wait for the job to finish. Defaults to 0.
+
+    Returns:
+        The result of the job with 200 if it finished in time, the error with 500 if it failed, otherwise the
+        status of the job with 202 and its URL in the Location header.
+    """
+    if wait:
+        job = jobs.wait(job["_id"], min(wait, JOB_MAX_WAIT))
+    if job["status"] == JOB_DONE:
+        # None for a job run by another worker, its result is only kept in memory
+        return jsonify(job.get("result")), 200
+    if job["status"] == JOB_FAILED:
+        return jsonify({f"error {name}": job["error"]}), 500
+    status = {key: value for key, value in job.items() if key != "result"}
+    return jsonify(status), 202, {"Location": f"/api/jobs/{job['_id']}"}
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Retrieves the status of a job: key, status (queued, running, done, failed or interrupted), progress,
+    submitted/started/finished times, duration in seconds, error, and result if it is done.
+
+    The optional "wait" query parameter waits that many seconds for the job to finish.
+    """
+    try:
+        wait = request.args.get('wait', default=0, type=float)
+        job = jobs.wait(job_id, min(wait, JOB_MAX_WAIT)) if wait else jobs.get(job_id)
+        if job is None:
+            return jsonify({"error get_job": f"Unknown job {job_id}"}), 404
+        return jsonify(job), 200
+    except Exception as e:
+        logging.error(f"get_job < Exception: {str(e)}, job_id: {job_id} >")
+        return jsonify({"error get_job": str(e)}), 500
+
+
+@app.route('/api/jobs', methods=['GET'])
+def get_jobs():
+    """
+    Retrieves the latest jobs of every process, newest first, without their results.
+    """
+    try:
+        limit = request.args.get('limit', default=20, type=int)
+        latest_jobs = list(collection_jobs.find({}, sort=[("submitted", -1)]).limit(limit))
+        return jsonify(latest_jobs), 200
+    except Exception as e:
+        logging.error(f"get_jobs < Exception: {str(e)} >")
+        return jsonify({"error get_jobs": str(e)}), 500
+
+
 @app.route('/api/delete_useless_reads_from_db', methods=['GET'])
 def delete_useless_reads_from_db():
+    """
+    Starts the deletion of the useless sensor reads in the background, see delete_useless_reads.
+
+    The optional "wait" query parameter waits that many seconds for the job to finish.
+
+    Returns:
+        A JSON response with "Done" once the job is finished, otherwise the status of the job (202).
+    """
+    try:
+        job = jobs.submit("delete_useless_reads_from_db", delete_useless_reads)
+        return job_response(job, "delete_useless_reads_from_db", request.args.get('wait', default=0, type=float))
+    except Exception as e:
+        logging.error(f"delete_useless_reads_from_db < Exception: {str(e)} >")
+        return jsonify({"error delete_useless_reads_from_db": str(e)}), 500
+
+
+def delete_useless_reads():
     """
     Deletes useless sensor reads from the database based on certain criteria.
 
@@ -458,85 +914,58 @@ def delete_useless_reads_from_db():
     5. Only reads with almost zero barrier speed and gelcoat speed are deleted.
 
     Returns:
-        A JSON response indicating the status of the operation.
+        str: "Done".
     """
-    global IS_DELETE_USELESS_READS_RUNNING
+    since = None
     try:
-        if not IS_DELETE_USELESS_READS_RUNNING:
-            IS_DELETE_USELESS_READS_RUNNING = 1
-            # check whether it is the first time we run this function, checking the length of the collection_delete_useless_reads
-            if collection_delete_useless_reads.count_documents({}) == 0:
-                # Check from the beginning of the database
-                since = None
-                all_sessions = get_starts_gelcoat_and_barrier()[0].json
-                
-                # delete all sensor reads that are sooner than the first session (we use _id in order to find earlier reads)
-                collection.delete_many({
-                    "_id": {"$lt": collection.find_one({"time": all_sessions[0]["begin"]})["_id"]}
-                })
-                
-            else:
-                since = collection_delete_useless_reads.find_one({})["since"]
-                all_sessions = get_starts_gelcoat_and_barrier(since)[0].json
-
-            # We delete all reads that are between the end of a session and the start of the next session
-            # we do this for all sessions except the last 4 sessions, in order to avoid deleting the data between the last session and the current time which is important for the agent
-            for i in range(len(all_sessions) - 4):
-                # check whether these session have time overlap
-                if datetime.strptime(all_sessions[i]["end"], '%Y-%m-%d %I:%M:%S %p') >= datetime.strptime(all_sessions[i+1]["begin"], '%Y-%m-%d %I:%M:%S %p'):
-                    # if they have overlap, we skip deleting data between them
-                    continue
-
-                # if the current time period is within the previous time periods, we delete the data differently
-                if datetime.strptime(all_sessions[i]["end"], '%Y-%m-%d %I:%M:%S %p') <= datetime.strptime(all_sessions[i-1]["end"], '%Y-%m-%d %I:%M:%S %p'):
-                    latest_previous_end = datetime.strptime(
-                        all_sessions[i-1]["end"], '%Y-%m-%d %I:%M:%S %p')
-                    j = 2
-                    while latest_previous_end <= datetime.strptime(all_sessions[i-j]["end"], '%Y-%m-%d %I:%M:%S %p'):
-                        latest_previous_end = datetime.strptime(
-                            all_sessions[i-j]["end"], '%Y-%m-%d %I:%M:%S %p')
-                        j += 1
-                        
-                    if latest_previous_end < datetime.strptime(all_sessions[i+1]["begin"], '%Y-%m-%d %I:%M:%S %p'):
-                        collection.delete_many({
-                            "_id": {
-                                "$gt": collection.find_one({"time": all_sessions[i-j+1]["end"]}, sort=[('_id', -1)])["_id"],
-                                "$lt": collection.find_one({"time": all_sessions[i+1]["begin"]})["_id"]
-                            },
-                            # and they must also have almost zero barrier speed and gelcoat speed
-                            "Barrier_speedRPM": {"$lt": 0.0001},
-                            "Gelcoat_speedRPM": {"$lt": 0.0001}
-                        })
-                    continue
-
-                collection.delete_many({
-                    "_id": {
-                        "$gt": collection.find_one({"time": all_sessions[i]["end"]}, sort=[('_id', -1)])["_id"],
-                        "$lt": collection.find_one({"time": all_sessions[i+1]["begin"]})["_id"]
-                    },
-                    # and they must also have almost zero barrier speed and gelcoat speed
-                    "Barrier_speedRPM": {"$lt": 0.0001},
-                    "Gelcoat_speedRPM": {"$lt": 0.0001}
-                })
-                
-            # update the since field in the collection_delete_useless_reads
-            since_new = collection.find_one({"time": all_sessions[-4]["end"]})["_id"]
-            collection_delete_useless_reads.delete_many({})
-            collection_delete_useless_reads.insert_one({
-                "since": since_new,
-                "time": datetime.now().strftime('%Y-%m-%d %I:%M:%S %p')
-            })
+        # check whether it is the first time we run this function, checking the length of the collection_delete_useless_reads
+        if collection_delete_useless_reads.count_documents({}) == 0:
+            # Check from the beginning of the database
+            all_sessions = find_all_sessions()
+            
+            # delete all sensor reads that are sooner than the first session (we use _id in order to find earlier reads)
+            delete_readings_before(all_sessions[0]["begin_id"])
             
-            IS_DELETE_USELESS_READS_RUNNING = 0
-            logging.info(f"delete_useless_reads_from_db < since: {since}, since_new: {since_new} >")
-            return jsonify("Done"), 200
         else:
-            logging.info("delete_useless_reads_from_db < The delete useless reads is being calculated >")
-            return jsonify("The delete useless reads is being calculated, please wait")
+            since = collection_delete_useless_reads.find_one({})["since"]
+            all_sessions = find_all_sessions(since)
+
+        # We delete all reads that are between the end of a session and the start of the next session
+        # we do this for all sessions except the last 4 sessions, in order to avoid deleting the data between the last session and the current time which is important for the agent
+        for i in range(len(all_sessions) - 4):
+            jobs.progress(i / (len(all_sessions) - 4), "deleting the reads between sessions")
+            # check whether these session have time overlap
+            if all_sessions[i]["end"] >= all_sessions[i+1]["begin"]:
+                # if they have overlap, we skip deleting data between them
+                continue
+
+            # if the current time period is within the previous time periods, we delete the data differently
+            if all_sessions[i]["end"] <= all_sessions[i-1]["end"]:
+                latest_previous_end = all_sessions[i-1]["end"]
+                j = 2
+                while latest_previous_end <= all_sessions[i-j]["end"]:
+                    latest_previous_end = all_sessions[i-j]["end"]
+                    j += 1
+                    
+                if latest_previous_end < all_sessions[i+1]["begin"]:
+                    delete_idle_readings(all_sessions[i-j+1]["end_id"], all_sessions[i+1]["begin_id"])
+                continue
+
+            delete_idle_readings(all_sessions[i]["end_id"], all_sessions[i+1]["begin_id"])
+            
+        # update the since field in the collection_delete_useless_reads
+        since_new = all_sessions[-4]["end_id"]
+        collection_delete_useless_reads.delete_many({})
+        collection_delete_useless_reads.insert_one({
+            "since": since_new,
+            "time": datetime.now()
+        })
+        
+        logging.info(f"delete_useless_reads_from_db < since: {since}, since_new: {since_new} >")
+        return "Done"
     except Exception as e:
-        IS_DELETE_USELESS_READS_RUNNING = 0
         logging.error(f"delete_useless_reads_from_db < Exception: {str(e)}, since: {since} >")
-        return jsonify({"error delete_useless_reads_from_db": str(e)}), 500
+        raise
 
 @app.route('/api/delete_all_session_from_collection', methods=['GET'])
 def delete_all_session_from_collection():
@@ -548,14 +977,131 @@ def delete_all_session_from_collection():
     """
     try:
         collection_sessions.delete_many({})
+        session_segmenter.reset()
+        bump_versions(collection_versions, SESSIONS_VERSION)
+        mark_products_outdated()
         logging.warning("delete_all_session_from_collection < Done >")
         return jsonify("Done"), 200
     except Exception as e:
         logging.error(f"delete_all_session_from_collection < Exception: {str(e)} >")
         return jsonify({"error delete_all_session_from_collection": str(e)}), 500
 
+def position_after(position):
+    """
+    Returns the smallest position greater than the given one (see find_reading_id), as an exclusive upper bound.
+    """
+    if isinstance(position, ObjectId):
+        return ObjectId((int.from_bytes(position.binary, "big") + 1).to_bytes(12, "big"))
+    return position + timedelta(milliseconds=1)
+
+
+def aggregate_pump_session_metrics(pump_type, sessions):
+    """
+    Computes the sum of the pulses and the mean pressure of sessions of one pump inside MongoDB.
+
+    The sessions of a pump never overlap, so after matching their readings a single $bucket on _id, with the
+    begin of every session as a boundary, groups the readings by session.
+
+    Args:
+        pump_type (str): The type of pump, either "gelcoat" or "barrier".
+        sessions (list): Sessions of that pump sorted by their begin time, in the format returned by find_all_sessions.
+
+    Returns:
+        dict: {begin_id: (sum of the pulses, mean pressure)}, sessions without readings are left out.
+    """
+    column_name_pulse = COLUMNS_TO_CHECK_PULSES[pump_type]
+    if STORAGE_LAYOUT == LAYOUT_BUCKETS:
+        return aggregate_bucketed_session_metrics(column_name_pulse, sessions)
+
+    pipeline = [
+        {"$match": {"$or": [{"_id": {"$gte": session["begin_id"], "$lte": session["end_id"]}} for session in sessions]}},
+        {"$bucket": {
+            "groupBy": "$_id",
+            "boundaries": [session["begin_id"] for session in sessions] + [position_after(sessions[-1]["end_id"])],
+            "output": {
+                "sum_pulses": {"$sum": f"${column_name_pulse}"},
+                "avg_pressure": {"$avg": "$Pressure"},
+            }
+        }},
+    ]
+    return {result["_id"]: (result["sum_pulses"], result["avg_pressure"]) for result in collection.aggregate(pipeline)}
+
+
+def aggregate_bucketed_session_metrics(column_name_pulse, sessions):
+    """
+    Same as aggregate_pump_session_metrics for the bucketed layout, where the positions are timestamps.
+
+    The buckets of the sessions are unpacked inside MongoDB: the times and values of every bucket are zipped
+    into one array per reading, and the readings are grouped by session with $bucket as in the documents layout.
+    """
+    key_pulses = FIELD_KEYS[column_name_pulse]
+    key_pressure = FIELD_KEYS["Pressure"]
+    pipeline = [
+        {"$match": {"$or": [{"s": {"$gte": bucket_start(session["begin_id"], BUCKET_SECONDS), "$lte": session["end_id"]},
+                             "e": {"$gte": session["begin_id"]}} for session in sessions]}},
+        {"$project": {"_id": 0, "s": 1,
+                      "r": {"$zip": {"inputs": ["$t", f"$v.{key_pulses}", f"$v.{key_pressure}"]}}}},
+        {"$unwind": "$r"},
+        {"$project": {"timestamp": {"$add": ["$s", {"$arrayElemAt": ["$r", 0]}]},
+                      "pulses": {"$arrayElemAt": ["$r", 1]},
+                      "pressure": {"$arrayElemAt": ["$r", 2]}}},
+        {"$match": {"$or": [{"timestamp": {"$gte": session["begin_id"], "$lte": session["end_id"]}} for session in sessions]}},
+        {"$bucket": {
+            "groupBy": "$timestamp",
+            "boundaries": [session["begin_id"] for session in sessions] + [position_after(sessions[-1]["end_id"])],
+            "output": {
+                "sum_pulses": {"$sum": "$pulses"},
+                "avg_pressure": {"$avg": "$pressure"},
+            }
+        }},
+    ]
+    return {result["_id"]: (result["sum_pulses"], result["avg_pressure"]) for result in bucket_collection.aggregate(pipeline)}
+
+
+def build_session_documents(sessions, first_id):
+    """
+    Builds the documents stored in the sessions collection, with the metrics computed inside MongoDB.
+
+    Args:
+        sessions (list): The sessions, in the format returned by find_all_sessions.
+        first_id (int): The "id" of the first session, the next ones are numbered from it.
+
+    Returns:
+        list: The session documents, in the same order as the sessions.
+    """
+    metrics = {}
+    for pump_type in PUMP_TYPES:
+        pump_sessions = [session for session in sessions if session["pump_type"] == pump_type]
+        for i in range(0, len(pump_sessions), SESSION_METRICS_BATCH_SIZE):
+            batch = pump_sessions[i:i + SESSION_METRICS_BATCH_SIZE]
+            metrics.update({(pump_type, begin_id): values
+                            for begin_id, values in aggregate_pump_session_metrics(pump_type, batch).items()})
+
+    documents = []
+    for i, session in enumerate(sessions):
+        sum_pulses, avg_pressure = metrics.get((session["pump_type"], session["begin_id"]), (0, None))
+        # calculate the total pulses
+        weight_per_pulse = COLUMNS_WEIGHT_PER_PULSE[session["pump_type"]]
+        documents.append({
+            "id": first_id + i,
+            "start_time": format_time(session["begin"]),
+            "end_time": format_time(session["end"]),
+            "start_datetime": session["begin"],
+            "end_datetime": session["end"],
+            "start_id": session["begin_id"],
+            "end_id": session["end_id"],
+            "pump_type": session["pump_type"],
+            "length": session["length"],
+            "total_sprayed_amount": sum_pulses * weight_per_pulse,
+            "avg_speed": sum_pulses / (session["end"] - session["begin"]).total_seconds(),
+            "avg_pressure": avg_pressure,
+            "comments": "",
+            "is_trash": 0,
+        })
+    return documents
+
+
 def reset_all_valid_sessions_from_sensor_data():
-    global IS_GET_NEW_SESSIONS_RUNNING
     """
     Resets all valid sessions from sensor data.
 
@@ -563,192 +1109,200 @@ def reset_all_valid_sessions_from_sensor_data():
     and stores the session information in a separate collection. It also deletes unnecessary data from the sensor data collection.
 
     Returns:
-        A JSON response containing the list of sessions and a status code.
+        list: The sessions, in the format returned by serialize_sessions.
 
     Raises:
         Exception: If an error occurs during the process.
     """
     try:
-        # a list of dictionaries, each dictionary represents a session like this: {"begin": "2024-04-07 11:00:00 AM", "end": "2024-04-07 11:00:15 AM", "pump_type": "gelcoat", "length": 15}, indicationg sessions of gelcoat and barrier
-        all_sessions = get_starts_gelcoat_and_barrier()[0].json
+        # a list of dictionaries, each dictionary represents a session like this: {"begin": datetime(2024, 4, 7, 11, 0, 0), "end": datetime(2024, 4, 7, 11, 0, 15), "begin_id": ObjectId(...), "end_id": ObjectId(...), "pump_type": "gelcoat", "length": 15}, indicationg sessions of gelcoat and barrier
+        session_segmenter.reset()
+        all_sessions = find_ended_sessions()
 
         try:
-            collection.delete_many({
-                "_id": {"$lt": collection.find_one({"time": all_sessions[0]["begin"]})["_id"]}
-            })
+            delete_readings_before(all_sessions[0]["begin_id"])
         except:
             pass
         
-        for i in range(len(all_sessions)):
-            session = all_sessions[i]
-            start_time_id = collection.find_one({
-                "time": session["begin"]
-            })["_id"]
-            
-            end_time_id = collection.find_one({
-                "time": session["end"]
-            }, sort=[('_id', -1)])["_id"]            
-            
-            # get the data between the start and end time
-            session_data = pd.DataFrame(collection.find({
-                "_id": {"$gte": start_time_id, "$lt": end_time_id}
-            }))
-            
-            # calculate the total pulses
-            column_name_pulse = COLUMNS_TO_CHECK_PULSES[session["pump_type"]]
-            weight_per_pulse = COLUMNS_WEIGHT_PER_PULSE[session["pump_type"]]
-            sum_pulses = session_data[column_name_pulse].sum()
-            total_weight = sum_pulses * weight_per_pulse
-            avg_pressure = session_data["Pressure"].mean()
-            avg_speed = session_data[column_name_pulse].sum() / (datetime.strptime(session["end"], '%Y-%m-%d %I:%M:%S %p') - datetime.strptime(session["begin"], '%Y-%m-%d %I:%M:%S %p')).total_seconds()
-            document = {
-                "id": i+1,
-                "start_time": session["begin"],
-                "end_time": session["end"],
-                "pump_type": session["pump_type"],
-                "length": session["length"],
-                "total_sprayed_amount": total_weight,
-                "avg_speed": avg_speed,
-                "avg_pressure":avg_pressure,
-                "comments": "",
-                "is_trash": 0,
-            }
-            collection_sessions.insert_one(document)
-            
-            if i < len(all_sessions) - 4:
-                if datetime.strptime(all_sessions[i]["end"], '%Y-%m-%d %I:%M:%S %p') >= datetime.strptime(all_sessions[i+1]["begin"], '%Y-%m-%d %I:%M:%S %p'):
-                    # if they have overlap, we skip deleting data between them
-                    continue
+        if all_sessions:
+            collection_sessions.insert_many(build_session_documents(all_sessions, 1))
+            bump_versions(collection_versions, SESSIONS_VERSION)
+
+        for i in range(len(all_sessions) - 4):
+            if all_sessions[i]["end"] >= all_sessions[i+1]["begin"]:
+                # if they have overlap, we skip deleting data between them
+                continue
+
+            # if the current time period is within the previous time periods, we delete the data differently
+            if all_sessions[i]["end"] <= all_sessions[i-1]["end"]:
+                latest_previous_end = all_sessions[i-1]["end"]
+                j = 2
+                while latest_previous_end <= all_sessions[i-j]["end"]:
+                    latest_previous_end = all_sessions[i-j]["end"]
+                    j += 1
+                    
 
-                # if the current time period is within the previous time periods, we delete the data differently
-                if datetime.strptime(all_sessions[i]["end"], '%Y-%m-%d %I:%M:%S %p') <= datetime.strptime(all_sessions[i-1]["end"], '%Y-%m-%d %I:%M:%S %p'):
-                    latest_previous_end = datetime.strptime(
-                        all_sessions[i-1]["end"], '%Y-%m-%d %I:%M:%S %p')
-                    j = 2
-                    while latest_previous_end <= datetime.strptime(all_sessions[i-j]["end"], '%Y-%m-%d %I:%M:%S %p'):
-                        latest_previous_end = datetime.strptime(
-                            all_sessions[i-j]["end"], '%Y-%m-%d %I:%M:%S %p')
-                        j += 1
-                        
-
-                    if latest_previous_end < datetime.strptime(all_sessions[i+1]["begin"], '%Y-%m-%d %I:%M:%S %p'):
-                        collection.delete_many({
-                            "_id": {
-                                "$gt": collection.find_one({"time": all_sessions[i-j+1]["end"]}, sort=[('_id', -1)])["_id"],
-                                "$lt": collection.find_one({"time": all_sessions[i+1]["begin"]})["_id"]
-                            },
-                            # and they must also have almost zero barrier speed and gelcoat speed
-                            "Barrier_speedRPM": {"$lt": 0.0001},
-                            "Gelcoat_speedRPM": {"$lt": 0.0001}
-                        })
-                    continue
+                if latest_previous_end < all_sessions[i+1]["begin"]:
+                    delete_idle_readings(all_sessions[i-j+1]["end_id"], all_sessions[i+1]["begin_id"])
+                continue
 
-                collection.delete_many({
-                    "_id": {
-                        "$gt": collection.find_one({"time": all_sessions[i]["end"]}, sort=[('_id', -1)])["_id"],
-                        "$lt": collection.find_one({"time": all_sessions[i+1]["begin"]})["_id"]
-                    },
-                    # and they must also have almost zero barrier speed and gelcoat speed
-                    "Barrier_speedRPM": {"$lt": 0.0001},
-                    "Gelcoat_speedRPM": {"$lt": 0.0001}
-                })
-                
+            delete_idle_readings(all_sessions[i]["end_id"], all_sessions[i+1]["begin_id"])
+
+        session_segmenter.commit()
+        jobs.submit("update_product_db", update_product_db)
         logging.info("reset_all_valid_sessions_from_sensor_data < Done >")
-        IS_GET_NEW_SESSIONS_RUNNING = 0  
-        return jsonify(all_sessions), 200
+        return serialize_sessions(all_sessions)
     except Exception as e:
         logging.error(f"reset_all_valid_sessions_from_sensor_data < Exception: {str(e)} >")
-        return jsonify({"error reset_all_valid_sessions_from_sensor_data": str(e)}), 500
+        raise
 
 
 @app.route('/api/get_new_sessions', methods=['GET'])
 def get_new_sessions():
+    """
+    Starts the detection of the new sessions in the background, see update_sessions.
+
+    The optional "wait" query parameter waits that many seconds for the job to finish, e.g. for the agent
+    that reads the sessions right after.
+
+    Returns:
+        A JSON response containing the new sessions once the job is finished, otherwise the status of the job (202).
+    """
+    try:
+        job = jobs.submit("get_new_sessions", update_sessions)
+        return job_response(job, "get_new_sessions", request.args.get('wait', default=0, type=float))
+    except Exception as e:
+        logging.error(f"get_new_sessions < Exception: {str(e)} >")
+        return jsonify({"error get_new_sessions": str(e)}), 500
+
+
+def update_sessions():
     """
     Retrieves new sessions from the database and calculates session metrics.
 
     Returns:
-        A JSON response containing the new sessions and their metrics.
+        list: The new sessions, in the format returned by serialize_sessions.
 
     Raises:
         Exception: If an error occurs while retrieving or calculating the sessions.
     """
-    global IS_GET_NEW_SESSIONS_RUNNING
     try:
-        if not IS_GET_NEW_SESSIONS_RUNNING:
-            # find the latest session in the database
-            IS_GET_NEW_SESSIONS_RUNNING = 1
-            latest_session = collection_sessions.find_one({}, sort=[('_id', -1)])
-
-            # if the database is empty, we session the reset_all_valid_sessions_from_sensor_data function instead
-            if latest_session is None:
-                return reset_all_valid_sessions_from_sensor_data()
-            # we find the sensor data associated with the end_time of the latest session
-            latest_sensor_read = collection.find_one({
-                "time": latest_session["end_time"]
-                }, sort=[('_id', -1)])
-            
-            since = latest_sensor_read["_id"]
-            
-            new_sessions = get_starts_gelcoat_and_barrier(since)[0].json
-            
-            if not new_sessions:
-                IS_GET_NEW_SESSIONS_RUNNING = 0  
-                return jsonify([]), 200
-            
-            collection_size = collection_sessions.count_documents({})
-            # add sessions to the database
-            for i in range(len(new_sessions)):
-                session = new_sessions[i]
-                start_time_id = collection.find_one({
-                    "time": session["begin"]
-                })["_id"]
-                
-                end_time_id = collection.find_one({
-                    "time": session["end"]
-                }, sort=[('_id', -1)])["_id"]
-                
-                # get the data between the start and end time
-                session_data = pd.DataFrame(collection.find({
-                    "_id": {"$gte": start_time_id, "$lte": end_time_id}
-                }))
-                
-                # calculate the total pulses
-                column_name_pulse = COLUMNS_TO_CHECK_PULSES[session["pump_type"]]
-                weight_per_pulse = COLUMNS_WEIGHT_PER_PULSE[session["pump_type"]]
-                sum_pulses = session_data[column_name_pulse].sum()
-                total_weight = sum_pulses * weight_per_pulse
-                avg_pressure = session_data["Pressure"].mean()
-                avg_speed = session_data[column_name_pulse].sum() / (datetime.strptime(session["end"], '%Y-%m-%d %I:%M:%S %p') - datetime.strptime(session["begin"], '%Y-%m-%d %I:%M:%S %p')).total_seconds()
-                document = {
-                    "id": i+1+collection_size,
-                    "start_time": session["begin"],
-                    "end_time": session["end"],
-                    "pump_type": session["pump_type"],
-                    "length": session["length"],
-                    "total_sprayed_amount": total_weight,
-                    "avg_speed": avg_speed,
-                    "avg_pressure":avg_pressure,
-                    "comments": "",
-                    "is_trash": 0,
-                }
-                # print("DOCUMENT TO BE ADDED:", file=sys.stderr)
-                logging.debug(f"get_new_sessions (Document to be added) < document: {document} >")
-                collection_sessions.insert_one(document)
-            IS_GET_NEW_SESSIONS_RUNNING = 0    
-            logging.info(f"get_new_sessions < since: {since} >")
-            return jsonify(new_sessions), 200
-        else:
-            logging.info("get_new_sessions < The new sessions are being calculated >")
-            return jsonify("The new sessions are being calculated, please wait")
+        # find the latest session in the database
+        latest_session = collection_sessions.find_one({}, sort=[('_id', -1)])
+
+        # if the database is empty, we session the reset_all_valid_sessions_from_sensor_data function instead
+        if latest_session is None:
+            return reset_all_valid_sessions_from_sensor_data()
+        # we find the sensor data associated with the end_time of the latest session
+        # only used by a pump without checkpoint yet, e.g. on a database filled by an older version
+        since = latest_session.get("end_id") or find_reading_id(latest_session["end_datetime"], last=True)
+        
+        new_sessions = find_ended_sessions(since)
+        
+        if not new_sessions:
+            session_segmenter.commit()
+            return []
+        
+        collection_size = collection_sessions.count_documents({})
+        # add sessions to the database
+        documents = build_session_documents(new_sessions, collection_size + 1)
+        logging.debug(f"get_new_sessions (Documents to be added) < documents: {documents} >")
+        collection_sessions.insert_many(documents)
+        session_segmenter.commit()
+        bump_versions(collection_versions, SESSIONS_VERSION)
+        jobs.submit("update_product_db", update_product_db)
+        logging.info(f"get_new_sessions < since: {since} >")
+        return serialize_sessions(new_sessions)
     except Exception as e:
-        IS_GET_NEW_SESSIONS_RUNNING = 0
         logging.error(f"get_new_sessions < Exception: {str(e)} >")
-        return jsonify({"error get_new_sessions": str(e)}), 500
+        raise
+
+def integer_arg(name):
+    """
+    Reads an integer query parameter of the request.
+
+    Returns:
+        int: The value, None if the parameter is not given.
+
+    Raises:
+        ValueError: If the parameter is given but is not an integer.
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name}, it should be an integer. {value} is given.")
+
+
+def list_page(collection, query, projection, fields, filters=()):
+    """
+    Returns a list of sessions or products, newest first, shaped by the query parameters of the request.
+
+    Without "limit" the whole list is returned. The query parameters, all optional:
+        limit: The number of records of the page, at most PAGE_LIMIT_MAX. The response has a NEXT_CURSOR_HEADER
+            header while there are more records.
+        before: Only the records with an id lower than it, the NEXT_CURSOR_HEADER of the previous page.
+        start, end: Only the records that started within this range, e.g. '2024-04-07 11:00:00 AM'.
+        fields: The fields returned, separated by commas, e.g. "start_time,comments". The id is always returned.
+        The names in filters, e.g. pump_type: only the records with this value.
+
+    The pages are read with the indexes on (..., id), only the records of the page are read and serialized.
+
+    Args:
+        collection (pymongo.collection.Collection): The sessions or products collection.
+        query (dict): The filter of the list, e.g. {"is_trash": 0}.
+        projection (dict): The projection used when no fields are asked for.
+        fields (tuple): The fields that can be asked for.
+        filters (tuple, optional): The fields that can be filtered on by value. Defaults to ().
+
+    Returns:
+        flask.Response: The JSON array of the records.
+
+    Raises:
+        ValueError: If a field asked for is not in fields, a date is not in TIME_FORMAT or limit or before is not
+            an integer. The endpoints answer it with a 400.
+    """
+    query = dict(query)
+    for name in filters:
+        if request.args.get(name):
+            query[name] = request.args[name]
+    before = integer_arg('before')
+    if before is not None:
+        query["id"] = {"$lt": before}
+    if request.args.get('start') or request.args.get('end'):
+        query["start_datetime"] = {}
+        if request.args.get('start'):
+            query["start_datetime"]["$gte"] = parse_time(request.args['start'])
+        if request.args.get('end'):
+            query["start_datetime"]["$lte"] = parse_time(request.args['end'])
+    if request.args.get('fields'):
+        asked = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        unknown = sorted(set(asked) - set(fields))
+        if unknown:
+            raise ValueError(f"Invalid fields, they should be among {', '.join(fields)}. {', '.join(unknown)} is given.")
+        projection = {'_id': 0, 'id': 1, **{field: 1 for field in asked}}
+
+    cursor = collection.find(query, projection).sort('id', -1)
+    limit = integer_arg('limit')
+    if limit is None:
+        return jsonify(list(cursor))
+    limit = max(1, min(limit, PAGE_LIMIT_MAX))
+    # one more record tells whether there is a next page
+    records = list(cursor.limit(limit + 1))
+    response = jsonify(records[:limit])
+    if len(records) > limit:
+        response.headers[NEXT_CURSOR_HEADER] = str(records[limit - 1]["id"])
+    return response
+
 
 @app.route('/api/get_all_sessions_from_collection', methods=['GET'])
+@response_cache.cached(SESSIONS_VERSION, finish=with_freshness)
 def get_all_sessions_from_collection():
     """
-    Retrieves all sessions from the collection.
+    Retrieves the sessions from the collection, all of them or a page, see list_page. They can also be filtered
+    by pump_type.
 
     Returns:
         A tuple containing the JSON response and the HTTP status code.
@@ -757,18 +1311,22 @@ def get_all_sessions_from_collection():
         Exception: If an error occurs during the operation.
     """
     try:
-        get_new_sessions()
-        all_sessions = list(collection_sessions.find({"is_trash": 0}, {'_id': 0,}).sort('id', -1))
+        # the new sessions are detected in the background, see refresh_sessions
+        response = list_page(collection_sessions, {"is_trash": 0}, SESSION_PROJECTION, SESSION_FIELDS, ('pump_type',))
         logging.info("get_all_sessions_from_collection < Done >")
-        return jsonify(all_sessions), 200
+        return response, 200
+    except ValueError as e:
+        logging.error(f"get_all_sessions_from_collection < ValueError: {str(e)} >")
+        return jsonify({"error get_all_sessions_from_collection": str(e)}), 400
     except Exception as e:
         logging.error(f"get_all_sessions_from_collection < Exception: {str(e)} >")
         return jsonify({"error get_all_sessions_from_collection": str(e)}), 500
 
 @app.route('/api/get_deleted_sessions_from_collection', methods=['GET'])
+@response_cache.cached(SESSIONS_VERSION, finish=with_freshness)
 def get_deleted_sessions_from_collection():
     """
-    Retrieves all deleted sessions from the collection.
+    Retrieves the deleted sessions from the collection, all of them or a page, see get_all_sessions_from_collection.
 
     Returns:
         A tuple containing the JSON response and the HTTP status code.
@@ -778,9 +1336,12 @@ def get_deleted_sessions_from_collection():
     """
     try:
         # find all sessions that their is_trash field is 1
-        all_sessions = list(collection_sessions.find({"is_trash": 1}, {'_id': 0,}).sort('id', -1))
+        response = list_page(collection_sessions, {"is_trash": 1}, SESSION_PROJECTION, SESSION_FIELDS, ('pump_type',))
         logging.info("get_deleted_sessions_from_collection < Done >")
-        return jsonify(all_sessions), 200
+        return response, 200
+    except ValueError as e:
+        logging.error(f"get_deleted_sessions_from_collection < ValueError: {str(e)} >")
+        return jsonify({"error get_deleted_sessions_from_collection": str(e)}), 400
     except Exception as e:
         logging.error(f"get_deleted_sessions_from_collection < Exception: {str(e)} >")
         return jsonify({"error get_deleted_sessions_from_collection": str(e)}), 500
@@ -802,6 +1363,8 @@ def set_trash_by_id():
         collection_sessions.update_one({"id": int(data['id'])}, {
             "$set": {"is_trash": 1}
         })
+        bump_versions(collection_versions, SESSIONS_VERSION)
+        mark_products_outdated()
         logging.info(f"set_trash_by_id < id: {data['id']} >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -831,6 +1394,8 @@ def restore_trash_session_by_id():
         collection_sessions.update_one({"id": int(data['id'])}, {
             "$set": {"is_trash": 0}
         })
+        bump_versions(collection_versions, SESSIONS_VERSION)
+        mark_products_outdated()
         logging.info(f"restore_trash_session_by_id < id: {data['id']} >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -861,6 +1426,7 @@ def set_comments_by_id_session():
         collection_sessions.update_one({"id": int(data['id'])}, {
             "$set": {"comments": data['comments']}
         })
+        bump_versions(collection_versions, SESSIONS_VERSION)
         logging.info(f"set_comments_by_id_session < id: {data['id']} >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -871,48 +1437,130 @@ def set_comments_by_id_session():
         return jsonify({"error set_comments_by_id_session": str(e)}), 500
 
 
-def get_all_products_from_sessions():
+def find_products(sessions):
     """
-    Retrieves all products from sessions.
+    Matches the products in a list of sessions.
+
+    A product is a sequence of [gelcoat, gelcoat, barrier] sessions. The sessions are scanned from the first one
+    and a session belongs to one product at most.
+
+    Args:
+        sessions (list): The session documents, sorted by id.
 
     Returns:
-        list: A list of products, where each product is a sequence of [gelcoat, gelcoat, barrier] sessions.
-            Each product is represented as a string in the format 'start_time: <start_time>, end_time: <end_time>'.
-            If an error occurs during the retrieval process, None is returned.
-            
-    Raises:
-        Exception: If an error occurs during the process.
+        tuple: (the products, without id, comments and hide, see product_key for their key,
+            the number of sessions the scan is over with, the next products can only start after them).
     """
-    # a product is a sequence of [gelcoat, gelcoat, barrier] sessions
-    try:
-        all_sessions = list(collection_sessions.find({"is_trash": 0}).sort('_id', 1))
-        products = []
-        i = 0
-        while i < len(all_sessions) - 2:
-            if all_sessions[i]["pump_type"] == "gelcoat" and all_sessions[i+1]["pump_type"] == "gelcoat" and all_sessions[i+2]["pump_type"] == "barrier":
-                gelcoat_material = all_sessions[i]["total_sprayed_amount"] + all_sessions[i+1]["total_sprayed_amount"]
-                barrier_material = all_sessions[i+2]["total_sprayed_amount"]
-                products.append(
-                    f'start_time: {all_sessions[i]["start_time"]}, end_time: {all_sessions[i+2]["end_time"]}, gelcoat_material: {gelcoat_material}, barrier_material: {barrier_material}'
-                )
-                i += 3
-            else:
-                i += 1
-        logging.info("get_all_products_from_sessions < Done >")
-        return products
-    except Exception as e:
-        logging.error(f"get_all_products_from_sessions < Exception: {str(e)} >")
-        return None
+    products = []
+    i = 0
+    while i < len(sessions) - 2:
+        first, second, barrier = sessions[i:i + 3]
+        if first["pump_type"] == "gelcoat" and second["pump_type"] == "gelcoat" and barrier["pump_type"] == "barrier":
+            session_ids = [first["id"], second["id"], barrier["id"]]
+            products.append({
+                "key": product_key(session_ids, first["start_datetime"]),
+                "session_ids": session_ids,
+                "start_time": first["start_time"],
+                "end_time": barrier["end_time"],
+                "start_datetime": first["start_datetime"],
+                "end_datetime": barrier["end_datetime"],
+                "gelcoat_material": float(first["total_sprayed_amount"] + second["total_sprayed_amount"]),
+                "barrier_material": float(barrier["total_sprayed_amount"]),
+            })
+            i += 3
+        else:
+            i += 1
+    return products, i
+
+
+def product_key(session_ids, start_datetime):
+    """
+    Returns the unique key of a product, e.g. "12-13-15@1712487600000".
+
+    The ids of the sessions identify the product, the start of its first session tells it apart from a product
+    matched before the sessions were detected again (their ids start over from 1).
+    """
+    return f'{"-".join(map(str, session_ids))}@{(start_datetime - datetime(1970, 1, 1)) // timedelta(milliseconds=1)}'
+
+
+def legacy_product_identifier(product):
+    """
+    Returns the product_unique_identifier of a product as stored by older versions, before the keys.
+    """
+    return (f'start_time: {product["start_time"]}, end_time: {product["end_time"]}, '
+            f'gelcoat_material: {product["gelcoat_material"]}, barrier_material: {product["barrier_material"]}')
+
+
+def find_product_sessions(after_id=0):
+    """
+    Returns the sessions that are not in the trash with an id greater than after_id, sorted by id.
+    """
+    return list(collection_sessions.find({"is_trash": 0, "id": {"$gt": after_id}}, PRODUCT_SESSION_PROJECTION).sort('id', 1))
+
+
+def mark_products_outdated():
+    """
+    Makes the next update_product_db match the products again from the first session.
+
+    Called when sessions are trashed, restored or deleted, which can change the products already matched.
+    The update is started in the background.
+    """
+    collection_session_checkpoints.update_one({"_id": PRODUCTS_CHECKPOINT}, {"$inc": {"changes": 1}}, upsert=True)
+    jobs.submit("update_product_db", update_product_db)
+
+
+def rebuild_products():
+    """
+    Matches the products of all sessions and applies the difference with the stored ones, by their key.
+
+    A product that is matched again keeps its id, comments and hide status, a new one gets the next id and a
+    product that is not matched anymore is deleted. The products stored by an older version, without key,
+    hand their comments and hide status over by their product_unique_identifier.
+
+    Returns:
+        int: The id of the last session scanned, the next update starts after it.
+    """
+    sessions = find_product_sessions()
+    products, scanned = find_products(sessions)
+
+    old_products = list(collection_products.find({}))
+    by_key = {product["key"]: product for product in old_products if "key" in product}
+    legacy_products = {product["product_unique_identifier"]: product for product in old_products if "key" not in product}
+    next_id = max((product["id"] for product in by_key.values()), default=0) + 1
+
+    new_keys = {product["key"] for product in products}
+    gone = [product["_id"] for key, product in by_key.items() if key not in new_keys]
+    gone.extend(product["_id"] for product in legacy_products.values())
+    if gone:
+        collection_products.delete_many({"_id": {"$in": gone}})
+
+    operations = []
+    for product in products:
+        old_product = by_key.get(product["key"])
+        if old_product is None:
+            legacy_product = legacy_products.get(legacy_product_identifier(product), {}) if legacy_products else {}
+            operations.append(InsertOne(dict(product, id=next_id, comments=legacy_product.get("comments", ""),
+                                             hide=legacy_product.get("hide", 0))))
+            next_id += 1
+        elif any(old_product.get(field) != value for field, value in product.items()):
+            operations.append(UpdateOne({"_id": old_product["_id"]}, {"$set": product}))
+    if operations:
+        collection_products.bulk_write(operations, ordered=True)
+    if gone or operations:
+        bump_versions(collection_versions, PRODUCTS_VERSION)
+    logging.info(f"rebuild_products < products: {len(products)}, deleted: {len(gone)}, written: {len(operations)} >")
+    return sessions[scanned - 1]["id"] if scanned else 0
 
 
 def update_product_db():
     """
-    Updates the product database with the current products.
+    Updates the product database with the products of the sessions added since the last update.
 
-    This function retrieves all the current products from the sessions and updates the product database accordingly.
-    If the product database is empty, it adds all the current products to the database.
-    If the product database is not empty, it replaces all the existing products with the current products.
-    If a current product already exists in the database, it keeps the comments and hide status of the existing product.
+    Only the sessions after the last one scanned are matched, the new products get the next ids. All the
+    products are matched again (see rebuild_products) on the first update and after sessions were trashed,
+    restored or deleted (see mark_products_outdated). The state is the PRODUCTS_CHECKPOINT document
+    {"_id": PRODUCTS_CHECKPOINT, "last_session_id": ..., "changes": ..., "synced": ...}.
+    It runs as a job, see get_all_products_collection.
 
     Raises:
         Exception: If an error occurs during the update process.
@@ -920,77 +1568,39 @@ def update_product_db():
     Returns:
         None
     """
-    global IS_UPDATE_PRODUCT_DB_RUNNING
     try:
-        if not IS_UPDATE_PRODUCT_DB_RUNNING:
-            IS_UPDATE_PRODUCT_DB_RUNNING = 1
-            all_current_products = get_all_products_from_sessions()
-            # if the database for product is empty, we add the products to the database
-            if collection_products.count_documents({}) == 0:
-                for i, product in enumerate(all_current_products):
-                    end_time_index = product.find(", end_time: ")
-                    gelcoat_material_index = product.find(", gelcoat_material: ")
-                    barrier_material_index = product.find(", barrier_material: ")
-                    
-                    start_time = product[len("start_time: "):end_time_index]
-                    end_time = product[end_time_index + len(", end_time: "):gelcoat_material_index]
-                    gelcoat_material = product[gelcoat_material_index + len(", gelcoat_material: "):barrier_material_index]
-                    barrier_material = product[barrier_material_index + len(", barrier_material: "):]
-
-                    document = {
-                        "id": i+1,
-                        "start_time": start_time,
-                        "end_time": end_time,
-                        "gelcoat_material": float(gelcoat_material),
-                        "barrier_material": float(barrier_material),
-                        "product_unique_identifier": product,
-                        "comments": "",
-                        "hide": 0
-                    }
-                    collection_products.insert_one(document)
-            else:
-                # get all old products from the database
-                old_products = list(collection_products.find({}))
-                old_products_unique_identifiers = {product["product_unique_identifier"] for product in old_products}
-
-                # empty the database
-                collection_products.delete_many({})
-
-                # add all current products to the database, if they were in the old products, we keep their comments and hide status
-                for i, product in enumerate(all_current_products):
-                    end_time_index = product.find(", end_time: ")
-                    gelcoat_material_index = product.find(", gelcoat_material: ")
-                    barrier_material_index = product.find(", barrier_material: ")
-                    
-                    start_time = product[len("start_time: "):end_time_index]
-                    end_time = product[end_time_index + len(", end_time: "):gelcoat_material_index]
-                    gelcoat_material = product[gelcoat_material_index + len(", gelcoat_material: "):barrier_material_index]
-                    barrier_material = product[barrier_material_index + len(", barrier_material: "):]
-                    
-                    document = {
-                        "id": i+1,
-                        "start_time": start_time,
-                        "end_time": end_time,
-                        "gelcoat_material": float(gelcoat_material),
-                        "barrier_material": float(barrier_material),
-                        "product_unique_identifier": product,
-                        "comments": old_products[i]["comments"] if product in old_products_unique_identifiers else "",
-                        "hide": old_products[i]["hide"] if product in old_products_unique_identifiers else 0
-                    }
-                    collection_products.insert_one(document)
-            IS_UPDATE_PRODUCT_DB_RUNNING = 0
-            logging.info("update_product_db < Done >")
+        state = collection_session_checkpoints.find_one({"_id": PRODUCTS_CHECKPOINT}) or {}
+        changes = state.get("changes", 0)
+        if "last_session_id" not in state or state.get("synced") != changes:
+            last_session_id = rebuild_products()
         else:
-            logging.info("update_product_db < The update product db is being calculated >")
+            last_session_id = state["last_session_id"]
+            sessions = find_product_sessions(last_session_id)
+            products, scanned = find_products(sessions)
+            if products:
+                last_product = collection_products.find_one({}, {"id": 1}, sort=[('id', -1)])
+                next_id = last_product["id"] + 1 if last_product else 1
+                collection_products.insert_many([dict(product, id=next_id + i, comments="", hide=0)
+                                                 for i, product in enumerate(products)])
+                bump_versions(collection_versions, PRODUCTS_VERSION)
+            if scanned:
+                last_session_id = sessions[scanned - 1]["id"]
+            logging.info(f"update_product_db < sessions: {len(sessions)}, new products: {len(products)} >")
+        # a change made while this update ran leaves synced behind changes, the next update rebuilds again
+        collection_session_checkpoints.update_one({"_id": PRODUCTS_CHECKPOINT},
+                                                  {"$set": {"last_session_id": last_session_id, "synced": changes}},
+                                                  upsert=True)
+        logging.info("update_product_db < Done >")
     except Exception as e:
-        IS_UPDATE_PRODUCT_DB_RUNNING = 0
         logging.error(f"update_product_db < Exception: {str(e)} >")
+        raise
 
 
 @app.route('/api/get_all_products_collection', methods=['GET'])
+@response_cache.cached(PRODUCTS_VERSION)
 def get_all_products_collection():
     """
-    Retrieves all products from the collection.
+    Retrieves the products from the collection, all of them or a page, see list_page.
 
     Returns:
         A tuple containing the JSON response and the HTTP status code.
@@ -999,15 +1609,14 @@ def get_all_products_collection():
         Exception: If an error occurs during the retrieval process.
     """
     try:
-        update_product_db()
-        all_products = list(collection_products.find({
-            "hide": 0
-        }, {
-            '_id': 0,
-            "product_unique_identifier": 0,
-        }).sort('id', -1))
+        # the products are updated in the background whenever sessions are stored, trashed or restored
+        # (see update_sessions, mark_products_outdated and refresh_sessions), not on every request
+        response = list_page(collection_products, {"hide": 0}, PRODUCT_PROJECTION, PRODUCT_FIELDS)
         logging.info("get_all_products_collection < Done >")
-        return jsonify(all_products), 200
+        return response, 200
+    except ValueError as e:
+        logging.error(f"get_all_products_collection < ValueError: {str(e)} >")
+        return jsonify({"error get_all_products_collection": str(e)}), 400
     except Exception as e:
         logging.error(f"get_all_products_collection < Exception: {str(e)} >")
         return jsonify({"error get_all_products_collection": str(e)}), 500
@@ -1029,6 +1638,7 @@ def set_hide_by_id_product():
         collection_products.update_one({"id": int(data['id'])}, {
             "$set": {"hide": 1}
         })
+        bump_versions(collection_versions, PRODUCTS_VERSION)
         logging.info(f"set_hide_by_id_product < id: {data['id']} >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -1052,6 +1662,7 @@ def set_comments_by_id_product():
         collection_products.update_one({"id": int(data['id'])}, {
             "$set": {"comments": data['comments']}
         })
+        bump_versions(collection_versions, PRODUCTS_VERSION)
         logging.info(f"set_comments_by_id_product < id: {data['id']} >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -1062,22 +1673,21 @@ def set_comments_by_id_product():
         return jsonify({"error set_comments_by_id_product": str(e)}), 500
 
 @app.route('/api/get_all_deleted_products_collection', methods=['GET'])
+@response_cache.cached(PRODUCTS_VERSION)
 def get_all_deleted_products_collection():
     """
-    Retrieves all deleted products from the collection.
+    Retrieves the deleted products from the collection, all of them or a page, see list_page.
 
     Returns:
         A tuple containing the JSON response and the HTTP status code.
     """
     try:
-        all_products = list(collection_products.find({
-            "hide": 1
-        }, {
-            '_id': 0,
-            "product_unique_identifier": 0,
-        }).sort('id', -1))
+        response = list_page(collection_products, {"hide": 1}, PRODUCT_PROJECTION, PRODUCT_FIELDS)
         logging.info("get_all_deleted_products_collection < Done >")
-        return jsonify(all_products), 200
+        return response, 200
+    except ValueError as e:
+        logging.error(f"get_all_deleted_products_collection < ValueError: {str(e)} >")
+        return jsonify({"error get_all_deleted_products_collection": str(e)}), 400
     except Exception as e:
         logging.error(f"get_all_deleted_products_collection < Exception: {str(e)} >")
         return jsonify({"error get_all_deleted_products_collection": str(e)}), 500
@@ -1104,6 +1714,7 @@ def restore_hide_by_id_product():
         collection_products.update_one({"id": int(data['id'])}, {
             "$set": {"hide": 0}
         })
+        bump_versions(collection_versions, PRODUCTS_VERSION)
         logging.info(f"restore_hide_by_id_product < id: {data['id']} >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -1117,6 +1728,7 @@ def restore_hide_by_id_product():
 
 
 @app.route('/api/get_nominal_sessions', methods=['POST'])
+@response_cache.cached(NOMINAL_VERSION)
 def get_nominal_sessions():
     """
     Retrieves the nominal sessions based on the pump type specified in the request data.
@@ -1160,75 +1772,30 @@ def get_nominal_sessions():
 @app.route('/api/add_new_nominal_session', methods=['POST'])
 def add_new_nominal_session():
     """
-    Adds a new nominal session to the database based on the provided parameters.
+    Adds a new nominal session to the database based on the provided parameters, as a job (see add_nominal_sessions).
+
+    The optional "wait" query parameter sets how many seconds to wait for the job, JOB_WAIT_TIMEOUT by default.
 
     Returns:
-        A JSON response containing the details of all the nominal sessions in the database.
+        A JSON response containing the details of all the nominal sessions in the database once the job is finished,
+        otherwise the status of the job (202).
 
     Raises:
         Exception: If an error occurs while adding the new nominal session.
     """
-    global IS_ADD_NEW_NOMINAL_SESSION_RUNNING
     try:
-        if not IS_ADD_NEW_NOMINAL_SESSION_RUNNING:
-            IS_ADD_NEW_NOMINAL_SESSION_RUNNING = 1
-            data = request.get_json()
-            get_new_sessions()
-
-            pump_type = data['pump_type']
-            if pump_type == "gelcoat":
-                collection_nominal_sessions = collection_nominal_gelcoat
-                all_sessions = list(collection_sessions.find(
-                    {"pump_type": "gelcoat", "is_trash": 0}))
-            elif pump_type == "barrier":
-                collection_nominal_sessions = collection_nominal_barrier
-                all_sessions = list(collection_sessions.find(
-                    {"pump_type": "barrier", "is_trash": 0}))
-            else:
-                IS_ADD_NEW_NOMINAL_SESSION_RUNNING = 0
-                return jsonify({"error add_new_nominal_session_new": "Invalid pump type"}), 501
-
-            size_collection_nominal_sessions = collection_nominal_sessions.count_documents({
-            })
-            start_date = data['startDate']
-            end_date = data['endDate']
-
-            # we find the session that are between the start_date and end_date
-
-            id_offset = 1
-            for session in all_sessions:
-                if datetime.strptime(session['start_time'], '%Y-%m-%d %I:%M:%S %p') >= datetime.strptime(start_date, '%Y-%m-%d %I:%M:%S %p') and datetime.strptime(session['end_time'], '%Y-%m-%d %I:%M:%S %p') <= datetime.strptime(end_date, '%Y-%m-%d %I:%M:%S %p'):
-                    # add the new nominal sessions to the database
-                    document = {
-                        "id": size_collection_nominal_sessions + id_offset,
-                        "time_added": datetime.now().strftime('%Y-%m-%d %I:%M:%S %p'),
-                        "start_date": session['start_time'],
-                        "end_date": session['end_time'],
-                        "total_sprayed_amount":session['total_sprayed_amount'],
-                        "avg_speed":session['avg_speed'],
-                        "avg_pressure":session['avg_pressure'],
-                    }
-                    collection_nominal_sessions.insert_one(document)
-                    id_offset += 1
-                # if the session is after the end_date, we break the loop
-                if datetime.strptime(session['start_time'], '%Y-%m-%d %I:%M:%S %p') > datetime.strptime(end_date, '%Y-%m-%d %I:%M:%S %p'):
-                    break
-
-            all_nominal_data = list(collection_nominal_sessions.find({}, {
-                '_id': 0,
-                'id': 1,
-                'time_added': 1,
-                'start_date': 1,
-                'end_date': 1
-            }))
-            IS_ADD_NEW_NOMINAL_SESSION_RUNNING = 0
-            logging.info(f"add_new_nominal_session < pump_type: {data['pump_type']} >")
-            return jsonify(all_nominal_data), 200
-        else:
-            logging.info("add_new_nominal_session < The add new nominal session is being calculated >")
-            return jsonify("The add new nominal session is being calculated, please wait")
+        data = request.get_json()
+        pump_type = data['pump_type']
+        if pump_type not in PUMP_TYPES:
+            return jsonify({"error add_new_nominal_session_new": "Invalid pump type"}), 501
+        start_date = parse_time(data['startDate'])
+        end_date = parse_time(data['endDate'])
+
+        job = jobs.submit(f"add_new_nominal_session {pump_type} {start_date} {end_date}", add_nominal_sessions,
+                          pump_type, start_date, end_date)
+        return job_response(job, "add_new_nominal_session_new",
+                            request.args.get('wait', default=JOB_WAIT_TIMEOUT, type=float))
     except Exception as e:
-        IS_ADD_NEW_NOMINAL_SESSION_RUNNING = 0
         try:
             data = request.get_json()
             logging.error(f"add_new_nominal_session < Exception: {str(e)}, pump_type: {data['pump_type']}, startDate: {data['startDate']}, endDate: {data['endDate']} >")
@@ -1237,6 +1804,62 @@ def add_new_nominal_session():
         return jsonify({"error add_new_nominal_session_new": str(e)}), 500
 
 
+def add_nominal_sessions(pump_type, start_date, end_date):
+    """
+    Adds the sessions of a pump between two dates to its nominal sessions.
+
+    Args:
+        pump_type (str): The type of pump, either "gelcoat" or "barrier".
+        start_date (datetime): The start of the range.
+        end_date (datetime): The end of the range.
+
+    Returns:
+        list: The details of all the nominal sessions of the pump.
+    """
+    # the new sessions must be in the database first, this waits for a detection already running
+    jobs.run("get_new_sessions", update_sessions)
+
+    # we find the session that are between the start_date and end_date
+    if pump_type == "gelcoat":
+        collection_nominal_sessions = collection_nominal_gelcoat
+    else:
+        collection_nominal_sessions = collection_nominal_barrier
+    all_sessions = list(collection_sessions.find(
+        {"pump_type": pump_type, "is_trash": 0, "start_datetime": {"$gte": start_date}, "end_datetime": {"$lte": end_date}}).sort('_id', 1))
+
+    # the ids are numbered from the size of the collection, two ranges of the same pump are added one after the other
+    with jobs.lock(f"nominal sessions {pump_type}"):
+        size_collection_nominal_sessions = collection_nominal_sessions.count_documents({
+        })
+
+        id_offset = 1
+        for session in all_sessions:
+            # add the new nominal sessions to the database
+            document = {
+                "id": size_collection_nominal_sessions + id_offset,
+                "time_added": format_time(datetime.now()),
+                "start_date": session['start_time'],
+                "end_date": session['end_time'],
+                "total_sprayed_amount":session['total_sprayed_amount'],
+                "avg_speed":session['avg_speed'],
+                "avg_pressure":session['avg_pressure'],
+            }
+            collection_nominal_sessions.insert_one(document)
+            id_offset += 1
+        if all_sessions:
+            bump_versions(collection_versions, NOMINAL_VERSION)
+
+    all_nominal_data = list(collection_nominal_sessions.find({}, {
+        '_id': 0,
+        'id': 1,
+        'time_added': 1,
+        'start_date': 1,
+        'end_date': 1
+    }))
+    logging.info(f"add_new_nominal_session < pump_type: {pump_type} >")
+    return all_nominal_data
+
+
 def reset_id_nominal_sessions(collection):
     """
     Resets the ID of the nominal sessions in the specified collection.
@@ -1298,6 +1921,7 @@ def remove_nominal_session_by_id():
                 'end_date': 1
             }))
 
+        bump_versions(collection_versions, NOMINAL_VERSION)
         logging.info(f"remove_nominal_session_by_id < pump_type: {data['pump_type']}, id: {data['id']} >")
         return jsonify(all_nominal_data), 200
     except Exception as e:
@@ -1346,6 +1970,7 @@ def reset_maintenance_pump():
             }
             collection_maintenance_pump.insert_one(document)
 
+            bump_versions(collection_versions, MAINTENANCE_VERSION)
             logging.info("reset_maintenance_pump < First Added >")
             return jsonify("Done"), 200
 
@@ -1366,6 +1991,7 @@ def reset_maintenance_pump():
                     "end_time": datetime.now() + timedelta(days=DEFAUL_MAINTEANCE_PUMP),
                 }
             })
+        bump_versions(collection_versions, MAINTENANCE_VERSION)
         logging.info("reset_maintenance_pump < Done >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -1412,6 +2038,7 @@ def reset_maintenance_filter():
             }
             collection_maintenance_filter.insert_one(document)
 
+            bump_versions(collection_versions, MAINTENANCE_VERSION)
             logging.info("reset_maintenance_filter < First Added >")
             return jsonify("Done"), 200
 
@@ -1432,6 +2059,7 @@ def reset_maintenance_filter():
                     "end_time": datetime.now() + timedelta(days=DEFAUL_MAINTEANCE_FILTER),
                 }
             })
+        bump_versions(collection_versions, MAINTENANCE_VERSION)
         logging.info("reset_maintenance_filter < Done >")
         return jsonify("Done"), 200
     except Exception as e:
@@ -1439,6 +2067,7 @@ def reset_maintenance_filter():
         return jsonify({"error": str(e)}), 501
     
 @app.route('/api/get_maintenance', methods=['GET'])
+@response_cache.cached(MAINTENANCE_VERSION, max_age=MAINTENANCE_CACHE_SECONDS)
 def get_maintenance():
     """
     Retrieves the maintenance information for gelcoat and barrier pumps, as well as filter pumps.
@@ -1514,6 +2143,7 @@ def set_maintenance_manually():
             })
         else:
             pass
+        bump_versions(collection_versions, MAINTENANCE_VERSION)
         logging.info(f"set_maintenance_manually < pump_type: {pump_type}, field_to_change: {field_to_change}, new_value: {new_value} >")
         return jsonify("Done Changinge Maintenance Record"), 200
     
@@ -1527,6 +2157,7 @@ def set_maintenance_manually():
     
 
 @app.route('/api/get_latest_alerts', methods=['GET'])
+@response_cache.cached(ALERTS_VERSION)
 def get_latest_alerts():
     """
     Retrieves the latest alerts and nominal values from the database and sorts them by their times.
@@ -1547,7 +2178,7 @@ def get_latest_alerts():
         j = 0
         while i < len(latest_alerts) and j < len(latest_nominal):
             
-            if datetime.strptime(latest_alerts[i]['time'], '%Y-%m-%d %I:%M:%S %p') > datetime.strptime(latest_nominal[j]['time'], '%Y-%m-%d %I:%M:%S %p'):
+            if latest_alerts[i]['time'] > latest_nominal[j]['time']:
                 all_alerts.append(latest_alerts[i])
                 i += 1
             else:
@@ -1573,5 +2204,20 @@ def get_latest_alerts():
         return jsonify({"error get_latest_alerts": str(e)}), 500
 
 
+# detects the new sessions in the background, in a single api worker at a time (see refresh_sessions)
+session_refresher = threading.Thread(target=refresh_sessions, name="session-refresh", daemon=True)
+session_refresher.start()
+
+
+def shutdown():
+    """
+    Lets the running jobs finish and closes the MongoDB connections, called by gunicorn when a worker exits.
+    """
+    jobs.shutdown()
+    client.close()
+    logging.info("shutdown < Done >")
+
+
 if __name__ == '__main__':
+    # development server, the container serves the api with gunicorn (see gunicorn.conf.py)
     app.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,85 @@
+"""
+Cache of the responses of the list endpoints, with ETags.
+
+A cached endpoint declares the versions of the data it reads (see common.versions). Its ETag is derived from
+the path, the query string, the body of the request and those versions, so it changes as soon as a write bumps
+one of them, in any api worker or in the agent. A request whose If-None-Match holds the current ETag gets a 304
+without a body, a request that matches the cached ETag gets the cached body, only the others run the endpoint.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+
+from common.versions import read_versions
+
+
+class ResponseCache:
+    """
+    Keeps the latest response of every endpoint and parameters, at most max_entries of them.
+
+    Args:
+        versions (pymongo.collection.Collection): The collection of the versions, common.versions.VERSIONS.
+        max_entries (int, optional): The number of responses kept, the least recently used go first. Defaults to 256.
+    """
+
+    def __init__(self, versions, max_entries=256):
+        self.versions = versions
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def cached(self, *names, max_age=None, finish=None):
+        """
+        Decorates a view function whose response only depends on the request and the named data.
+
+        Args:
+            names (str): The versions the response depends on.
+            max_age (float, optional): Seconds after which the response is computed again even without a write,
+                for responses that depend on the time. Defaults to None, never.
+            finish (callable, optional): Called with a response computed by the view before it is cached, e.g.
+                to add headers. The cached responses keep them, a hit doesn't call it again. Defaults to None.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                key = (request.path, request.query_string, request.get_data())
+                seed = [repr(key), *read_versions(self.versions, names)]
+                if max_age:
+                    seed.append(str(int(time.time() // max_age)))
+                etag = hashlib.sha1("\0".join(seed).encode()).hexdigest()[:20]
+
+                if request.if_none_match.contains(etag):
+                    response = Response(status=304)
+                else:
+                    with self._lock:
+                        entry = self._entries.get(key)
+                        if entry is not None:
+                            self._entries.move_to_end(key)
+                    if entry is not None and entry[0] == etag:
+                        response = Response(entry[1], status=200, headers=entry[2])
+                    else:
+                        result = view(*args, **kwargs)
+                        response, status = result if isinstance(result, tuple) else (result, 200)
+                        response.status_code = status
+                        if status != 200:
+                            return response
+                        if finish:
+                            response = finish(response)
+                        self._store(key, (etag, response.get_data(), list(response.headers.items())))
+                response.set_etag(etag)
+                # the browsers revalidate every time and get a 304 while nothing was written
+                response.headers["Cache-Control"] = "no-cache"
+                return response
+            return wrapper
+        return decorator
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
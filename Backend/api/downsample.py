@@ -0,0 +1,162 @@
+"""
+Server-side downsampling of the readings sent by /api/history.
+
+Every channel is downsampled on its own and the readings selected for any channel are returned, unchanged,
+so the response keeps the shape of a full history and every value in it is a real reading. max_points is the
+number of readings returned in total, so every channel gets its share of it. Two methods:
+
+- METHOD_MINMAX splits the time range into max_points / (2 * channels) buckets of equal length and keeps the
+  reading with the lowest and the one with the highest value of every channel in every bucket, so a spike of
+  a single reading is always kept. The buckets are grouped inside MongoDB, see minmax_stages, only the
+  selected readings are sent to the api.
+- METHOD_LTTB (Largest Triangle Three Buckets) keeps max_points / channels readings per channel, chosen to
+  preserve the shape of the curve, first and last reading included. The values are read in a first pass and
+  the selected readings in a second one, see lttb_readings.
+"""
+from array import array
+from datetime import datetime, timedelta
+from itertools import islice
+
+import numpy as np
+
+METHOD_MINMAX = "minmax"
+METHOD_LTTB = "lttb"
+
+DOWNSAMPLED_FIELDS = ('Barr_pulses', 'Gelcoat_pulses', 'Barrier_speedRPM', 'Gelcoat_speedRPM', 'WaterLevel_1',
+                      'WaterLevel_2', 'Pressure')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def minimum_points(method, fields=DOWNSAMPLED_FIELDS):
+    """
+    Returns the smallest max_points of a method: one bucket for minmax, three points per channel for LTTB.
+    """
+    return (2 if method == METHOD_MINMAX else 3) * len(fields)
+
+
+def check_downsampling(method, max_points, fields=DOWNSAMPLED_FIELDS):
+    """
+    Raises:
+        ValueError: If the method is unknown or max_points is lower than minimum_points.
+    """
+    if method not in (METHOD_MINMAX, METHOD_LTTB):
+        raise ValueError(f"Invalid downsampling method, it should be either {METHOD_MINMAX} or {METHOD_LTTB}. {method} is given.")
+    if max_points < minimum_points(method, fields):
+        raise ValueError(f"Invalid max_points, it should be at least {minimum_points(method, fields)} with {method}. {max_points} is given.")
+
+
+def minmax_stages(start, end, max_points, fields=DOWNSAMPLED_FIELDS):
+    """
+    Returns the aggregation stages that keep the lowest and highest reading of every channel per time bucket.
+
+    The stages take readings with a "timestamp" and the fields. Comparing {"v": value, "r": reading} documents
+    orders them by value, so $min and $max return the whole reading holding the extreme value.
+
+    Args:
+        start (datetime): The time of the first reading.
+        end (datetime): The time of the last reading.
+        max_points (int): The number of readings returned in total, see check_downsampling.
+        fields (tuple, optional): The channels. Defaults to DOWNSAMPLED_FIELDS.
+
+    Returns:
+        list: The stages, one document per bucket, read with minmax_readings.
+    """
+    buckets = max_points // (2 * len(fields))
+    span = (end - start) // timedelta(milliseconds=1) + 1
+    group = {
+        "_id": {"$floor": {"$divide": [{"$multiply": [{"$subtract": ["$timestamp", start]}, buckets]}, span]}},
+        "n": {"$sum": 1},
+    }
+    for i, field in enumerate(fields):
+        group[f"lo{i}"] = {"$min": {"v": f"${field}", "r": "$$ROOT"}}
+        group[f"hi{i}"] = {"$max": {"v": f"${field}", "r": "$$ROOT"}}
+    return [{"$group": group}]
+
+
+def minmax_readings(groups, fields=DOWNSAMPLED_FIELDS):
+    """
+    Collects the readings selected by minmax_stages.
+
+    Args:
+        groups (iterable): The documents returned by the stages.
+        fields (tuple, optional): The channels. Defaults to DOWNSAMPLED_FIELDS.
+
+    Returns:
+        tuple: (the selected readings sorted by time, each one once, the number of readings read).
+    """
+    selected = {}
+    count = 0
+    for group in groups:
+        count += group["n"]
+        for i in range(len(fields)):
+            for extreme in (group[f"lo{i}"], group[f"hi{i}"]):
+                reading = extreme["r"]
+                selected[(reading["timestamp"], reading.get("device"), reading.get("seq"))] = reading
+    return [selected[key] for key in sorted(selected, key=lambda key: (key[0], key[2] or 0))], count
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Returns the indices of the threshold points selected by Largest Triangle Three Buckets.
+
+    Args:
+        x (numpy.ndarray): Increasing x values, e.g. seconds.
+        y (numpy.ndarray): The values.
+        threshold (int): The number of points to keep.
+    """
+    count = len(x)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    # threshold - 2 buckets between the first and the last point, which are always kept
+    edges = np.linspace(1, count - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = count - 1
+    anchor = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        following = slice(edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else slice(count - 1, count)
+        average_x = x[following].mean()
+        average_y = y[following].mean()
+        areas = np.abs((x[anchor] - average_x) * (y[start:end] - y[anchor])
+                       - (x[anchor] - x[start:end]) * (average_y - y[anchor]))
+        anchor = start + int(np.argmax(areas))
+        selected[i + 1] = anchor
+    return selected
+
+
+def lttb_readings(read, max_points, fields=DOWNSAMPLED_FIELDS):
+    """
+    Downsamples readings per channel with LTTB.
+
+    The first pass only keeps the time and the values of the channels, as packed float arrays. The second pass
+    keeps the selected readings, it stops after the readings of the first pass so readings recorded meanwhile
+    don't shift the indices.
+
+    Args:
+        read (callable): Returns a new iterable over the readings sorted by time, with a "timestamp" datetime.
+        max_points (int): The number of readings returned in total, see check_downsampling.
+        fields (tuple, optional): The channels. Defaults to DOWNSAMPLED_FIELDS.
+
+    Returns:
+        tuple: (the selected readings, the number of readings read).
+    """
+    seconds = array('d')
+    columns = {field: array('d') for field in fields}
+    for reading in read():
+        seconds.append((reading["timestamp"] - EPOCH).total_seconds())
+        for field, column in columns.items():
+            value = reading.get(field)
+            column.append(np.nan if value is None else value)
+    count = len(seconds)
+    if not count:
+        return [], 0
+
+    x = np.frombuffer(seconds)
+    selected = np.arange(0)
+    for column in columns.values():
+        selected = np.union1d(selected, lttb_indices(x, np.frombuffer(column), max_points // len(fields)))
+
+    selected = set(selected.tolist())
+    return [reading for i, reading in enumerate(islice(read(), count)) if i in selected], count
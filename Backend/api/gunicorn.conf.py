@@ -0,0 +1,32 @@
+"""
+Gunicorn settings of the api, used by the Dockerfile:
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is not preloaded: every worker imports app.py after the fork, so each one opens its own MongoClient
+and runs its own live feed and job pool. The workers share the job records and leases in MongoDB, a job key
+never runs in two workers at the same time.
+"""
+import os
+import sys
+
+bind = "0.0.0.0:5000"
+preload_app = False
+
+workers = int(os.environ.get("API_WORKERS", 2))
+# every /api/stream client holds a thread of its worker while it is connected. A worker holds at most API_STREAMS
+# of them (see stream in app.py) and gets as many threads on top of the API_THREADS of the normal requests
+worker_class = "gthread"
+threads = int(os.environ.get("API_THREADS", 16)) + int(os.environ.get("API_STREAMS", 8))
+
+timeout = 120  # (SECOND)
+# time left to the running jobs of a worker to finish on restart or shutdown
+graceful_timeout = int(os.environ.get("API_GRACEFUL_TIMEOUT", 60))  # (SECOND)
+
+accesslog = "-"
+errorlog = "-"
+
+
+def worker_exit(server, worker):
+    app = sys.modules.get("app")
+    if app is not None:
+        app.shutdown()
@@ -0,0 +1,319 @@
+"""
+Background jobs of the maintenance endpoints.
+
+Long computations (session detection, cleanup of the readings, products, nominal sessions) are submitted to a
+small thread pool instead of running in the request thread. A job is identified by a key: submitting a key
+that is already queued or running, in this or another api worker, returns that job instead of starting another
+one, and two runs of the same key never overlap thanks to a lease document per key. Every job is recorded in
+MongoDB with its status, progress and duration, so it can be followed from /api/jobs/<id> by any process.
+
+The records of the queued and running jobs and the leases are kept alive by a heartbeat of the process that
+owns them. The ones of a process that died are taken over once they are older than JOB_LEASE_SECONDS.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_INTERRUPTED = "interrupted"
+
+JOB_FINISHED = (JOB_DONE, JOB_FAILED, JOB_INTERRUPTED)
+
+# finished jobs kept in memory with their result
+JOB_HISTORY = 100
+
+# the leases and active job records of a process are renewed every JOB_HEARTBEAT_INTERVAL, the ones of a process
+# that died expire JOB_LEASE_SECONDS after its last heartbeat
+JOB_HEARTBEAT_INTERVAL = 10  # (SECOND)
+JOB_LEASE_SECONDS = 30  # (SECOND)
+JOB_POLL_INTERVAL = 0.5  # (SECOND)
+# times submit looks for the active job of a key and tries to queue its own, another process may be faster
+JOB_SUBMIT_ATTEMPTS = 5
+
+
+class Job:
+    def __init__(self, key, owner):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.owner = owner
+        self.status = JOB_QUEUED
+        self.progress = None
+        self.message = None
+        self.submitted = datetime.now()
+        self.started = None
+        self.finished = None
+        self.duration = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def record(self):
+        """
+        Returns the status of the job as stored in MongoDB, without the result.
+        """
+        record = {
+            "_id": self.id,
+            "key": self.key,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "duration": self.duration,
+            "error": self.error,
+            "heartbeat": datetime.now(),
+            **self.owner,
+        }
+        # only the queued and running jobs have an active_key, unique (see the index in common.schema)
+        if self.status in (JOB_QUEUED, JOB_RUNNING):
+            record["active_key"] = self.key
+        return record
+
+
+class JobRunner:
+    """
+    Runs the jobs on a thread pool and keeps their records up to date.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection of the job records.
+        leases (pymongo.collection.Collection): The collection of the leases, one document per running key.
+        max_workers (int, optional): The number of jobs that run at the same time. Defaults to 2.
+    """
+
+    def __init__(self, collection, leases, max_workers=2):
+        self.collection = collection
+        self.leases = leases
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="job")
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid(), "boot": uuid.uuid4().hex}
+        self._lock = threading.Lock()
+        self._active = {}
+        self._jobs = OrderedDict()
+        self._key_locks = {}
+        self._local = threading.local()
+        self._heartbeat = threading.Thread(target=self._beat, name="job-heartbeat", daemon=True)
+        self._started = False
+
+    def submit(self, key, function, *args, **kwargs):
+        """
+        Queues function(*args, **kwargs) as the job of the given key, unless that job is already queued or running
+        in this or another process.
+
+        Returns:
+            dict: The status of the job, see status(). The record of the job of another process has no result.
+        """
+        self._start()
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                return self.status(job)
+            job = Job(key, self.owner)
+            for _ in range(JOB_SUBMIT_ATTEMPTS):
+                record = self.collection.find_one({"active_key": key})
+                if record is not None:
+                    if datetime.now() - record["heartbeat"] < timedelta(seconds=JOB_LEASE_SECONDS):
+                        return dict(record, result=None)
+                    self._interrupt(record)
+                    continue
+                try:
+                    # the unique index on the active jobs makes the insert fail if another process was faster
+                    self.collection.insert_one(job.record())
+                    break
+                except DuplicateKeyError:
+                    continue
+            else:
+                raise RuntimeError(f"The job {key} could not be queued, its key stays taken.")
+            self._active[key] = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > JOB_HISTORY and next(iter(self._jobs.values())).done.is_set():
+                self._jobs.popitem(last=False)
+        self.executor.submit(self._execute, job, function, args, kwargs)
+        return self.status(job)
+
+    def run(self, key, function, *args, **kwargs):
+        """
+        Runs function in the calling thread, after the running job of the same key if there is one.
+
+        Used by a job that needs the work of another key done first, e.g. the new sessions before the nominal ones.
+        """
+        with self.lock(key):
+            return function(*args, **kwargs)
+
+    def wait(self, job_id, timeout):
+        """
+        Waits at most timeout seconds for a job to finish. Jobs of other processes are polled in MongoDB.
+
+        Returns:
+            dict: The status of the job, None if it is unknown.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+            return self.status(job)
+        deadline = time.monotonic() + timeout
+        record = self.get(job_id)
+        while record is not None and record["status"] not in JOB_FINISHED and time.monotonic() < deadline:
+            time.sleep(JOB_POLL_INTERVAL)
+            record = self.get(job_id)
+        return record
+
+    def get(self, job_id):
+        """
+        Returns the status of a job, with its result if it was run by this process.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return self.status(job)
+        return self.collection.find_one({"_id": job_id})
+
+    def progress(self, fraction, message=None):
+        """
+        Updates the progress of the job running in the calling thread, does nothing outside of a job.
+
+        Args:
+            fraction (float): The part of the work done, between 0 and 1.
+            message (str, optional): What the job is doing. Defaults to None.
+        """
+        job = getattr(self._local, "job", None)
+        if job is None:
+            return
+        job.progress = round(fraction, 3)
+        job.message = message
+        self._save(job)
+
+    def recover(self):
+        """
+        Marks the jobs left queued or running by a process of this host that is gone as interrupted.
+        """
+        query = {"status": {"$in": [JOB_QUEUED, JOB_RUNNING]}, "host": self.owner["host"], "boot": {"$ne": self.owner["boot"]}}
+        for record in self.collection.find(query, {"pid": 1, "heartbeat": 1}):
+            if record["pid"] == self.owner["pid"] or not _is_alive(record["pid"]):
+                self._interrupt(record)
+
+    @staticmethod
+    def status(job):
+        status = job.record()
+        status["result"] = job.result
+        return status
+
+    @contextmanager
+    def lock(self, key, poll_interval=JOB_POLL_INTERVAL):
+        """
+        Holds the key for the calling thread: no job of that key runs in this or another process meanwhile.
+
+        Args:
+            key (str): The key, a job key or the name of a task that must run in a single process.
+            poll_interval (float, optional): Seconds between two tries while another process holds the key.
+                Defaults to JOB_POLL_INTERVAL.
+        """
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        self._start()
+        with key_lock:
+            self._acquire_lease(key, poll_interval)
+            try:
+                yield
+            finally:
+                self.leases.delete_one({"_id": key, "boot": self.owner["boot"]})
+
+    def shutdown(self):
+        """
+        Waits for the running jobs and marks the queued ones as interrupted, called when the process exits.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            cancelled = [job for job in self._jobs.values() if job.status == JOB_QUEUED]
+        for job in cancelled:
+            job.status = JOB_INTERRUPTED
+            self._save(job)
+            job.done.set()
+
+    def _acquire_lease(self, key, poll_interval):
+        while True:
+            now = datetime.now()
+            try:
+                # matches an expired lease, otherwise inserts one, which fails while another process holds the key
+                self.leases.update_one(
+                    {"_id": key, "expires": {"$lt": now}},
+                    {"$set": {"boot": self.owner["boot"], "expires": now + timedelta(seconds=JOB_LEASE_SECONDS)}},
+                    upsert=True)
+                return
+            except DuplicateKeyError:
+                time.sleep(poll_interval)
+
+    def _start(self):
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self._heartbeat.start()
+
+    def _beat(self):
+        while True:
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+            now = datetime.now()
+            try:
+                self.leases.update_many({"boot": self.owner["boot"]},
+                                        {"$set": {"expires": now + timedelta(seconds=JOB_LEASE_SECONDS)}})
+                self.collection.update_many({"boot": self.owner["boot"], "active_key": {"$exists": True}},
+                                            {"$set": {"heartbeat": now}})
+            except Exception as e:
+                logging.error(f"JobRunner heartbeat < Exception: {str(e)} >")
+
+    def _interrupt(self, record):
+        # the heartbeat in the filter leaves a record alone if its process renewed it meanwhile
+        self.collection.update_one({"_id": record["_id"], "heartbeat": record.get("heartbeat")},
+                                   {"$set": {"status": JOB_INTERRUPTED}, "$unset": {"active_key": ""}})
+        logging.warning(f"JobRunner < interrupted job: {record['_id']} >")
+
+    def _execute(self, job, function, args, kwargs):
+        self._local.job = job
+        try:
+            with self.lock(job.key):
+                job.status = JOB_RUNNING
+                job.started = datetime.now()
+                self._save(job)
+                start = time.monotonic()
+                try:
+                    job.result = function(*args, **kwargs)
+                    job.status = JOB_DONE
+                except Exception as e:
+                    job.status = JOB_FAILED
+                    job.error = str(e)
+                    logging.error(f"JobRunner < key: {job.key}, id: {job.id}, Exception: {str(e)} >")
+                job.duration = round(time.monotonic() - start, 3)
+                job.finished = datetime.now()
+        finally:
+            self._local.job = None
+            with self._lock:
+                self._active.pop(job.key, None)
+            self._save(job)
+            job.done.set()
+        logging.info(f"JobRunner < key: {job.key}, id: {job.id}, status: {job.status}, duration: {job.duration} >")
+
+    def _save(self, job):
+        try:
+            self.collection.replace_one({"_id": job.id}, job.record(), upsert=True)
+        except Exception as e:
+            logging.error(f"JobRunner < key: {job.key}, id: {job.id}, save Exception: {str(e)} >")
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
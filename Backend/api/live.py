@@ -0,0 +1,153 @@
+"""
+Live feed of the latest readings.
+
+A single tailer thread polls the sensor data for readings newer than its cursor and keeps the latest ones in
+a ring buffer, so get_20 and /api/stream are served from memory and the database load doesn't depend on the
+number of open dashboards. The sums of SUMMED_FIELDS over a window are computed with math.fsum from the
+readings in the ring, once per window and batch: running sums since the feed started would lose the
+precision of the window to cancellation after a while.
+"""
+import logging
+import math
+import queue
+import threading
+import time
+
+SUMMED_FIELDS = ('Barr_pulses', 'Gelcoat_pulses', 'Pressure')
+
+
+class LiveFeed:
+    """
+    Tails the sensor data and fans out new readings to subscribers.
+
+    Args:
+        fetch (callable): Called as fetch(cursor, limit) from the tailer thread, returns (readings, cursor) with the
+            readings after cursor in time order. With cursor None it returns the latest limit readings.
+        summarize (callable): Called as summarize(sums, count) with the sums of SUMMED_FIELDS over a window,
+            returns the totals sent along with the readings.
+        capacity (int): Number of latest readings kept, the largest window that can be asked for.
+        poll_interval (float, optional): Seconds between two polls. Defaults to 0.25.
+        client_queue_size (int, optional): Messages buffered per client, a client that falls further behind is
+            sent a fresh snapshot instead. Defaults to 100.
+        max_clients (int, optional): Number of subscribers at the same time, see subscribe. Defaults to None, no limit.
+    """
+
+    def __init__(self, fetch, summarize, capacity, poll_interval=0.25, client_queue_size=100, max_clients=None):
+        self.fetch = fetch
+        self.summarize = summarize
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.client_queue_size = client_queue_size
+        self.max_clients = max_clients
+
+        # reading number k is at _ring[k % capacity]
+        self._ring = [None] * capacity
+        self._count = 0
+        self._cursor = None
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._started = False
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="live-feed", daemon=True)
+
+    def start(self):
+        """
+        Starts the tailer thread on first use, so it only runs in the process that serves requests.
+        """
+        with self._lock:
+            if not self._started:
+                self._started = True
+                self._thread.start()
+        return self
+
+    def snapshot(self, window, timeout=5):
+        """
+        Returns the latest readings, as get_20 does: {"data": readings newest first, **totals}.
+
+        Args:
+            window (int): The number of readings, at most capacity.
+            timeout (float, optional): Seconds to wait for the first poll after startup. Defaults to 5.
+        """
+        self.start()
+        self._ready.wait(timeout)
+        with self._lock:
+            return self._message(window, self._count - min(window, self._count), reset=True)
+
+    def subscribe(self, window, timeout=5):
+        """
+        Returns a queue that receives a snapshot message first and then one message per batch of new readings,
+        with the totals over the latest window readings, or None if max_clients are already subscribed.
+        """
+        self.start()
+        self._ready.wait(timeout)
+        subscription = queue.Queue(self.client_queue_size)
+        with self._lock:
+            if self.max_clients is not None and len(self._subscribers) >= self.max_clients:
+                return None
+            # under the lock, so no batch can fall between the snapshot and the registration
+            subscription.put(self._message(window, self._count - min(window, self._count), reset=True))
+            self._subscribers[subscription] = window
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.pop(subscription, None)
+
+    def clients(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _message(self, window, first, reset=False):
+        """
+        Builds a message with the readings first..count-1, newest first, and the totals over the latest window readings.
+        """
+        window = min(window, self._count)
+        readings = [self._ring[k % self.capacity] for k in range(self._count - window, self._count)]
+        sums = {field: math.fsum(reading.get(field) or 0 for reading in readings) for field in SUMMED_FIELDS}
+        message = {
+            "data": [self._ring[k % self.capacity] for k in range(self._count - 1, first - 1, -1)],
+            "reset": reset,
+            "window": window,
+        }
+        message.update(self.summarize(sums, window))
+        return message
+
+    def _run(self):
+        while True:
+            try:
+                readings, cursor = self.fetch(self._cursor, self.capacity)
+                if readings or not self._ready.is_set():
+                    self._advance(readings, cursor)
+            except Exception as e:
+                logging.error(f"LiveFeed < Exception: {str(e)}, cursor: {self._cursor} >")
+            self._ready.set()
+            time.sleep(self.poll_interval)
+
+    def _advance(self, readings, cursor):
+        # a long catch-up only needs the readings that still fit in the ring
+        readings = readings[-self.capacity:]
+        with self._lock:
+            first = self._count
+            for reading in readings:
+                self._ring[self._count % self.capacity] = reading
+                self._count += 1
+            self._cursor = cursor
+            if not readings:
+                return
+            messages = {}
+            for subscription, window in self._subscribers.items():
+                if window not in messages:
+                    messages[window] = self._message(window, first)
+            subscribers = list(self._subscribers.items())
+        for subscription, window in subscribers:
+            try:
+                subscription.put_nowait(messages[window])
+            except queue.Full:
+                # the client is too slow, drop its backlog and let it start over from a snapshot
+                while True:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        break
+                with self._lock:
+                    subscription.put_nowait(self._message(window, self._count - min(window, self._count), reset=True))
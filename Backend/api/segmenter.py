@@ -0,0 +1,147 @@
+"""
+Incremental detection of the pump sessions.
+
+A session is a run of readings where a pump runs with no gap longer than MIN_LENGTH_SESSION between two of
+them. The readings of both pumps are read by a single query and split in the same vectorized pass.
+SessionSegmenter keeps the position of the last reading it has read and the sessions that were still running
+at that point in a small checkpoint document, so every call only reads the new readings.
+"""
+import heapq
+
+import numpy as np
+
+
+def to_seconds(timestamps):
+    """
+    Converts a list of datetimes to a numpy array of epoch seconds.
+    """
+    return np.array(timestamps, dtype="datetime64[ms]").astype(np.int64) / 1000
+
+
+def find_segments(positions, timestamps, speeds, min_gap):
+    """
+    Splits the readings of every pump into the runs without a gap longer than min_gap seconds.
+
+    Args:
+        positions (list): The positions of the readings (see find_reading_id in app.py), sorted by time.
+        timestamps (list): The times of the readings.
+        speeds (dict): The speeds of every pump, {pump_type: list}, a pump runs where its speed is above zero.
+        min_gap (float): The longest gap in seconds allowed within a run.
+
+    Returns:
+        dict: {pump_type: runs}, one dictionary per run with the keys begin, end (datetimes), begin_id and end_id.
+    """
+    if not positions:
+        return {pump_type: [] for pump_type in speeds}
+    seconds = to_seconds(timestamps)
+    segments = {}
+    for pump_type, speed in speeds.items():
+        running = np.flatnonzero(np.array(speed, dtype=np.float64) > 0)
+        if not len(running):
+            segments[pump_type] = []
+            continue
+        gaps = np.flatnonzero(np.diff(seconds[running]) > min_gap)
+        starts = running[np.concatenate(([0], gaps + 1))].tolist()
+        ends = running[np.concatenate((gaps, [len(running) - 1]))].tolist()
+        segments[pump_type] = [{"begin": timestamps[start], "end": timestamps[end],
+                                "begin_id": positions[start], "end_id": positions[end]}
+                               for start, end in zip(starts, ends)]
+    return segments
+
+
+def to_sessions(segments, min_length):
+    """
+    Turns the runs of every pump into one list of sessions sorted by their begin time.
+
+    Adds pump_type and length to the runs and drops the ones not longer than min_length seconds.
+    """
+    sessions = []
+    for pump_type, runs in segments.items():
+        sessions.append([dict(run, pump_type=pump_type, length=(run["end"] - run["begin"]).total_seconds())
+                         for run in runs if (run["end"] - run["begin"]).total_seconds() > min_length])
+    return list(heapq.merge(*sessions, key=lambda session: session["begin"]))
+
+
+class SessionSegmenter:
+    """
+    Finds the sessions of the pumps that ended since the last call.
+
+    The checkpoint is the document {"_id": name, "cursor": ..., "fresh": ..., "open": {pump_type: ...}} in the
+    given collection, with the position of the last reading read, the time of the latest reading when it was read
+    and the bounds of the sessions still running then.
+    advance() doesn't write the checkpoint, commit() does, once the caller has stored the sessions.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection of the checkpoints.
+        pump_types (tuple): The pumps, e.g. ("barrier", "gelcoat").
+        fetch (callable): Called as fetch(since, pump_types), returns (positions, timestamps, speeds) of the
+            readings after the position since (all readings if None) where any of the pumps runs, sorted by time.
+            speeds is {pump_type: list}.
+        min_gap (float): The longest gap in seconds within a session.
+        min_length (float): Sessions not longer than this many seconds are dropped.
+        name (str, optional): The _id of the checkpoint document. Defaults to "sessions".
+    """
+
+    def __init__(self, collection, pump_types, fetch, min_gap, min_length, name="sessions"):
+        self.collection = collection
+        self.pump_types = tuple(pump_types)
+        self.fetch = fetch
+        self.min_gap = min_gap
+        self.min_length = min_length
+        self.name = name
+        self._pending = None
+
+    def advance(self, latest_time, since=None):
+        """
+        Reads the readings after the checkpoint and returns the sessions that are over.
+
+        Args:
+            latest_time (datetime): The time of the latest reading, of any speed. The last session of a pump is
+                still running if it ended less than min_gap seconds before it.
+            since (optional): The position to start from when there is no checkpoint yet. Defaults to None,
+                the first reading.
+
+        Returns:
+            list: The sessions of all pumps sorted by their begin time, in the format returned by find_all_sessions.
+        """
+        state = self.collection.find_one({"_id": self.name}) or {"cursor": since, "open": {}}
+        positions, timestamps, speeds = self.fetch(state["cursor"], self.pump_types)
+        segments = find_segments(positions, timestamps, speeds, self.min_gap)
+
+        still_running = {}
+        for pump_type, runs in segments.items():
+            running = state["open"].get(pump_type)
+            if running is not None:
+                if runs and (runs[0]["begin"] - running["end"]).total_seconds() <= self.min_gap:
+                    # the session was still running at the checkpoint and goes on in the new readings
+                    runs[0]["begin"] = running["begin"]
+                    runs[0]["begin_id"] = running["begin_id"]
+                else:
+                    runs.insert(0, running)
+            if runs and (latest_time is None or (latest_time - runs[-1]["end"]).total_seconds() <= self.min_gap):
+                still_running[pump_type] = runs.pop()
+
+        self._pending = {"cursor": positions[-1] if positions else state["cursor"], "fresh": latest_time,
+                         "open": still_running}
+        return to_sessions(segments, self.min_length)
+
+    def commit(self):
+        """
+        Saves the checkpoint reached by the last call to advance.
+        """
+        if self._pending is not None:
+            self.collection.replace_one({"_id": self.name}, self._pending, upsert=True)
+            self._pending = None
+
+    def checkpoint(self):
+        """
+        Returns the saved checkpoint without the running sessions, {"cursor": ..., "fresh": ...}, or None.
+        """
+        return self.collection.find_one({"_id": self.name}, {"_id": 0, "cursor": 1, "fresh": 1})
+
+    def reset(self):
+        """
+        Deletes the checkpoint, the next call to advance starts over from the first reading.
+        """
+        self._pending = None
+        self.collection.delete_one({"_id": self.name})
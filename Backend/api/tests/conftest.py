@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the api imports its modules by name and the shared package as common, as it runs from its own directory
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(API_DIR))
+sys.path.insert(0, API_DIR)
@@ -0,0 +1,82 @@
+import mongomock
+from flask import Flask, jsonify
+
+from cache import ResponseCache
+from common.versions import SESSIONS_VERSION, bump_versions
+
+
+def worker(versions, comments):
+    """
+    Builds an app like one api worker, with its own ResponseCache on the shared versions.
+    """
+    app = Flask(__name__)
+    cache = ResponseCache(versions)
+
+    @app.route('/sessions')
+    @cache.cached(SESSIONS_VERSION)
+    def sessions():
+        return jsonify(comments), 200
+
+    @app.route('/comment/<text>', methods=['POST'])
+    def comment(text):
+        comments.append(text)
+        bump_versions(versions, SESSIONS_VERSION)
+        return jsonify(comments), 200
+
+    return app.test_client()
+
+
+def test_write_in_one_worker_is_served_by_the_other():
+    versions = mongomock.MongoClient().Api.versions
+    comments = []
+    first, second = worker(versions, comments), worker(versions, comments)
+
+    cached = second.get('/sessions')
+    assert cached.get_json() == []
+    assert second.get('/sessions', headers={"If-None-Match": cached.headers["ETag"]}).status_code == 304
+
+    first.post('/comment/clogged')
+
+    refetched = second.get('/sessions', headers={"If-None-Match": cached.headers["ETag"]})
+    assert refetched.status_code == 200
+    assert refetched.get_json() == ["clogged"]
+    assert refetched.headers["ETag"] != cached.headers["ETag"]
+    assert first.get('/sessions').headers["ETag"] == refetched.headers["ETag"]
+
+
+def test_write_by_another_process_is_served_at_once():
+    versions = mongomock.MongoClient().Api.versions
+    comments = []
+    client = worker(versions, comments)
+    cached = client.get('/sessions')
+
+    # what bump_versions leaves in MongoDB when the agent or another api worker writes
+    comments.append("clogged")
+    versions.update_one({"_id": SESSIONS_VERSION}, {"$set": {"token": "written elsewhere"}}, upsert=True)
+
+    refetched = client.get('/sessions', headers={"If-None-Match": cached.headers["ETag"]})
+    assert refetched.status_code == 200
+    assert refetched.get_json() == ["clogged"]
+
+
+def test_finish_headers_are_cached_with_the_response():
+    app = Flask(__name__)
+    cache = ResponseCache(mongomock.MongoClient().Api.versions)
+    calls = []
+
+    def finish(response):
+        calls.append(response)
+        response.headers["X-Fresh-As-Of"] = str(len(calls))
+        return response
+
+    @app.route('/sessions')
+    @cache.cached(SESSIONS_VERSION, finish=finish)
+    def sessions():
+        return jsonify([]), 200
+
+    client = app.test_client()
+    first = client.get('/sessions')
+    second = client.get('/sessions')
+    assert client.get('/sessions', headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert len(calls) == 1
+    assert second.headers["X-Fresh-As-Of"] == first.headers["X-Fresh-As-Of"] == "1"
@@ -0,0 +1,280 @@
+"""
+Bucketed storage layout of the sensor readings.
+
+Instead of one document per reading, the bucketed layout keeps one document per device and minute in
+Sensor_Data.buckets_1m, with short keys and one packed array per field:
+
+    {
+        "d": "rotary",                          # device
+        "s": datetime(2024, 4, 7, 11, 0),       # start of the minute
+        "e": datetime(2024, 4, 7, 11, 0, 59),   # time of the last reading
+        "n": 600,                               # number of readings
+        "t": [0, 100, 200, ...],                # milliseconds since "s"
+        "q": [1200, 1201, 1202, ...],           # sequence numbers
+        "v": {"bp": [...], "gp": [...], ...},   # values, keys in FIELD_KEYS
+        "lo": {"bp": 0, ...},                   # minimum of every field
+        "hi": {"bp": 3, ...},                   # maximum of every field
+    }
+
+The layout is chosen with the SENSOR_STORAGE_LAYOUT environment variable ("documents" or "buckets"), which
+must be the same for the rotary script, the api and the agent. Readings don't have an _id in this layout,
+they are located by their timestamp.
+
+Converting the readings recorded in the documents layout:
+    python -m common.buckets --mongo mongodb://db:27017 --convert
+"""
+import argparse
+import logging
+import os
+from datetime import timedelta
+
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from common.readings import DEFAULT_DEVICE, bucket_start, format_time
+
+LAYOUT_DOCUMENTS = "documents"
+LAYOUT_BUCKETS = "buckets"
+STORAGE_LAYOUT = os.environ.get("SENSOR_STORAGE_LAYOUT", LAYOUT_DOCUMENTS)
+
+BUCKET_COLLECTION = "buckets_1m"
+BUCKET_SECONDS = 60
+
+FIELD_KEYS = {
+    'Barr_pulses': 'bp',
+    'Gelcoat_pulses': 'gp',
+    'Barrier_speedRPM': 'br',
+    'Gelcoat_speedRPM': 'gr',
+    'WaterLevel_1': 'w1',
+    'WaterLevel_2': 'w2',
+    'Pressure': 'p',
+}
+
+# below this speed both pumps are considered stopped, same threshold as delete_useless_reads_from_db
+IDLE_SPEED = 0.0001
+
+CONVERT_BATCH_SIZE = 10000
+
+
+def ensure_bucket_indexes(collection):
+    collection.create_index([("d", ASCENDING), ("s", ASCENDING)], unique=True)
+    collection.create_index([("s", ASCENDING)])
+
+
+def bucket_operations(readings):
+    """
+    Builds one upsert per (device, minute) that appends the given readings to the bucket.
+
+    The filter excludes buckets that already hold the first sequence number of the group, so a group that
+    was already applied makes the upsert fail with a duplicate key error instead of being appended twice.
+
+    Args:
+        readings (list): Reading documents with "timestamp" and "seq", in the order they were taken.
+
+    Returns:
+        list: (UpdateOne, readings) pairs, the operation for bulk_write and the readings it holds.
+    """
+    groups = {}
+    for reading in readings:
+        key = (reading.get("device", DEFAULT_DEVICE), bucket_start(reading["timestamp"], BUCKET_SECONDS))
+        groups.setdefault(key, []).append(reading)
+
+    operations = []
+    for (device, start), group in groups.items():
+        push = {
+            "t": {"$each": [int((reading["timestamp"] - start).total_seconds() * 1000) for reading in group]},
+            "q": {"$each": [reading["seq"] for reading in group]},
+        }
+        low, high = {}, {}
+        for field, key in FIELD_KEYS.items():
+            values = [reading[field] for reading in group]
+            push[f"v.{key}"] = {"$each": values}
+            low[f"lo.{key}"] = min(values)
+            high[f"hi.{key}"] = max(values)
+        high["e"] = group[-1]["timestamp"]
+        operations.append((UpdateOne(
+            {"d": device, "s": start, "q": {"$ne": group[0]["seq"]}},
+            {"$push": push, "$inc": {"n": len(group)}, "$min": low, "$max": high},
+            upsert=True
+        ), group))
+    return operations
+
+
+def unpack_bucket(bucket, exclude=()):
+    """
+    Expands a bucket into reading documents in the documents layout, without the _id.
+
+    Args:
+        bucket (dict): The bucket document.
+        exclude (iterable, optional): Keys left out of the readings, e.g. "timestamp". Defaults to none.
+
+    Returns:
+        list: The readings of the bucket, in the order they were taken.
+    """
+    start = bucket["s"]
+    values = bucket["v"]
+    fields = [(field, values[key]) for field, key in FIELD_KEYS.items() if field not in exclude]
+    readings = []
+    for i, offset in enumerate(bucket["t"]):
+        timestamp = start + timedelta(milliseconds=offset)
+        reading = {"time": format_time(timestamp), "timestamp": timestamp, "device": bucket["d"], "seq": bucket["q"][i]}
+        for field, column in fields:
+            reading[field] = column[i]
+        for key in exclude:
+            reading.pop(key, None)
+        readings.append(reading)
+    return readings
+
+
+def find_bucketed_readings(collection, start_date=None, end_date=None, device=None, active=None, exclude=()):
+    """
+    Reads the readings taken between two times from the buckets, see iter_bucketed_readings.
+
+    Returns:
+        list: The readings sorted by time.
+    """
+    return list(iter_bucketed_readings(collection, start_date, end_date, device, active, exclude))
+
+
+def iter_bucketed_readings(collection, start_date=None, end_date=None, device=None, active=None, exclude=()):
+    """
+    Yields the readings taken between two times from the buckets, one bucket is unpacked at a time.
+
+    Args:
+        collection (pymongo.collection.Collection): The bucket collection.
+        start_date (datetime, optional): Only readings taken at or after this time. Defaults to the first reading.
+        end_date (datetime, optional): Only readings taken at or before this time. Defaults to the last reading.
+        device (str, optional): Only readings of this device. Defaults to all devices.
+        active (str or tuple, optional): Only readings where this field, or one of these fields, is greater than
+            zero. Buckets where they are never greater than zero are not fetched. Defaults to all readings.
+        exclude (iterable, optional): Keys left out of the readings. Defaults to none.
+
+    Yields:
+        dict: The readings sorted by time.
+    """
+    query = {}
+    if start_date is not None:
+        query["s"] = {"$gte": bucket_start(start_date, BUCKET_SECONDS)}
+        query["e"] = {"$gte": start_date}
+    if end_date is not None:
+        query.setdefault("s", {})["$lte"] = end_date
+    if device is not None:
+        query["d"] = device
+    if isinstance(active, str):
+        active = (active,)
+    if active is not None:
+        query["$or"] = [{f"hi.{FIELD_KEYS[field]}": {"$gt": 0}} for field in active]
+
+    for bucket in collection.find(query, {"_id": 0}).sort("s", ASCENDING):
+        for reading in unpack_bucket(bucket):
+            if start_date is not None and reading["timestamp"] < start_date:
+                continue
+            if end_date is not None and reading["timestamp"] > end_date:
+                break
+            if active is not None and not any(reading[field] > 0 for field in active):
+                continue
+            for key in exclude:
+                reading.pop(key, None)
+            yield reading
+
+
+def find_latest_bucketed_readings(collection, limit, device=None, exclude=()):
+    """
+    Reads the latest readings from the buckets.
+
+    Args:
+        collection (pymongo.collection.Collection): The bucket collection.
+        limit (int): The number of readings.
+        device (str, optional): Only readings of this device. Defaults to all devices.
+        exclude (iterable, optional): Keys left out of the readings. Defaults to none.
+
+    Returns:
+        list: The latest readings, newest first like a find sorted by descending _id.
+    """
+    query = {} if device is None else {"d": device}
+    readings = []
+    for bucket in collection.find(query, {"_id": 0}).sort("s", DESCENDING):
+        readings.extend(reversed(unpack_bucket(bucket, exclude)))
+        if len(readings) >= limit:
+            break
+    return readings[:limit]
+
+
+def delete_idle_buckets(collection, after=None, before=None):
+    """
+    Deletes the buckets strictly between two times where both pumps were stopped for the whole minute.
+
+    Args:
+        collection (pymongo.collection.Collection): The bucket collection.
+        after (datetime, optional): Only buckets starting after this time. Defaults to the first bucket.
+        before (datetime, optional): Only buckets ending before this time. Defaults to the last bucket.
+
+    Returns:
+        int: The number of deleted buckets.
+    """
+    query = {
+        "hi.br": {"$lt": IDLE_SPEED},
+        "hi.gr": {"$lt": IDLE_SPEED},
+    }
+    if after is not None:
+        query["s"] = {"$gt": after}
+    if before is not None:
+        query["e"] = {"$lt": before}
+    return collection.delete_many(query).deleted_count
+
+
+def next_bucket_sequence(collection, device=DEFAULT_DEVICE):
+    """
+    Returns the sequence number that follows the last reading written by the given device in the buckets.
+    """
+    latest = collection.find_one({"d": device}, {"q": {"$slice": -1}}, sort=[("s", DESCENDING)])
+    if latest is None or not latest["q"]:
+        return 0
+    return latest["q"][-1] + 1
+
+
+def convert_readings(collection, buckets):
+    """
+    Appends the readings of the documents layout to the buckets, in _id order.
+
+    Readings without a timestamp or a sequence number must be migrated first with common.migrate_timestamps.
+    Groups that are already in the buckets are skipped, so an interrupted conversion can be run again.
+
+    Returns:
+        int: The number of converted readings.
+    """
+    ensure_bucket_indexes(buckets)
+    batch = []
+    total = 0
+    for reading in collection.find({"timestamp": {"$exists": True}, "seq": {"$exists": True}}).sort("_id", ASCENDING):
+        batch.append(reading)
+        if len(batch) == CONVERT_BATCH_SIZE:
+            _append(buckets, batch)
+            total += len(batch)
+            batch = []
+    _append(buckets, batch)
+    return total + len(batch)
+
+
+def _append(buckets, readings):
+    if not readings:
+        return
+    try:
+        buckets.bulk_write([operation for operation, _ in bucket_operations(readings)], ordered=False)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Maintain the bucketed layout of the sensor readings.")
+    parser.add_argument("--mongo", default="mongodb://db:27017", help="MongoDB connection string")
+    parser.add_argument("--convert", action="store_true", help="append the readings of the documents layout to the buckets")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["Sensor_Data"]
+    if args.convert:
+        logging.info(f"convert_readings < readings: {convert_readings(db['test_28_march'], db[BUCKET_COLLECTION])} >")
+    else:
+        ensure_bucket_indexes(db[BUCKET_COLLECTION])
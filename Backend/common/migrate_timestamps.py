@@ -0,0 +1,111 @@
+"""
+One-shot migration to native timestamps.
+
+Adds the "timestamp" (BSON datetime), "device" and "seq" fields to sensor readings that only carry the
+legacy "time" string, and the "start_datetime"/"end_datetime" fields to the stored sessions.
+It is safe to run more than once: documents that already have the new fields are skipped.
+
+Usage (from the Backend directory, or inside the api container):
+    python -m common.migrate_timestamps --mongo mongodb://db:27017
+"""
+import argparse
+import logging
+
+from pymongo import MongoClient, UpdateOne
+
+from common.readings import DEFAULT_DEVICE, parse_time
+
+BATCH_SIZE = 1000
+
+
+def migrate_readings(collection, device=DEFAULT_DEVICE):
+    """
+    Adds timestamp, device and seq to every reading that has no timestamp yet.
+
+    The legacy "time" only has a resolution of a second, so the readings of a second share their timestamp and
+    seq keeps their order. Readings are numbered in _id order with a counter that only increases, across the
+    batches and the runs: a run that follows an interrupted one continues after the last reading it migrated.
+    The migrated readings come right before the lowest sequence number already written by the device; if that
+    number is too low, the readings of the device are renumbered first so no sequence number is negative.
+    Run it while the rotary script is stopped.
+
+    Returns:
+        int: The number of migrated readings.
+    """
+    query = {"timestamp": {"$exists": False}}
+    missing = collection.count_documents(query)
+    if not missing:
+        return 0
+
+    first_missing = collection.find_one(query, {"_id": 1}, sort=[("_id", 1)])
+    previous = collection.find_one({"_id": {"$lt": first_missing["_id"]}, "device": device, "seq": {"$exists": True}},
+                                   {"seq": 1}, sort=[("_id", -1)])
+    if previous is not None:
+        seq = previous["seq"] + 1
+    else:
+        first_existing = collection.find_one({"device": device, "seq": {"$exists": True}}, {"seq": 1}, sort=[("seq", 1)])
+        seq = first_existing["seq"] - missing if first_existing else 0
+        if seq < 0:
+            collection.update_many({"device": device, "seq": {"$exists": True}}, {"$inc": {"seq": -seq}})
+            seq = 0
+
+    operations = []
+    migrated = 0
+    for reading in collection.find(query, {"_id": 1, "time": 1}).sort("_id", 1):
+        operations.append(UpdateOne(
+            {"_id": reading["_id"]},
+            {"$set": {"timestamp": parse_time(reading["time"]), "device": device, "seq": seq}}
+        ))
+        seq += 1
+        if len(operations) == BATCH_SIZE:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+    return migrated
+
+
+def migrate_sessions(collection):
+    """
+    Adds start_datetime and end_datetime to every session that has no start_datetime yet.
+
+    Returns:
+        int: The number of migrated sessions.
+    """
+    operations = [
+        UpdateOne(
+            {"_id": session["_id"]},
+            {"$set": {"start_datetime": parse_time(session["start_time"]), "end_datetime": parse_time(session["end_time"])}}
+        )
+        for session in collection.find({"start_datetime": {"$exists": False}}, {"start_time": 1, "end_time": 1})
+    ]
+    if not operations:
+        return 0
+    return collection.bulk_write(operations, ordered=False).modified_count
+
+
+def migrate_delete_useless_reads(collection):
+    """
+    Converts the "time" of the last cleaning run from the legacy string to a datetime.
+
+    Returns:
+        int: The number of migrated records.
+    """
+    migrated = 0
+    for record in collection.find({"time": {"$type": "string"}}):
+        collection.update_one({"_id": record["_id"]}, {"$set": {"time": parse_time(record["time"])}})
+        migrated += 1
+    return migrated
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Add native timestamps and sequence numbers to stored readings.")
+    parser.add_argument("--mongo", default="mongodb://db:27017", help="MongoDB connection string")
+    parser.add_argument("--device", default=DEFAULT_DEVICE, help="device name assigned to the migrated readings")
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo)
+    logging.info(f"migrate_timestamps < readings: {migrate_readings(client['Sensor_Data']['test_28_march'], args.device)} >")
+    logging.info(f"migrate_timestamps < sessions: {migrate_sessions(client['Sessions']['sessions'])} >")
+    logging.info(f"migrate_timestamps < delete_useless_reads: {migrate_delete_useless_reads(client['Sessions']['delete_useless_reads'])} >")
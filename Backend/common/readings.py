@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+
+# Legacy string format of the "time" field, still sent to the dashboard
+TIME_FORMAT = '%Y-%m-%d %I:%M:%S %p'
+
+# Name of the device writing the readings, used to scope the sequence number
+DEFAULT_DEVICE = "rotary"
+
+
+def format_time(timestamp):
+    """
+    Formats a datetime the way the "time" field of a reading and the session start_time/end_time are stored.
+
+    Args:
+        timestamp (datetime): The datetime to format.
+
+    Returns:
+        str: The formatted time, e.g. '2024-04-07 11:00:00 AM'.
+    """
+    return timestamp.strftime(TIME_FORMAT)
+
+
+def parse_time(value):
+    """
+    Parses a time string sent by the dashboard or stored by an older version of the rotary script.
+
+    Args:
+        value (str): The time string, e.g. '2024-04-07 11:00:00 AM'.
+
+    Returns:
+        datetime: The parsed datetime.
+    """
+    return datetime.strptime(value, TIME_FORMAT)
+
+
+def bucket_start(timestamp, seconds):
+    """
+    Returns the start of the bucket of the given length that contains timestamp.
+
+    Args:
+        timestamp (datetime): The time to look up.
+        seconds (int): The bucket length, a divisor of a day.
+
+    Returns:
+        datetime: The start of the bucket.
+    """
+    midnight = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    offset = int((timestamp - midnight).total_seconds()) // seconds * seconds
+    return midnight + timedelta(seconds=offset)
+
+
+def next_sequence(collection, device=DEFAULT_DEVICE):
+    """
+    Returns the sequence number that follows the last reading written by the given device.
+
+    Args:
+        collection (pymongo.collection.Collection): The sensor data collection.
+        device (str, optional): The device name. Defaults to DEFAULT_DEVICE.
+
+    Returns:
+        int: The next sequence number, 0 if the device has no readings yet.
+    """
+    latest = collection.find_one({"device": device, "seq": {"$exists": True}}, {"seq": 1}, sort=[("seq", -1)])
+    if latest is None:
+        return 0
+    return latest["seq"] + 1
@@ -0,0 +1,182 @@
+"""
+Multi-resolution rollups of the sensor readings.
+
+Every tier keeps one document per device and time bucket with the count and the sum, min and max of every
+reading field. The rotary script updates the tiers with $inc/$min/$max upserts after each write, so they are
+maintained incrementally, and the api reads the coarsest tier that still gives the requested number of points.
+
+Rebuilding the tiers from the raw readings (e.g. after the first deployment):
+    python -m common.rollups --mongo mongodb://db:27017 --rebuild
+"""
+import argparse
+import logging
+from collections import OrderedDict
+from datetime import datetime
+
+from pymongo import ASCENDING, MongoClient, UpdateOne
+
+from common.readings import DEFAULT_DEVICE, bucket_start, format_time
+
+# name of the tier and the length of its buckets in seconds, from the finest to the coarsest
+TIERS = OrderedDict([
+    ("1s", 1),
+    ("1m", 60),
+    ("1h", 3600),
+])
+
+ROLLUP_FIELDS = ['Barr_pulses', 'Gelcoat_pulses', 'Barrier_speedRPM', 'Gelcoat_speedRPM',
+                 'WaterLevel_1', 'WaterLevel_2', 'Pressure']
+
+# pulses are counts and are reported as the total of the bucket, the other fields as the mean
+SUMMED_FIELDS = {'Barr_pulses', 'Gelcoat_pulses'}
+
+REBUILD_BATCH_SIZE = 10000
+
+
+def rollup_collection(db, tier):
+    return db[f"rollup_{tier}"]
+
+
+def ensure_rollup_indexes(db):
+    for tier in TIERS:
+        rollup_collection(db, tier).create_index([("device", ASCENDING), ("start", ASCENDING)], unique=True)
+
+
+def rollup_operations(readings, seconds):
+    """
+    Builds one upsert per (device, bucket) that adds the given readings to the bucket.
+
+    Args:
+        readings (list): Reading documents with a "timestamp".
+        seconds (int): The bucket length of the tier.
+
+    Returns:
+        list: UpdateOne operations for bulk_write.
+    """
+    buckets = OrderedDict()
+    for reading in readings:
+        key = (reading.get("device", DEFAULT_DEVICE), bucket_start(reading["timestamp"], seconds))
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = {"count": 0, "sum": {}, "min": {}, "max": {}}
+        bucket["count"] += 1
+        for field in ROLLUP_FIELDS:
+            value = reading.get(field)
+            if value is None:
+                continue
+            bucket["sum"][field] = bucket["sum"].get(field, 0) + value
+            bucket["min"][field] = min(bucket["min"].get(field, value), value)
+            bucket["max"][field] = max(bucket["max"].get(field, value), value)
+
+    operations = []
+    for (device, start), bucket in buckets.items():
+        increments = {"count": bucket["count"]}
+        increments.update({f"sum.{field}": value for field, value in bucket["sum"].items()})
+        operations.append(UpdateOne(
+            {"device": device, "start": start},
+            {
+                "$inc": increments,
+                "$min": {f"min.{field}": value for field, value in bucket["min"].items()},
+                "$max": {f"max.{field}": value for field, value in bucket["max"].items()},
+            },
+            upsert=True
+        ))
+    return operations
+
+
+def update_rollups(db, readings):
+    """
+    Adds freshly written readings to every tier.
+
+    Args:
+        db (pymongo.database.Database): The sensor data database.
+        readings (list): The reading documents that were written.
+    """
+    if not readings:
+        return
+    for tier, seconds in TIERS.items():
+        rollup_collection(db, tier).bulk_write(rollup_operations(readings, seconds), ordered=False)
+
+
+def choose_tier(start_date, end_date, points):
+    """
+    Returns the coarsest tier that still gives at least the requested number of points over the range.
+
+    If even the finest tier gives fewer points, the finest tier is returned.
+    """
+    span = (end_date - start_date).total_seconds()
+    for tier, seconds in reversed(TIERS.items()):
+        if span / seconds >= points:
+            return tier
+    return next(iter(TIERS))
+
+
+def query_rollups(db, start_date, end_date, points, device=None):
+    """
+    Reads the rollups between two dates from the coarsest tier that still gives the requested number of points.
+
+    Args:
+        db (pymongo.database.Database): The sensor data database.
+        start_date (datetime): The start of the range.
+        end_date (datetime): The end of the range.
+        points (int): The requested number of points.
+        device (str, optional): Only return the rollups of this device. Defaults to all devices.
+
+    Returns:
+        tuple: The chosen tier and a list of points. Every point has the formatted "time" of its bucket, the "count"
+            of readings, the total of the pulses and the mean of the other fields, and the "min" and "max" of every field.
+    """
+    tier = choose_tier(start_date, end_date, points)
+    query = {"start": {"$gte": bucket_start(start_date, TIERS[tier]), "$lte": end_date}}
+    if device is not None:
+        query["device"] = device
+
+    output = []
+    for bucket in rollup_collection(db, tier).find(query, {"_id": 0}).sort("start", ASCENDING):
+        point = {"time": format_time(bucket["start"]), "count": bucket["count"]}
+        for field, total in bucket["sum"].items():
+            point[field] = total if field in SUMMED_FIELDS else total / bucket["count"]
+        point["min"] = bucket["min"]
+        point["max"] = bucket["max"]
+        output.append(point)
+    return tier, output
+
+
+def rebuild_rollups(db, collection):
+    """
+    Drops every tier and recomputes it from the raw readings.
+
+    Returns:
+        int: The number of readings rolled up.
+    """
+    for tier in TIERS:
+        rollup_collection(db, tier).delete_many({})
+    ensure_rollup_indexes(db)
+
+    projection = {field: 1 for field in ROLLUP_FIELDS}
+    projection.update({"_id": 0, "timestamp": 1, "device": 1})
+    batch = []
+    total = 0
+    for reading in collection.find({"timestamp": {"$exists": True}}, projection).sort("_id", ASCENDING):
+        batch.append(reading)
+        if len(batch) == REBUILD_BATCH_SIZE:
+            update_rollups(db, batch)
+            total += len(batch)
+            batch = []
+    update_rollups(db, batch)
+    return total + len(batch)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Maintain the rollups of the sensor readings.")
+    parser.add_argument("--mongo", default="mongodb://db:27017", help="MongoDB connection string")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every tier from the raw readings")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["Sensor_Data"]
+    if args.rebuild:
+        started = datetime.now()
+        logging.info(f"rebuild_rollups < readings: {rebuild_rollups(db, db['test_28_march'])}, duration: {datetime.now() - started} >")
+    else:
+        ensure_rollup_indexes(db)
@@ -0,0 +1,171 @@
+"""
+Indexes of the collections shared by the api and the agent.
+
+Both services call bootstrap_schema at startup. It creates every index declared in INDEXES (creating an index
+that already exists is a no-op) and explains the hot queries in HOT_QUERIES, logging a warning for every query
+that still scans a whole collection. The rollup and bucket collections keep their own declarations in
+common.rollups and common.buckets.
+
+Creating the indexes and checking the queries by hand:
+    python -m common.schema --mongo mongodb://db:27017 --explain
+"""
+import argparse
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from pymongo.errors import OperationFailure
+
+from common.buckets import BUCKET_COLLECTION, ensure_bucket_indexes
+from common.rollups import ensure_rollup_indexes
+
+SENSOR_DATA = ("Sensor_Data", "test_28_march")
+SESSIONS = ("Sessions", "sessions")
+PRODUCTS = ("Sessions", "products")
+ALERTS = ("Agent_Cycle_History", "alerts")
+NOMINAL_GELCOAT = ("Agent_Nominal_Values", "gelcoat")
+NOMINAL_BARRIER = ("Agent_Nominal_Values", "barrier")
+MAINTENANCE_PUMP = ("Agent_Maintenance", "maintenance_pump")
+MAINTENANCE_FILTER = ("Agent_Maintenance", "maintenance_filter")
+JOBS = ("Api", "jobs")
+
+
+def _running(field):
+    # only the readings where the pump runs are indexed, that is all the session detection ever looks at
+    return IndexModel([("_id", ASCENDING), (field, ASCENDING)], name=f"running_{field}",
+                      partialFilterExpression={field: {"$gt": 0}})
+
+
+INDEXES = {
+    SENSOR_DATA: [
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+        IndexModel([("device", ASCENDING), ("seq", ASCENDING)], name="device_seq"),
+        _running("Gelcoat_speedRPM"),
+        _running("Barrier_speedRPM"),
+    ],
+    SESSIONS: [
+        IndexModel([("id", ASCENDING)], name="id"),
+        IndexModel([("is_trash", ASCENDING), ("id", DESCENDING)], name="is_trash_id"),
+        IndexModel([("is_trash", ASCENDING), ("pump_type", ASCENDING), ("id", DESCENDING)], name="is_trash_pump_type_id"),
+        IndexModel([("pump_type", ASCENDING), ("_id", DESCENDING)], name="pump_type_id"),
+        IndexModel([("pump_type", ASCENDING), ("is_trash", ASCENDING), ("start_datetime", ASCENDING)],
+                   name="pump_type_is_trash_start"),
+        IndexModel([("start_datetime", ASCENDING)], name="start_datetime"),
+        IndexModel([("end_datetime", ASCENDING), ("start_datetime", ASCENDING)], name="end_start"),
+    ],
+    PRODUCTS: [
+        IndexModel([("id", ASCENDING)], name="id"),
+        IndexModel([("hide", ASCENDING), ("id", DESCENDING)], name="hide_id"),
+        # the products stored by older versions have no key until the next rebuild_products
+        IndexModel([("key", ASCENDING)], name="key", unique=True, partialFilterExpression={"key": {"$exists": True}}),
+    ],
+    ALERTS: [
+        # _id ascending keeps find_one({"message": ...}) returning the same alert as a collection scan
+        IndexModel([("message", ASCENDING), ("_id", ASCENDING)], name="message_id"),
+    ],
+    NOMINAL_GELCOAT: [IndexModel([("id", ASCENDING)], name="id")],
+    NOMINAL_BARRIER: [IndexModel([("id", ASCENDING)], name="id")],
+    MAINTENANCE_PUMP: [IndexModel([("pump_type", ASCENDING)], name="pump_type")],
+    MAINTENANCE_FILTER: [IndexModel([("pump_type", ASCENDING)], name="pump_type")],
+    JOBS: [
+        IndexModel([("submitted", DESCENDING)], name="submitted"),
+        IndexModel([("status", ASCENDING), ("host", ASCENDING)], name="status_host"),
+        # at most one queued or running job per key, across the api workers
+        IndexModel([("active_key", ASCENDING)], name="active_key", unique=True, sparse=True),
+    ],
+}
+
+# (name, collection, filter, sort) of the queries run on every request or agent cycle
+HOT_QUERIES = [
+    ("reading_by_timestamp", SENSOR_DATA, {"timestamp": {"$gte": 0}}, [("timestamp", ASCENDING)]),
+    ("next_sequence", SENSOR_DATA, {"device": "rotary", "seq": {"$exists": True}}, [("seq", DESCENDING)]),
+    ("running_gelcoat", SENSOR_DATA, {"Gelcoat_speedRPM": {"$gt": 0}, "_id": {"$gt": 0}}, [("_id", ASCENDING)]),
+    ("running_barrier", SENSOR_DATA, {"Barrier_speedRPM": {"$gt": 0}, "_id": {"$gt": 0}}, [("_id", ASCENDING)]),
+    ("running_pumps", SENSOR_DATA, {"$or": [{"Gelcoat_speedRPM": {"$gt": 0}}, {"Barrier_speedRPM": {"$gt": 0}}],
+                                    "_id": {"$gt": 0}}, [("_id", ASCENDING)]),
+    ("sessions_by_trash", SESSIONS, {"is_trash": 0}, [("id", DESCENDING)]),
+    ("sessions_page", SESSIONS, {"is_trash": 0, "pump_type": "gelcoat", "id": {"$lt": 0}}, [("id", DESCENDING)]),
+    ("session_by_id", SESSIONS, {"id": 0}, None),
+    ("sessions_by_pump", SESSIONS, {"pump_type": "gelcoat"}, [("_id", DESCENDING)]),
+    ("sessions_by_range", SESSIONS, {"pump_type": "gelcoat", "is_trash": 0, "start_datetime": {"$gte": 0}}, None),
+    ("sessions_overlapping", SESSIONS, {"end_datetime": {"$gte": 0}, "start_datetime": {"$lte": 0}},
+     [("end_datetime", ASCENDING)]),
+    ("sessions_since", SESSIONS, {"start_datetime": {"$gte": 0}}, [("id", DESCENDING)]),
+    ("products_shown", PRODUCTS, {"hide": 0}, [("id", DESCENDING)]),
+    ("products_page", PRODUCTS, {"hide": 0, "id": {"$lt": 0}}, [("id", DESCENDING)]),
+    ("product_by_id", PRODUCTS, {"id": 0}, None),
+    ("alert_by_message", ALERTS, {"message": ""}, None),
+    ("maintenance_pump", MAINTENANCE_PUMP, {"pump_type": "gelcoat"}, None),
+    ("maintenance_filter", MAINTENANCE_FILTER, {"pump_type": "gelcoat"}, None),
+]
+
+
+def ensure_indexes(client):
+    """
+    Creates the declared indexes that don't exist yet.
+
+    An index that conflicts with an existing one (same name or keys, other options) is logged and left as it is.
+    """
+    for (database, name), indexes in INDEXES.items():
+        try:
+            client[database][name].create_indexes(indexes)
+        except OperationFailure as e:
+            logging.error(f"ensure_indexes < collection: {database}.{name}, OperationFailure: {str(e)} >")
+    sensor_data = client[SENSOR_DATA[0]]
+    ensure_rollup_indexes(sensor_data)
+    ensure_bucket_indexes(sensor_data[BUCKET_COLLECTION])
+
+
+def _stages(plan):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _stages(child)
+
+
+def check_queries(client):
+    """
+    Explains the hot queries and logs a warning for every one whose winning plan is a collection scan.
+
+    Returns:
+        list: The names of the queries that scan a whole collection.
+    """
+    scans = []
+    for name, (database, collection), query, sort in HOT_QUERIES:
+        cursor = client[database][collection].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _stages(plan):
+            scans.append(name)
+            logging.warning(f"check_queries < COLLSCAN: {name}, collection: {database}.{collection}, filter: {query} >")
+    return scans
+
+
+def bootstrap_schema(client, explain=True):
+    """
+    Creates the indexes and checks the hot queries, called once at startup.
+
+    Errors are logged and not raised, a service must still start if the database is not reachable yet.
+    """
+    try:
+        ensure_indexes(client)
+        if explain:
+            check_queries(client)
+        logging.info("bootstrap_schema < Done >")
+    except Exception as e:
+        logging.error(f"bootstrap_schema < Exception: {str(e)} >")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    parser = argparse.ArgumentParser(description="Create the indexes of the shared collections.")
+    parser.add_argument("--mongo", default="mongodb://db:27017", help="MongoDB connection string")
+    parser.add_argument("--explain", action="store_true", help="also explain the hot queries and report collection scans")
+    args = parser.parse_args()
+
+    mongo = MongoClient(args.mongo)
+    ensure_indexes(mongo)
+    if args.explain:
+        logging.info(f"check_queries < COLLSCAN: {check_queries(mongo) or 'none'} >")
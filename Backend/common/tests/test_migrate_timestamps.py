@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+
+from common import migrate_timestamps
+from common.readings import format_time
+
+T0 = datetime(2024, 4, 7, 11, 0)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    monkeypatch.setattr(migrate_timestamps, "BATCH_SIZE", 4)
+    return mongomock.MongoClient().Sensor_Data.test_28_march
+
+
+def add_legacy_readings(collection, count):
+    # ten readings per second share the legacy "time", so the seconds span the batch boundaries
+    collection.insert_many([{"time": format_time(T0 + timedelta(seconds=i // 10))} for i in range(count)])
+
+
+def assert_ordered(collection):
+    readings = list(collection.find().sort("_id", 1))
+    keys = [(reading["timestamp"], reading["seq"]) for reading in readings]
+    assert keys == sorted(keys)
+    assert len({reading["seq"] for reading in readings}) == len(readings)
+    assert min(reading["seq"] for reading in readings) >= 0
+
+
+def test_duplicate_timestamps_across_batches(collection):
+    add_legacy_readings(collection, 25)
+    assert migrate_timestamps.migrate_readings(collection) == 25
+    assert [reading["seq"] for reading in collection.find().sort("_id", 1)] == list(range(25))
+    assert_ordered(collection)
+
+
+def test_readings_before_the_ones_of_the_device(collection):
+    add_legacy_readings(collection, 25)
+    collection.insert_many([{"time": format_time(T0 + timedelta(seconds=2)), "timestamp": T0 + timedelta(seconds=2),
+                             "device": "rotary", "seq": seq} for seq in range(3)])
+    assert migrate_timestamps.migrate_readings(collection) == 25
+    assert_ordered(collection)
+
+
+def test_interrupted_migration_continues_the_sequence(collection, monkeypatch):
+    add_legacy_readings(collection, 25)
+    bulk_write = collection.bulk_write
+    batches = []
+
+    def interrupted(operations, ordered=True):
+        if len(batches) == 2:
+            raise RuntimeError("interrupted")
+        batches.append(operations)
+        return bulk_write(operations, ordered=ordered)
+
+    monkeypatch.setattr(collection, "bulk_write", interrupted)
+    with pytest.raises(RuntimeError):
+        migrate_timestamps.migrate_readings(collection)
+    monkeypatch.setattr(collection, "bulk_write", bulk_write)
+
+    assert migrate_timestamps.migrate_readings(collection) == 17
+    assert_ordered(collection)
@@ -0,0 +1,39 @@
+"""
+Versions of the data served by the cached api endpoints (see api/cache.py).
+
+A version is a token per name in Api.versions that is replaced after every write to the data of that name, by
+the api or by the agent. The api workers and the agent share them through MongoDB. Random tokens rather than
+counters, so a version that was deleted can't come back to a value that is still cached.
+"""
+import uuid
+
+VERSIONS = ("Api", "versions")
+
+SESSIONS_VERSION = "sessions"
+PRODUCTS_VERSION = "products"
+NOMINAL_VERSION = "nominal"
+ALERTS_VERSION = "alerts"
+MAINTENANCE_VERSION = "maintenance"
+
+
+def bump_versions(collection, *names):
+    """
+    Gives the named data a new version, called after writing to it.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection of the versions, VERSIONS.
+        names (str): The names of the data written, e.g. SESSIONS_VERSION.
+    """
+    for name in names:
+        collection.update_one({"_id": name}, {"$set": {"token": uuid.uuid4().hex}}, upsert=True)
+
+
+def read_versions(collection, names):
+    """
+    Returns the versions of the named data, in the order of names, "" for data that was never written.
+
+    The versions are read again on every call, one find on the _id index: a token kept in memory would let an
+    api worker answer with a body cached before a write made by another worker.
+    """
+    tokens = {version["_id"]: version["token"] for version in collection.find({"_id": {"$in": list(names)}})}
+    return tuple(tokens.get(name, "") for name in names)
@@ -0,0 +1,53 @@
+class ADC_mcp3004:
+    """
+    Driver for an MCP3004/MCP3008 ADC that owns one SPI file descriptor and reads a list of channels in one burst.
+
+    The MCP300x needs chip select to be released after every conversion, so a burst is a run of back-to-back
+    3-byte transfers on the already open device, using command frames built once in the constructor. xfer2
+    writes the received bytes into the list it is given, so every transfer is sent a copy of the frame.
+
+    Args:
+        channels (iterable): The channels returned by read(), in that order.
+        oversample (int, optional): Number of conversions averaged per channel. Defaults to 1.
+        bus (int, optional): The SPI bus. Defaults to 0.
+        device (int, optional): The SPI chip select. Defaults to 1.
+        max_speed_hz (int, optional): The SPI clock. Defaults to 50000.
+        spi (object, optional): An SpiDev-like object, opened by the caller. Defaults to a new spidev.SpiDev.
+    """
+
+    def __init__(self, channels, oversample=1, bus=0, device=1, max_speed_hz=50000, spi=None):
+        self.channels = tuple(channels)
+        self.oversample = oversample
+        self.bus, self.device = bus, device
+        if spi is None:
+            import spidev
+            spi = spidev.SpiDev()
+            spi.open(bus, device)
+        self.spi = spi
+        self.spi.max_speed_hz = max_speed_hz
+        self.spi.mode = 1
+        self._frames = [[1, (8 + channel) << 4, 0] for channel in self.channels]
+
+    def get_adc(self, channel):
+        adc = self.spi.xfer2([1, (8 + channel) << 4, 0])
+        return ((adc[1] & 3) << 8) + adc[2]
+
+    def read(self):
+        """
+        Reads every configured channel, oversample times each, interleaving the channels.
+
+        Returns:
+            list: The averaged raw value (0-1023) of each channel, in the order of self.channels.
+        """
+        totals = [0] * len(self._frames)
+        xfer2 = self.spi.xfer2
+        for _ in range(self.oversample):
+            for i, frame in enumerate(self._frames):
+                adc = xfer2(list(frame))
+                totals[i] += ((adc[1] & 3) << 8) + adc[2]
+        if self.oversample == 1:
+            return totals
+        return [total / self.oversample for total in totals]
+
+    def close(self):
+        self.spi.close()
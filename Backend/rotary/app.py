@@ -1,59 +1,69 @@
-import RPi.GPIO as GPIO
+import argparse
+import logging
+import threading
 import time
 import os
-import spidev
+import sys
 # import pymysql
 import pymongo
-from datetime import datetime
-
-try:
-    client = pymongo.MongoClient("mongodb://127.0.0.1:27017")
-    db = client["Sensor_Data"]
-    collection = db["test_28_march"]
-except:
-    print("*"*100)
-    print("*"*100)
-    print("*"*100)
-    print("ROTARY SCRIPT CANNOT CONNECT TO MONGODB")
-    print("*"*100)
-    print("*"*100)
-    print("*"*100)
-
-actualt = 0
-ltime = 0
-eltime = 0
-lastVal1 = 0
-lastVal2 = 0
-volume = 0
-startTime = time.time()
-debug = 0
-
-
-class ADC_mcp3004:
-    def __init__(self, bus=0, device=1):
-        self.bus, self.device = bus, device
-        self.spi = spidev.SpiDev()
-        self.spi.open(0, 1)
-        self.spi.max_speed_hz = 50000
-        self.spi.mode = 1
-
-    def open(self):
-        self.spi.open(self.bus, self.device)
-        self.spi.max_speed_hz = 50000
+from writer import BucketWriter, BufferedWriter
+from scheduler import DeadlineScheduler
+from encoder import PULSES_PER_REVOLUTION, Rotary
+from adc import ADC_mcp3004
+from pipeline import DROP_OLDEST, PersistenceWorker, Sample, SampleQueue
+from metrics import LATENCY_BOUNDS_MS, Metrics, MetricsServer, period_bounds_ms
+import hardware
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.readings import DEFAULT_DEVICE, format_time, next_sequence
+from common.rollups import ensure_rollup_indexes, update_rollups
+from common.buckets import (BUCKET_COLLECTION, LAYOUT_BUCKETS, LAYOUT_DOCUMENTS, STORAGE_LAYOUT, bucket_operations,
+                            ensure_bucket_indexes, next_bucket_sequence)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    filename="rotary_logs.log",
+)
+
+# ! Frequency of data saving, the agent and the api assume PER_SECONDS_READS = SAMPLE_RATE_HZ
+SAMPLE_RATE_HZ = 10
+
+# encoder pins (BCM numbering)
+BARRIER_PINS = (19, 26)
+GELCOAT_PINS = (20, 21)
+
+# ADC channels read in one burst: water level 2, water level 1, pressure sensor
+ADC_CHANNELS = (3, 0, 2)
+ADC_OVERSAMPLE = 4
+
+# ! Buffered writes: documents are sent with insert_many every WRITER_FLUSH_SIZE reads or WRITER_FLUSH_INTERVAL seconds
+WRITER_FLUSH_SIZE = 20
+WRITER_FLUSH_INTERVAL = 1.0  # (SECOND)
+WRITER_MAX_BUFFER = 36000  # one hour of reads at 10 reads per second
+
+# metrics are served as JSON on http://127.0.0.1:METRICS_PORT/metrics and summarised to the log
+METRICS_PORT = 9108
+METRICS_REPORT_INTERVAL = 60  # (SECOND)
+
+# samples waiting between the sampling thread and the persistence worker, the oldest are dropped when full
+QUEUE_MAX_LENGTH = 600  # one minute of reads at 10 reads per second
+QUEUE_DROP_POLICY = DROP_OLDEST
+
+# the readings and their rollups (common/rollups.py) are kept in the same database
+SENSOR_DATA_DB = "Sensor_Data"
+SENSOR_DATA_COLLECTION = "test_28_march"
 
-    def get_adc(self, channel):
-        adc = self.spi.xfer2([1, (8 + channel) << 4, 0])
-        adc_out = ((adc[1] & 3) << 8) + adc[2]
-        voltage = (adc_out*3.3)/(1023)
-        return adc_out
-
-    def close(self):
-        self.spi.close()
+debug = 0
 
 
-def mongoconnect(Barr_pulses, Gelcoat_pulses, Barrier_speedRPM, Gelcoat_speedRPM, WaterLevel_1, WaterLevel_2, Pressure):
+def mongoconnect(writer, timestamp, seq, Barr_pulses, Gelcoat_pulses, Barrier_speedRPM, Gelcoat_speedRPM, WaterLevel_1, WaterLevel_2, Pressure):
     data = {
-        "time": datetime.now().strftime('%Y-%m-%d %I:%M:%S %p'),
+        "time": format_time(timestamp),
+        "timestamp": timestamp,
+        "device": DEFAULT_DEVICE,
+        "seq": seq,
         "Barr_pulses": Barr_pulses,
         "Gelcoat_pulses": Gelcoat_pulses,
         "Barrier_speedRPM": Barrier_speedRPM,
@@ -62,14 +72,12 @@ def mongoconnect(Barr_pulses, Gelcoat_pulses, Barrier_speedRPM, Gelcoat_speedRPM
         "WaterLevel_2": WaterLevel_2,
         "Pressure": Pressure
     }
-    collection.insert_one(data)
+    writer.add(data)
 
 
 def WaterLevel1m(adcVal):
     voltage1 = (adcVal/1023 * 5)
     meter1 = abs((voltage1-1)/4)
-    # print(meter1)
-    # meter_1=str.format(meter1)
     meter1 = round(meter1, 2)
     return meter1
 
@@ -77,7 +85,6 @@ def WaterLevel1m(adcVal):
 def WaterLevel2m(adcVal):
     voltage2 = (adcVal/1023 * 5)
     meter2 = (voltage2-1)/2
-# meter_2=str.format(meter2)
     meter2 = round(meter2, 2)
     return meter2
 
@@ -86,159 +93,259 @@ def PreSureVal(adcVal):
     voltage3 = (adcVal/1023 * 5)
     preSureraw = abs((voltage3-0.5)/4)
     pressure = 0.8*preSureraw
-    # pressure1=str.format(pressure)
     pressure = round(pressure, 2)
     return pressure
 
 
-sensor1 = ADC_mcp3004()
-sensor2 = ADC_mcp3004()
-sensor3 = ADC_mcp3004()
-
-
-class Rotary:
-
-    def __init__(self, Apin, Bpin, callback=None):
-        self.Apin = Apin
-        self.Bpin = Bpin
-        self.value = 0
-        self.state = '00'
-        self.direction = None
-        self.startt = 0
-        self.eltime = 0
-        self.dtime = 0
-        self.rpm = 0
-        self.callback = callback
-        GPIO.setup(self.Apin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.Bpin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(self.Apin, GPIO.BOTH,
-                              callback=self.transitionOccurred)
-        GPIO.add_event_detect(self.Bpin, GPIO.BOTH,
-                              callback=self.transitionOccurred)
-
-    def transitionOccurred(self, channel):
-        p1 = GPIO.input(self.Apin)
-        p2 = GPIO.input(self.Bpin)
-        newState = "{}{}".format(p1, p2)
-        self.startt = time.process_time()
-
-        if self.state == "00":  # Resting position
-            if newState == "01":  # Turned right 1
-                self.direction = "CW"
-            elif newState == "10":  # Turned left 1
-                self.direction = "L"
-
-        elif self.state == "01":  # R1 or L3 position
-            if newState == "11":  # Turned right 1
-                self.direction = "CW"
-            elif newState == "00":  # Turned left 1
-                if self.direction == "CCW":
-                    self.value = self.value - 1
-                    self.dtime = time.process_time()-self.startt
-                    self.rpm = (0.0157 * self.value)/self.dtime
-                    if self.callback is not None:
-                        self.callback(self.value, self.direction)
-
-        elif self.state == "10":  # R3 or L1
-            if newState == "11":  # Turned left 1
-                self.direction = "CCW"
-            elif newState == "00":  # Turned right 1
-                if self.direction == "CW":
-                    self.value = self.value + 1
-                    self.dtime = time.process_time()-self.startt
-
-                    self.rpm = (0.0157 * self.value)/self.dtime
-                    if self.callback is not None:
-                        self.callback(self.value, self.direction)
-
-        else:  # self.state == "11"
-            if newState == "01":  # Turned left 1
-                self.direction = "CCW"
-            elif newState == "10":  # Turned right 1
-                self.direction = "CW"
-            elif newState == "00":  # Skipped an intermediate 01 or 10 state, but if we know direction then a turn is complete
-                if self.direction == "CCW":
-                    self.value = self.value - 1
-                    self.dtime = time.process_time()-self.startt
-                    self.rpm = (0.0157 * self.value)/self.dtime
-                    if self.callback is not None:
-                        self.callback(self.value, self.direction)
-                elif self.direction == "R":
-                    self.value = self.value + 1
-                    self.dtime = time.process_time()-self.startt
-                    self.rpm = (0.0157 * self.value)/self.dtime
-                    if self.callback is not None:
-                        self.callback(self.value, self.direction)
-        self.state = newState
-
-    def getValue(self):
-        return self.value
-
-    def getrpm(self):
-        return self.rpm
-
-
 def valueChanged(value, direction):
     if (debug == 1):
         print("* countPos: {}, Direction: {} ".format(value, direction))
 
 
-GPIO.setmode(GPIO.BCM)
-#  GPIO.setup (17, GPIO.IN ,pull_up_down=GPIO.PUD_UP)
-#  GPIO.setup (27, GPIO.IN ,pull_up_down=GPIO.PUD_UP)
-e1 = Rotary(19, 26, valueChanged)  # barrier
-e2 = Rotary(20, 21, valueChanged)  # gelcoat
-prevTime = 0
-# e2=Rotary(20,21,valueChanged)
-try:
-    while True:
-        # ! Frequency of data saving
-        time.sleep(1)
+def connect_database(uri, latency=0.0):
+    """
+    Returns the sensor data database, or an in-memory stand-in if uri is "memory".
+    """
+    if uri == "memory":
+        return hardware.MemoryDatabase(latency)
+    try:
+        client = pymongo.MongoClient(uri)
+        return client[SENSOR_DATA_DB]
+    except:
+        print("*"*100)
+        print("*"*100)
+        print("*"*100)
+        print("ROTARY SCRIPT CANNOT CONNECT TO MONGODB")
+        print("*"*100)
+        print("*"*100)
+        print("*"*100)
+        raise
+
+
+def run(gpio, adc, db, clock, rate_hz=SAMPLE_RATE_HZ, duration=None, quiet=False, rollups=True,
+        layout=STORAGE_LAYOUT, metrics=None):
+    """
+    Samples the encoders and the ADC at rate_hz and writes one document per sample.
+
+    Sampling runs on a dedicated thread that only queues raw Sample records; a PersistenceWorker converts,
+    prints and hands them to the writer, so neither the console nor the database can delay a sample.
+
+    Args:
+        gpio (module): RPi.GPIO or a simulated stand-in.
+        adc (ADC_mcp3004): The ADC driver.
+        db (pymongo.database.Database): The sensor data database, or a stand-in.
+        clock (hardware.Clock): The time source.
+        rate_hz (float, optional): Number of samples per second. Defaults to SAMPLE_RATE_HZ.
+        duration (float, optional): Stop after this many seconds (of clock time). Defaults to running until interrupted.
+        quiet (bool, optional): Don't print every sample. Defaults to False.
+        rollups (bool, optional): Update the rollup collections after every flush. Defaults to True.
+        layout (str, optional): "documents" writes one document per sample, "buckets" one document per minute
+            (see common/buckets.py). Defaults to the SENSOR_STORAGE_LAYOUT environment variable.
+        metrics (metrics.Metrics, optional): Registry the ingest metrics are added to. Defaults to a new one.
+
+    Returns:
+        tuple: The writer, the scheduler and the sample queue, for their statistics.
+    """
+    metrics = Metrics() if metrics is None else metrics
+    on_flush = None
+    if rollups:
+        ensure_rollup_indexes(db)
+        on_flush = lambda documents: update_rollups(db, documents)
+    options = dict(flush_size=WRITER_FLUSH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL,
+                   max_buffer=WRITER_MAX_BUFFER, on_flush=on_flush,
+                   latency_histogram=metrics.histogram("flush_latency_ms", LATENCY_BOUNDS_MS))
+    if layout == LAYOUT_BUCKETS:
+        collection = db[BUCKET_COLLECTION]
+        ensure_bucket_indexes(collection)
+        writer = BucketWriter(collection, bucket_operations, **options).start()
+        seq = next_bucket_sequence(collection, DEFAULT_DEVICE)
+    else:
+        collection = db[SENSOR_DATA_COLLECTION]
+        writer = BufferedWriter(collection, **options).start()
+        seq = next_sequence(collection, DEFAULT_DEVICE)
+
+    gpio.setmode(gpio.BCM)
+    e1 = Rotary(*BARRIER_PINS, valueChanged, gpio=gpio, clock=clock.monotonic)  # barrier
+    e2 = Rotary(*GELCOAT_PINS, valueChanged, gpio=gpio, clock=clock.monotonic)  # gelcoat
+    scheduler = DeadlineScheduler(rate_hz, clock=clock.monotonic, sleep=clock.sleep)
+    queue = SampleQueue(QUEUE_MAX_LENGTH, QUEUE_DROP_POLICY)
+    worker = PersistenceWorker(queue, lambda record: persist(record, writer, quiet)).start()
+    stop = threading.Event()
+    failures = []
+    period = metrics.histogram("loop_period_ms", period_bounds_ms(rate_hz))
+    adc_latency = metrics.histogram("adc_read_latency_ms", LATENCY_BOUNDS_MS)
+    metrics.register("scheduler", scheduler.stats)
+    metrics.register("barrier_edges_per_second", lambda: round(e1.edges_per_second(), 1))
+    metrics.register("gelcoat_edges_per_second", lambda: round(e2.edges_per_second(), 1))
+    metrics.register("queue", queue.stats)
+    metrics.register("worker", worker.stats)
+    metrics.register("writer", writer.stats)
+
+    def sampling():
+        try:
+            sample(e1, e2, adc, scheduler, clock, queue, seq, stop, duration, period, adc_latency)
+        except BaseException as e:
+            failures.append(e)
+
+    sampler = threading.Thread(target=sampling, name="sampler", daemon=True)
+    lastReport = clock.monotonic()
+    try:
+        sampler.start()
+        while sampler.is_alive():
+            sampler.join(timeout=1)
+            if clock.monotonic() - lastReport >= METRICS_REPORT_INTERVAL:
+                logging.info(f"metrics < {metrics.summary()} >")
+                lastReport = clock.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        sampler.join()
+        worker.stop()
+        writer.close()
+        logging.info(f"metrics < {metrics.summary()} >")
+    if failures:
+        raise failures[0]
+    return writer, scheduler, queue
+
+
+def sample(e1, e2, adc, scheduler, clock, queue, seq, stop, duration=None, period=None, adc_latency=None):
+    """
+    Timing-critical sampling loop, run on its own thread: on every deadline it reads the pulse counters and
+    the ADC and queues the raw values as a Sample, everything else is left to the persistence worker.
+    The measured loop period and ADC read time are observed in the period and adc_latency histograms (in ms).
+    """
+    lastVal1 = e1.getValue()
+    lastVal2 = e2.getValue()
+    scheduler.start()
+    end = None if duration is None else clock.monotonic() + duration
+    while not stop.is_set() and (end is None or clock.monotonic() < end):
+        # ! Frequency of data saving, interval is the measured time since the previous read
+        interval = scheduler.wait()
         newVal1 = e1.getValue()
         newVal2 = e2.getValue()
-        time1 = time.time()-startTime
-        # newVal2=e2.getValue()
-        # if (newVal1>newVal2):
-        #     print("rot 1")
-        # else:
-        #     print("rot2")
-    #  pos=newVal1
-        #  is Running
-        value1 = sensor1.get_adc(channel=3)  # water level 2
-        value2 = sensor2.get_adc(channel=0)  # water level 1
-        value3 = sensor3.get_adc(channel=2)  # pressure sensor
-        w1 = WaterLevel1m(value2)
-
-        w2 = WaterLevel2m(value1)
-        p1 = PreSureVal(value3)
-        if (w1 < 0):
-            w1 = abs(w1)
-        if (w2 < 0):
-            w2 = abs(w2)
-        if (p1 < 0):
-            p1 = abs(p1)
-        dif1 = abs(newVal1-lastVal1)
-        dif2 = abs(newVal2-lastVal2)
-        rpmBarrier = (dif1 * 60)/400
-        rpmGelcoat = (dif2 * 60)/400
-        print("Barrier pulses:", dif1, "Gelcoat pulses:", dif2, "Barrier speed:",
-              rpmBarrier, "Gelcoat speed:", rpmGelcoat, "w1:", w1, "w2:", w2, "p:", p1)
-        water1 = abs(w1)
-        water2 = abs(w2)
-        p = abs(p1)
-        mongoconnect(dif1, dif2, rpmBarrier, rpmGelcoat, water1, water2, p)
-    #  mysqlconnect(dif1,dif2,rpmBarrier,rpmGelcoat,water1,water2,p)
-        # print(time1-prevTime)
-        # print ("rpm:",rpm)
-        #  volume=volume+ newVal1/10
-    #   print("volume is:",volume)
-        #  IS not running
-
-        # print("rpm:",rpm)
+        sampleTime = clock.now()
+        adcStart = time.perf_counter()
+        raw = adc.read()  # water level 2, water level 1, pressure sensor
+        if period is not None:
+            period.observe(interval * 1000)
+            adc_latency.observe((time.perf_counter() - adcStart) * 1000)
+        queue.put(Sample(sampleTime, seq, interval, abs(newVal1-lastVal1), abs(newVal2-lastVal2), raw))
+        seq += 1
         lastVal1 = newVal1
         lastVal2 = newVal2
-        # prevTime=time1
-        # pos=0
-except KeyboardInterrupt:
-    pass
-GPIO.cleanup()
+
+
+def persist(record, writer, quiet=False):
+    """
+    Converts a raw Sample to physical units, prints it and hands the document to the writer.
+    """
+    value1, value2, value3 = record.adc
+    w1 = WaterLevel1m(value2)
+
+    w2 = WaterLevel2m(value1)
+    p1 = PreSureVal(value3)
+    if (w1 < 0):
+        w1 = abs(w1)
+    if (w2 < 0):
+        w2 = abs(w2)
+    if (p1 < 0):
+        p1 = abs(p1)
+    dif1 = record.barrier_pulses
+    dif2 = record.gelcoat_pulses
+    rpmBarrier = (dif1 * 60)/(PULSES_PER_REVOLUTION * record.interval)
+    rpmGelcoat = (dif2 * 60)/(PULSES_PER_REVOLUTION * record.interval)
+    if not quiet:
+        print("Barrier pulses:", dif1, "Gelcoat pulses:", dif2, "Barrier speed:",
+              rpmBarrier, "Gelcoat speed:", rpmGelcoat, "w1:", w1, "w2:", w2, "p:", p1)
+    water1 = abs(w1)
+    water2 = abs(w2)
+    p = abs(p1)
+    mongoconnect(writer, record.timestamp, record.seq, dif1, dif2, rpmBarrier, rpmGelcoat, water1, water2, p)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the rotary encoders and the ADC sensors to MongoDB.")
+    parser.add_argument("--backend", choices=["gpio", "sim"], default="gpio",
+                        help="gpio reads the Raspberry Pi hardware, sim replays recorded or synthetic traces")
+    parser.add_argument("--mongo", default="mongodb://127.0.0.1:27017",
+                        help='MongoDB connection string, or "memory" for an in-memory stand-in')
+    parser.add_argument("--db-latency", type=float, default=0.0,
+                        help="milliseconds added to every write of the in-memory stand-in")
+    parser.add_argument("--rate", type=float, default=SAMPLE_RATE_HZ, help="samples per second")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run, default runs until interrupted")
+    parser.add_argument("--quiet", action="store_true", help="don't print every sample")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="port of the local JSON metrics endpoint, 0 disables it")
+    parser.add_argument("--no-rollups", action="store_true", help="don't update the rollup collections")
+    parser.add_argument("--layout", choices=[LAYOUT_DOCUMENTS, LAYOUT_BUCKETS], default=STORAGE_LAYOUT,
+                        help="storage layout of the readings, defaults to $SENSOR_STORAGE_LAYOUT or documents")
+    simulation = parser.add_argument_group("simulated backend")
+    simulation.add_argument("--speed", type=float, default=1.0, help="replay speed, 10 replays ten seconds per second")
+    simulation.add_argument("--edges", help="recorded edge trace (CSV t,pin,level), replaces the synthetic encoders")
+    simulation.add_argument("--adc", help="recorded ADC trace (CSV t,channel,value), replaces the synthetic signals")
+    simulation.add_argument("--barrier-rpm", type=float, default=60.0, help="speed of the synthetic barrier pump")
+    simulation.add_argument("--gelcoat-rpm", type=float, default=90.0, help="speed of the synthetic gelcoat pump")
+    simulation.add_argument("--on", type=float, default=None, help="seconds each synthetic pump runs before stopping")
+    simulation.add_argument("--off", type=float, default=0.0, help="seconds each synthetic pump stays off")
+    args = parser.parse_args()
+
+    simulated = args.backend == "sim"
+    clock = hardware.Clock(args.speed if simulated else 1.0)
+    gpio, spi = hardware.open_backend(args.backend, clock, args.adc)
+    adc = ADC_mcp3004(ADC_CHANNELS, oversample=ADC_OVERSAMPLE, spi=spi)
+    db = connect_database(args.mongo, args.db_latency / 1000)
+
+    replayer = None
+    if simulated:
+        # the replay needs a bound, without --duration it stops after a day of traces
+        horizon = args.duration if args.duration is not None else 24 * 3600
+        if args.edges:
+            streams = [hardware.read_edge_trace(args.edges)]
+        else:
+            streams = [
+                hardware.SyntheticEncoder(*BARRIER_PINS, args.barrier_rpm, args.on, args.off).edges(horizon),
+                hardware.SyntheticEncoder(*GELCOAT_PINS, args.gelcoat_rpm, args.on, args.off,
+                                          offset=(args.on or 0) + args.off).edges(horizon),
+            ]
+        replayer = hardware.EdgeReplayer(gpio, streams, clock)
+
+    metrics = Metrics()
+    server = MetricsServer(metrics, args.metrics_port).start() if args.metrics_port else None
+    if replayer is not None:
+        metrics.register("replay", replayer.stats)
+
+    started = time.monotonic()
+    try:
+        if replayer is not None:
+            replayer.start()
+        writer, scheduler, queue = run(gpio, adc, db, clock, args.rate, args.duration, args.quiet,
+                                       not args.no_rollups, args.layout, metrics)
+    finally:
+        if replayer is not None:
+            replayer.stop()
+        if server is not None:
+            server.stop()
+        adc.close()
+        gpio.cleanup()
+
+    if simulated:
+        wall = time.monotonic() - started
+        writer_stats = writer.stats()
+        print("Benchmark:", {
+            "wall_seconds": round(wall, 2),
+            "simulated_seconds": round(wall * args.speed, 2),
+            "samples_per_second": round(scheduler.ticks / wall, 1) if wall > 0 else 0.0,
+            "written": writer_stats["written"],
+            "dropped": writer_stats["dropped"],
+            "avg_flush_latency_ms": writer_stats["avg_flush_latency_ms"],
+            "max_flush_latency_ms": writer_stats["max_flush_latency_ms"],
+            "overruns": scheduler.overruns,
+            "queue_dropped": queue.dropped,
+            "queue_high_watermark": queue.high_watermark,
+            **replayer.stats(),
+        })
+
+
+if __name__ == '__main__':
+    main()
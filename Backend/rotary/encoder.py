@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+
+PULSES_PER_REVOLUTION = 400
+EDGES_PER_PULSE = 4
+EDGE_BUFFER_SIZE = 4096
+# if no edge is seen for this long the instantaneous speed is reported as zero
+STOPPED_AFTER = 1.0  # (SECOND)
+
+# Quarter steps for every transition, indexed by (previous_state << 2) | new_state where state = (A << 1) | B.
+# A clockwise turn goes 00 -> 01 -> 11 -> 10 -> 00. SKIPPED marks a transition where both pins changed,
+# meaning one state was missed; it is counted as two steps in the last known direction.
+SKIPPED = 2
+QUARTER_STEPS = (
+    0, 1, -1, SKIPPED,
+    -1, 0, SKIPPED, 1,
+    1, SKIPPED, 0, -1,
+    SKIPPED, -1, 1, 0,
+)
+
+
+class Rotary:
+    """
+    Quadrature decoder for a rotary encoder connected to two GPIO pins.
+
+    Every edge is decoded with a lookup table on the integer state of both pins. The count of full pulses,
+    the number of decoded edges and a ring buffer of (monotonic timestamp, total edges before the step) pairs
+    are updated under a lock, so the sampling loop can read them at any time while the GPIO callback thread
+    keeps running.
+
+    A pulse is counted once the steps moved a full cycle of EDGES_PER_PULSE away from the last counted
+    boundary, so contact chatter around a boundary doesn't count phantom pulses.
+
+    Args:
+        Apin (int): The BCM number of the A pin.
+        Bpin (int): The BCM number of the B pin.
+        callback (callable, optional): Called with (value, direction) every time the pulse count changes. Defaults to None.
+        gpio (module, optional): The GPIO module. Defaults to RPi.GPIO.
+        clock (callable, optional): Monotonic clock returning seconds. Defaults to time.monotonic.
+    """
+
+    def __init__(self, Apin, Bpin, callback=None, gpio=None, clock=time.monotonic):
+        if gpio is None:
+            import RPi.GPIO as gpio
+        self.gpio = gpio
+        self.Apin = Apin
+        self.Bpin = Bpin
+        self.callback = callback
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._steps = 0
+        # steps at the last counted pulse boundary
+        self._boundary = 0
+        self._edges = 0
+        self._direction = 0
+        self._timestamps = deque(maxlen=EDGE_BUFFER_SIZE)
+        self.value = 0
+        self.direction = None
+
+        gpio.setup(self.Apin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        gpio.setup(self.Bpin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        self.state = (gpio.input(self.Apin) << 1) | gpio.input(self.Bpin)
+        gpio.add_event_detect(self.Apin, gpio.BOTH,
+                              callback=self.transitionOccurred)
+        gpio.add_event_detect(self.Bpin, gpio.BOTH,
+                              callback=self.transitionOccurred)
+
+    def transitionOccurred(self, channel):
+        newState = (self.gpio.input(self.Apin) << 1) | self.gpio.input(self.Bpin)
+        timestamp = self.clock()
+
+        with self._lock:
+            step = QUARTER_STEPS[(self.state << 2) | newState]
+            self.state = newState
+            if not step:
+                return
+            if step == SKIPPED:
+                if not self._direction:
+                    return
+                step = 2 * self._direction
+            self._direction = 1 if step > 0 else -1
+            self._timestamps.append((timestamp, self._edges))
+            self._steps += step
+            self._edges += abs(step)
+            self.direction = "CW" if step > 0 else "CCW"
+            changed = abs(self._steps - self._boundary) >= EDGES_PER_PULSE
+            if changed:
+                self._boundary += self._direction * EDGES_PER_PULSE
+                self.value += self._direction
+            value = self.value
+
+        if changed and self.callback is not None:
+            self.callback(value, self.direction)
+
+    def getValue(self):
+        with self._lock:
+            return self.value
+
+    def snapshot(self):
+        """
+        Reads the counters in one atomic step.
+
+        Returns:
+            tuple: (value, edges, last_edge_time) where value is the signed count of full pulses, edges the total
+                number of decoded edges and last_edge_time the monotonic time of the last edge (None if none yet).
+        """
+        with self._lock:
+            return self.value, self._edges, self._timestamps[-1][0] if self._timestamps else None
+
+    def instantaneous_rpm(self, now=None):
+        """
+        Returns the speed derived from the interval between the last two edges.
+        """
+        now = self.clock() if now is None else now
+        with self._lock:
+            if len(self._timestamps) < 2 or now - self._timestamps[-1][0] > STOPPED_AFTER:
+                return 0.0
+            (previous_time, _), (last_time, last_edges) = self._timestamps[-2], self._timestamps[-1]
+            step_edges = self._edges - last_edges
+        interval = last_time - previous_time
+        if interval <= 0:
+            return 0.0
+        return step_edges * 60.0 / (PULSES_PER_REVOLUTION * EDGES_PER_PULSE * interval)
+
+    def edges_per_second(self, window=1.0, now=None):
+        """
+        Returns the number of edges seen during the last window seconds, per second.
+        """
+        now = self.clock() if now is None else now
+        since = now - window
+        edges = 0
+        with self._lock:
+            # the ring buffer holds (timestamp, total edges before the step), so the edges in the window are the
+            # total minus the total before the oldest step inside the window
+            start_edges = None
+            for timestamp, edges_before in reversed(self._timestamps):
+                if timestamp <= since:
+                    break
+                start_edges = edges_before
+            if start_edges is not None:
+                edges = self._edges - start_edges
+        return edges / window
+
+    def windowed_rpm(self, window=1.0, now=None):
+        """
+        Returns the speed derived from the number of edges seen during the last window seconds.
+        """
+        return self.edges_per_second(window, now) * 60.0 / (PULSES_PER_REVOLUTION * EDGES_PER_PULSE)
+
+    def getrpm(self):
+        return self.windowed_rpm()
@@ -0,0 +1,335 @@
+"""
+Hardware layer of the rotary script.
+
+The real backend uses RPi.GPIO and spidev. The simulated backend replays recorded or synthetic encoder edges
+and ADC traces, at real time or accelerated, so the whole ingest path can be run and benchmarked on any machine.
+
+Recorded traces are CSV files with a header line:
+    edges: t,pin,level        (t in seconds from the start of the replay, level 0 or 1)
+    adc:   t,channel,value    (value is the raw 0-1023 reading, held until the next row of the same channel)
+"""
+import bisect
+import csv
+import heapq
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from encoder import EDGES_PER_PULSE, PULSES_PER_REVOLUTION
+
+# quadrature states of a clockwise turn, as (A << 1) | B
+CW_SEQUENCE = (0b00, 0b01, 0b11, 0b10)
+
+
+class Clock:
+    """
+    Time source shared by the scheduler, the encoders and the replay.
+
+    Args:
+        speed (float, optional): How many simulated seconds pass per real second. Defaults to 1.0.
+    """
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self._start = time.monotonic()
+        self._start_datetime = datetime.now()
+
+    def monotonic(self):
+        return self._start + (time.monotonic() - self._start) * self.speed
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+    def now(self):
+        if self.speed == 1.0:
+            return datetime.now()
+        return self._start_datetime + timedelta(seconds=self.monotonic() - self._start)
+
+    def elapsed(self):
+        return self.monotonic() - self._start
+
+
+class SimulatedGPIO:
+    """
+    Stand-in for the RPi.GPIO module: pins hold a level and edges are delivered to the registered callbacks.
+    """
+    BCM = "BCM"
+    IN = "IN"
+    BOTH = "BOTH"
+    PUD_UP = "PUD_UP"
+
+    def __init__(self):
+        self.levels = defaultdict(int)
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels[pin] = 0
+
+    def input(self, pin):
+        return self.levels[pin]
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+
+    def set_level(self, pin, level):
+        """
+        Changes the level of a pin and calls its callback if the level changed.
+        """
+        if self.levels[pin] == level:
+            return False
+        self.levels[pin] = level
+        callback = self.callbacks.get(pin)
+        if callback is not None:
+            callback(pin)
+        return True
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+
+class SyntheticEncoder:
+    """
+    Edge source for one encoder turning clockwise at a constant speed, optionally switched on and off periodically.
+
+    Args:
+        Apin (int): The A pin of the encoder.
+        Bpin (int): The B pin of the encoder.
+        rpm (float): The speed while the pump is on.
+        on_seconds (float, optional): How long the pump runs before it stops. None means always on. Defaults to None.
+        off_seconds (float, optional): How long the pump stays off. Defaults to 0.
+        offset (float, optional): Delay before the first cycle starts. Defaults to 0.
+    """
+
+    def __init__(self, Apin, Bpin, rpm, on_seconds=None, off_seconds=0.0, offset=0.0):
+        self.Apin, self.Bpin = Apin, Bpin
+        self.period = 60.0 / (rpm * PULSES_PER_REVOLUTION * EDGES_PER_PULSE) if rpm > 0 else None
+        self.on_seconds = on_seconds
+        self.off_seconds = off_seconds
+        self.offset = offset
+        self._index = 0
+
+    def edges(self, duration):
+        """
+        Yields (t, pin, level) for every edge until duration seconds.
+        """
+        if self.period is None:
+            return
+        t = self.offset
+        while t < duration:
+            if self.on_seconds is not None:
+                cycle = self.on_seconds + self.off_seconds
+                position = (t - self.offset) % cycle
+                if position >= self.on_seconds:
+                    t += cycle - position
+                    continue
+            previous = CW_SEQUENCE[self._index]
+            self._index = (self._index + 1) % len(CW_SEQUENCE)
+            state = CW_SEQUENCE[self._index]
+            if (previous ^ state) & 0b10:
+                yield t, self.Apin, state >> 1
+            else:
+                yield t, self.Bpin, state & 1
+            t += self.period
+
+
+def read_edge_trace(path):
+    """
+    Yields (t, pin, level) from a recorded edge trace.
+    """
+    with open(path, newline="") as trace:
+        for row in csv.DictReader(trace):
+            yield float(row["t"]), int(row["pin"]), int(row["level"])
+
+
+class EdgeReplayer:
+    """
+    Delivers edge streams to a SimulatedGPIO on the given clock, from a background thread.
+
+    Edges that are already due are delivered back to back; the replayer only sleeps when it is ahead of the stream,
+    so at high edge rates lag shows up as the distance between the scheduled and the actual delivery time.
+
+    Args:
+        gpio (SimulatedGPIO): The GPIO the edges are delivered to.
+        streams (list): Iterables of (t, pin, level) sorted by t.
+        clock (Clock): The replay clock.
+    """
+
+    def __init__(self, gpio, streams, clock):
+        self.gpio = gpio
+        self.streams = streams
+        self.clock = clock
+        self.delivered = 0
+        self.max_lag = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="edge-replayer", daemon=True)
+
+    def start(self):
+        self._start = self.clock.monotonic()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def _run(self):
+        for t, pin, level in heapq.merge(*self.streams):
+            if self._stop.is_set():
+                return
+            due = self._start + t
+            now = self.clock.monotonic()
+            if due > now:
+                self.clock.sleep(due - now)
+            else:
+                self.max_lag = max(self.max_lag, now - due)
+            if self.gpio.set_level(pin, level):
+                self.delivered += 1
+
+    def stats(self):
+        elapsed = self.clock.monotonic() - self._start
+        return {
+            "edges_delivered": self.delivered,
+            "edges_per_second": round(self.delivered / elapsed, 1) if elapsed > 0 else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+        }
+
+
+class SimulatedSpiDev:
+    """
+    Stand-in for spidev.SpiDev answering MCP300x conversions from ADC traces.
+
+    Args:
+        clock (Clock): The replay clock.
+        trace (str, optional): Path of a recorded ADC trace. Defaults to a synthetic trace.
+    """
+
+    def __init__(self, clock, trace=None):
+        self.clock = clock
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = 0
+        self._start = clock.monotonic()
+        self._samples = defaultdict(lambda: ([], []))
+        if trace is not None:
+            with open(trace, newline="") as rows:
+                for row in csv.DictReader(rows):
+                    times, values = self._samples[int(row["channel"])]
+                    times.append(float(row["t"]))
+                    values.append(int(row["value"]))
+
+    def open(self, bus, device):
+        pass
+
+    def value(self, channel, t):
+        if self._samples:
+            times, values = self._samples[channel]
+            index = bisect.bisect_right(times, t) - 1
+            return values[index] if index >= 0 else 0
+        # slow sine around mid scale with some noise, each channel with its own phase
+        return int(min(1023, max(0, 512 + 300 * math.sin(2 * math.pi * t / 60 + channel) + random.gauss(0, 4))))
+
+    def xfer2(self, data):
+        # like spidev, the received bytes replace the sent ones in data
+        self.transfers += 1
+        channel = (data[1] >> 4) - 8
+        value = self.value(channel, self.clock.monotonic() - self._start)
+        data[:] = [0, (value >> 8) & 3, value & 0xFF]
+        return data
+
+    def close(self):
+        pass
+
+
+class MemoryCollection:
+    """
+    In-memory stand-in for the sensor data collection, with an optional delay per write to mimic a slow database.
+
+    Only the operations used by the rotary script are implemented.
+
+    Args:
+        latency (float, optional): Seconds added to every write. Defaults to 0.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.documents = []
+        self.writes = 0
+
+    def insert_one(self, document):
+        self.insert_many([document])
+
+    def insert_many(self, documents, ordered=True):
+        if self.latency:
+            time.sleep(self.latency)
+        self.documents.extend(documents)
+        self.writes += 1
+
+    def bulk_write(self, operations, ordered=True):
+        if self.latency:
+            time.sleep(self.latency)
+        self.writes += 1
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        if not self.documents:
+            return None
+        if sort:
+            key, direction = sort[0]
+            matching = [document for document in self.documents if key in document]
+            if not matching:
+                return None
+            return (max if direction < 0 else min)(matching, key=lambda document: document[key])
+        return self.documents[0]
+
+    def count_documents(self, filter=None):
+        return len(self.documents)
+
+    def create_index(self, keys, **kwargs):
+        pass
+
+
+class MemoryDatabase:
+    """
+    In-memory stand-in for the sensor data database, every collection is a MemoryCollection with the same latency.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self.latency)
+        return self.collections[name]
+
+
+def open_backend(name, clock, adc_trace=None):
+    """
+    Returns the GPIO module and a ready-to-use SpiDev-like object of the given backend.
+
+    Args:
+        name (str): "gpio" for the Raspberry Pi hardware, "sim" for the simulated backend.
+        clock (Clock): The clock used by the simulated backend.
+        adc_trace (str, optional): Recorded ADC trace for the simulated backend. Defaults to a synthetic trace.
+
+    Returns:
+        tuple: (gpio, spi)
+    """
+    if name == "gpio":
+        import RPi.GPIO as GPIO
+        import spidev
+        spi = spidev.SpiDev()
+        spi.open(0, 1)
+        return GPIO, spi
+    if name == "sim":
+        return SimulatedGPIO(), SimulatedSpiDev(clock, adc_trace)
+    raise ValueError(f"Invalid hardware backend, it should be either gpio or sim. {name} is given.")
@@ -0,0 +1,166 @@
+"""
+Metrics of the rotary ingest path.
+
+Histograms are updated by the sampling and writer threads; other values are read from their sources when a
+snapshot is taken. Snapshots are served as JSON by MetricsServer (GET /metrics on localhost) and summarised
+to the log by the rotary script every METRICS_REPORT_INTERVAL seconds.
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds of the latency buckets in milliseconds, the last bucket counts everything above
+LATENCY_BOUNDS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# upper bounds of the loop period buckets as fractions of the nominal period
+PERIOD_BOUNDS = (0.5, 0.9, 0.95, 0.99, 1.01, 1.05, 1.1, 1.5, 2, 5)
+
+
+def period_bounds_ms(rate_hz):
+    """
+    Returns the loop period bucket bounds in milliseconds for the given sample rate.
+    """
+    return tuple(round(bound * 1000 / rate_hz, 3) for bound in PERIOD_BOUNDS)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram, cheap enough to be updated on every sample.
+
+    Only the thread that observes values writes to it, readers get a slightly stale but consistent-enough view.
+
+    Args:
+        bounds (tuple): Sorted upper bounds of the buckets. Values above the last bound go to an overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-th quantile, capped at the largest observed value.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["overflow"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else None,
+            "min": None if self.min is None else round(self.min, 3),
+            "max": None if self.max is None else round(self.max, 3),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class Metrics:
+    """
+    Registry of the histograms and value sources of the rotary process.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.histograms = {}
+        self.sources = {}
+
+    def histogram(self, name, bounds):
+        self.histograms[name] = Histogram(bounds)
+        return self.histograms[name]
+
+    def register(self, name, source):
+        """
+        Adds a value read when a snapshot is taken.
+
+        Args:
+            name (str): The name in the snapshot.
+            source (callable): Returns the value, e.g. a number or the dict returned by a stats() method.
+        """
+        self.sources[name] = source
+
+    def snapshot(self):
+        output = {"uptime_seconds": round(time.monotonic() - self.started, 1)}
+        for name, source in self.sources.items():
+            output[name] = source()
+        for name, histogram in self.histograms.items():
+            output[name] = histogram.snapshot()
+        return output
+
+    def summary(self):
+        """
+        Returns the snapshot as one log line, with only the count, mean, p99 and max of the histograms.
+        """
+        output = self.snapshot()
+        for name in self.histograms:
+            histogram = output[name]
+            output[name] = {key: histogram[key] for key in ("count", "mean", "p99", "max")}
+        return ", ".join(f"{name}: {value}" for name, value in output.items())
+
+
+class MetricsServer:
+    """
+    Serves the metrics snapshot as JSON on GET /metrics from a background thread.
+
+    Args:
+        metrics (Metrics): The metrics to serve.
+        port (int): The TCP port.
+        host (str, optional): The interface to listen on. Defaults to localhost only.
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        handler = type("MetricsHandler", (_MetricsHandler,), {"metrics": metrics})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.metrics.snapshot()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
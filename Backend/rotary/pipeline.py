@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+# Fixed layout of the records passed from the sampling thread to the persistence worker. Only raw values are
+# taken on the sampling thread; unit conversion, printing and writing happen on the worker.
+Sample = namedtuple("Sample", ["timestamp", "seq", "interval", "barrier_pulses", "gelcoat_pulses", "adc"])
+
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+
+
+class SampleQueue:
+    """
+    Bounded queue between one producer and one consumer thread.
+
+    It relies on deque.append and deque.popleft being atomic, so neither side takes a lock and the producer
+    never waits for the consumer. When the queue is full the drop policy decides which record is lost:
+    DROP_OLDEST keeps the latest readings, DROP_NEWEST keeps the backlog intact.
+
+    Args:
+        maxlen (int): The maximum number of queued records.
+        policy (str, optional): DROP_OLDEST or DROP_NEWEST. Defaults to DROP_OLDEST.
+    """
+
+    def __init__(self, maxlen, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Invalid drop policy, it should be either {DROP_OLDEST} or {DROP_NEWEST}. {policy} is given.")
+        self.maxlen = maxlen
+        self.policy = policy
+        self._records = deque(maxlen=maxlen if policy == DROP_OLDEST else None)
+        self.pushed = 0
+        self.dropped = 0
+        self.high_watermark = 0
+
+    def put(self, record):
+        """
+        Queues a record without blocking.
+
+        Returns:
+            bool: False if a record had to be dropped.
+        """
+        depth = len(self._records)
+        self.pushed += 1
+        if depth >= self.maxlen:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            # the deque discards the oldest record itself
+            self._records.append(record)
+            return False
+        self._records.append(record)
+        self.high_watermark = max(self.high_watermark, depth + 1)
+        return True
+
+    def drain(self):
+        """
+        Removes and returns every queued record, oldest first.
+        """
+        records = []
+        popleft = self._records.popleft
+        try:
+            while True:
+                records.append(popleft())
+        except IndexError:
+            return records
+
+    def depth(self):
+        return len(self._records)
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth(),
+            "high_watermark": self.high_watermark,
+            "pushed": self.pushed,
+            "dropped": self.dropped,
+        }
+
+
+class PersistenceWorker:
+    """
+    Background thread that drains a SampleQueue and hands every record to handle.
+
+    Errors raised by handle are logged and counted, the record is skipped and the worker keeps running.
+
+    Args:
+        queue (SampleQueue): The queue filled by the sampling thread.
+        handle (callable): Called with every record, in order.
+        poll_interval (float, optional): Seconds between two drains of an empty queue. Defaults to 0.05.
+    """
+
+    def __init__(self, queue, handle, poll_interval=0.05):
+        self.queue = queue
+        self.handle = handle
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="persistence-worker", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stops the worker after it has handled whatever is left in the queue.
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            stopping = self._stop.is_set()
+            records = self.queue.drain()
+            for record in records:
+                try:
+                    self.handle(record)
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    logging.error(f"PersistenceWorker < Exception: {str(e)}, seq: {getattr(record, 'seq', None)} >")
+            if stopping:
+                return
+            if not records:
+                time.sleep(self.poll_interval)
+
+    def stats(self):
+        return {"processed": self.processed, "errors": self.errors}
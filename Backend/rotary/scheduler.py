@@ -0,0 +1,66 @@
+import time
+
+
+class DeadlineScheduler:
+    """
+    Fires at a fixed rate on absolute deadlines, so the time spent between two calls to wait() doesn't add up to drift.
+
+    Deadlines are kept on the grid start + n * period. If an iteration overruns its deadline the next one fires
+    immediately, and when more than a whole period is lost the missed deadlines are skipped instead of fired in a burst.
+
+    Args:
+        rate_hz (float): The number of ticks per second.
+        clock (callable, optional): Monotonic clock returning seconds. Defaults to time.monotonic.
+        sleep (callable, optional): Sleep function taking seconds. Defaults to time.sleep.
+    """
+
+    def __init__(self, rate_hz, clock=time.monotonic, sleep=time.sleep):
+        self.rate_hz = rate_hz
+        self.period = 1.0 / rate_hz
+        self.clock = clock
+        self.sleep = sleep
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self._last = None
+        self._deadline = None
+
+    def start(self):
+        self._last = self.clock()
+        self._deadline = self._last + self.period
+        return self
+
+    def wait(self):
+        """
+        Sleeps until the next deadline.
+
+        Returns:
+            float: The measured number of seconds since the previous tick (or since start() for the first tick).
+        """
+        if self._deadline is None:
+            self.start()
+
+        now = self.clock()
+        if now < self._deadline:
+            self.sleep(self._deadline - now)
+            now = self.clock()
+        else:
+            self.overruns += 1
+            missed = int((now - self._deadline) // self.period)
+            if missed:
+                self.skipped += missed
+                self._deadline += missed * self.period
+
+        interval = now - self._last
+        self._last = now
+        self._deadline += self.period
+        self.ticks += 1
+        return interval
+
+    def stats(self):
+        return {
+            "rate_hz": self.rate_hz,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+        }
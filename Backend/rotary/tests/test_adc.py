@@ -0,0 +1,27 @@
+from adc import ADC_mcp3004
+from hardware import Clock, SimulatedSpiDev
+
+
+def simulated_spi(tmp_path, values):
+    trace = tmp_path / "adc.csv"
+    trace.write_text("t,channel,value\n" + "".join(f"0,{channel},{value}\n" for channel, value in values.items()))
+    return SimulatedSpiDev(Clock(), str(trace))
+
+
+def test_xfer2_writes_the_received_bytes_into_the_frame(tmp_path):
+    spi = simulated_spi(tmp_path, {0: 700})
+    frame = [1, 8 << 4, 0]
+    assert spi.xfer2(frame) is frame
+    assert frame == [0, 2, 700 & 0xFF]
+
+
+def test_read_the_same_channel_twice(tmp_path):
+    adc = ADC_mcp3004([0, 3], spi=simulated_spi(tmp_path, {0: 700, 3: 5}))
+    assert adc.read() == [700, 5]
+    assert adc.read() == [700, 5]
+
+
+def test_read_with_oversampling(tmp_path):
+    adc = ADC_mcp3004([3], oversample=4, spi=simulated_spi(tmp_path, {3: 1023}))
+    assert adc.read() == [1023]
+    assert adc.read() == [1023]
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+class BufferedWriter:
+    """
+    Holds sensor documents in a bounded in-memory buffer and writes them to MongoDB with insert_many.
+
+    A background thread flushes the buffer whenever it holds flush_size documents or flush_interval
+    seconds have passed since the last flush, so a slow database never blocks the sampling loop.
+    If the buffer is full the oldest documents are dropped and counted.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection the documents are written to.
+        flush_size (int, optional): Number of buffered documents that triggers a flush. Defaults to 20.
+        flush_interval (float, optional): Maximum number of seconds between two flushes. Defaults to 1.0.
+        max_buffer (int, optional): Maximum number of documents kept in memory. Defaults to 36000.
+        on_flush (callable, optional): Called with the list of written documents after every flush, e.g. to
+            update derived collections. Its errors are logged and never affect the buffer. Defaults to None.
+        latency_histogram (metrics.Histogram, optional): Observes the latency of every flush in milliseconds. Defaults to None.
+    """
+
+    def __init__(self, collection, flush_size=20, flush_interval=1.0, max_buffer=36000, on_flush=None,
+                 latency_histogram=None):
+        self.collection = collection
+        self.on_flush = on_flush
+        self.latency_histogram = latency_histogram
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="buffered-writer", daemon=True)
+
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, document):
+        """
+        Appends a document to the buffer, dropping the oldest one if the buffer is full.
+
+        Args:
+            document (dict): The sensor document to be written.
+        """
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(document)
+            depth = len(self._buffer)
+        if depth >= self.flush_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes all buffered documents with a single insert_many call.
+
+        On failure the batch is put back at the front of the buffer so it is retried on the next flush.
+        Documents keep the _id assigned by the driver, so a retried batch can't be inserted twice.
+
+        Returns:
+            int: The number of documents written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._buffer)
+                self._buffer.clear()
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                failed = self._write(batch)
+            except PyMongoError as e:
+                self._requeue(batch)
+                logging.error(f"BufferedWriter < Exception: {str(e)}, buffered: {self.depth()} >")
+                return 0
+            finally:
+                self._record_latency(time.perf_counter() - start)
+
+            if failed:
+                self._requeue(failed)
+                logging.error(f"BufferedWriter < BulkWriteError: {len(failed)} of {len(batch)} documents failed >")
+                failed_ids = {id(document) for document in failed}
+                batch = [document for document in batch if id(document) not in failed_ids]
+            self.written += len(batch)
+            self._notify(batch)
+            return len(batch)
+
+    def depth(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def stats(self):
+        """
+        Returns the current state of the writer.
+
+        Returns:
+            dict: Buffer depth, written/dropped document counts and flush latencies in milliseconds.
+        """
+        return {
+            "buffer_depth": self.depth(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_latency_ms": round(self.last_flush_latency * 1000, 2),
+            "avg_flush_latency_ms": round(self._total_flush_latency / self.flushes * 1000, 2) if self.flushes else 0.0,
+            "max_flush_latency_ms": round(self.max_flush_latency * 1000, 2),
+        }
+
+    def close(self, timeout=None):
+        """
+        Stops the background thread and writes whatever is left in the buffer.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _write(self, batch):
+        """
+        Writes a batch and returns the documents that failed and must be retried.
+        """
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # documents already inserted by a previous, partially failed flush are reported as duplicates
+            return [batch[error["index"]] for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+        return []
+
+    def _notify(self, documents):
+        if self.on_flush is None or not documents:
+            return
+        try:
+            self.on_flush(documents)
+        except Exception as e:
+            logging.error(f"BufferedWriter < on_flush Exception: {str(e)}, documents: {len(documents)} >")
+
+    def _requeue(self, documents):
+        self.failed_flushes += 1
+        with self._lock:
+            room = self.max_buffer - len(self._buffer)
+            if room < len(documents):
+                self.dropped += len(documents) - max(room, 0)
+                documents = documents[len(documents) - max(room, 0):]
+            self._buffer.extendleft(reversed(documents))
+
+    def _record_latency(self, latency):
+        self.flushes += 1
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self._total_flush_latency += latency
+        if self.latency_histogram is not None:
+            self.latency_histogram.observe(latency * 1000)
+
+
+class BucketWriter(BufferedWriter):
+    """
+    BufferedWriter for the bucketed layout: every flush appends the buffered readings to their per-minute
+    buckets with one bulk_write of upserts built by pack.
+
+    Args:
+        collection (pymongo.collection.Collection): The bucket collection.
+        pack (callable): Turns a list of readings into (operation, readings) pairs, e.g. common.buckets.bucket_operations.
+        **kwargs: The other arguments of BufferedWriter.
+    """
+
+    def __init__(self, collection, pack, **kwargs):
+        super().__init__(collection, **kwargs)
+        self.pack = pack
+
+    def _write(self, batch):
+        groups = self.pack(batch)
+        try:
+            self.collection.bulk_write([operation for operation, _ in groups], ordered=False)
+        except BulkWriteError as e:
+            # groups already appended by a previous, partially failed flush are reported as duplicates
+            return [document for error in e.details.get("writeErrors", []) if error.get("code") != 11000
+                    for document in groups[error["index"]][1]]
+        return []
@@ -2,7 +2,6 @@ import React from "react";
 import "./Charts.css";
 import { useState, useEffect } from "react";
 import ReactECharts from "echarts-for-react";
-import axios from "axios";
 import ipData from './ip_backend.json';
 
 const Charts = () => {
@@ -25,11 +24,15 @@ const Charts = () => {
   const [chartDataBarrierPulse, setChartDataBarrierPulse] = useState(null);
 
   useEffect(() => {
-    const fetchData = async () => {
+    // the api pushes the latest readings: first the whole window, then every new batch of readings
+    let data = [];
+    const source = new EventSource(`http://${ip}:5000/api/stream`);
+    source.onmessage = (event) => {
       try {
-        const response = await axios.get(`http://${ip}:5000/api/get_20`);
-        const data = response.data.data;
-
+        const message = JSON.parse(event.data);
+        data = message.reset
+          ? message.data
+          : message.data.concat(data).slice(0, message.window);
         setChartDataBarrierSpeed(formatChartDataBarrierSpeed(data));
         setChartDataGelcoatSpeed(formatChartDataGelcoatSpeed(data));
         setChartDataPressure(formatChartDataPressure(data));
@@ -37,14 +40,15 @@ const Charts = () => {
         setChartDataGelcoatPulse(formatChartDataGelcoatPulse(data));
         setChartDataBarrierPulse(formatChartDataBarrierPulse(data));
       } catch (error) {
-        console.error("Error fetching data:", error);
+        console.error("Error reading live data:", error);
       }
     };
+    source.onerror = (error) => {
+      // EventSource reconnects by itself and the api starts over with the whole window
+      console.error("Error in live data stream:", error);
+    };
 
-    fetchData();
-
-    const intervalId = setInterval(fetchData, 1500);
-    return () => clearInterval(intervalId);
+    return () => source.close();
   }, []);
 
   const formatChartDataBarrierSpeed = (data) => {
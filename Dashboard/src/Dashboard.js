@@ -3,7 +3,6 @@ import "./Dashboard.css";
 import { useState } from "react";
 import { useEffect } from "react";
 import ReactECharts from "echarts-for-react";
-import axios from "axios";
 import ipData from './ip_backend.json';
 
 const Dashboard = () => {
@@ -23,25 +22,31 @@ const Dashboard = () => {
   const [barrierQuantity, setBarrierQuantity] = useState(null);
   const [pressure, setPressure] = useState(null);
   useEffect(() => {
-    const fetchData = async () => {
+    // the api pushes the latest readings: first the whole window, then every new batch of readings
+    let data = [];
+    const source = new EventSource(`http://${ip}:5000/api/stream`);
+    source.onmessage = (event) => {
       try {
-        const response = await axios.get(`http://${ip}:5000/api/get_20`);
-        const data = response.data.data;
-        setBarrierQuantity(response.data.total_weight_barr);
-        setGelcoatQuantity(response.data.total_weight_gel);
-        setPressure(response.data.pressure);
+        const message = JSON.parse(event.data);
+        data = message.reset
+          ? message.data
+          : message.data.concat(data).slice(0, message.window);
+        setBarrierQuantity(message.total_weight_barr);
+        setGelcoatQuantity(message.total_weight_gel);
+        setPressure(message.pressure);
 
         setChartDataBarrierSpeed(formatChartDataBarrierSpeed(data));
         setChartDataGelcoatSpeed(formatChartDataGelcoatSpeed(data));
       } catch (error) {
-        console.error("Error fetching data:", error);
+        console.error("Error reading live data:", error);
       }
     };
+    source.onerror = (error) => {
+      // EventSource reconnects by itself and the api starts over with the whole window
+      console.error("Error in live data stream:", error);
+    };
 
-    fetchData();
-
-    const intervalId = setInterval(fetchData, 1500);
-    return () => clearInterval(intervalId);
+    return () => source.close();
   }, []);
 
   const formatChartDataBarrierSpeed = (data) => {
@@ -10,6 +10,10 @@ import moment from "moment";
 import Dropdown from "./Dropdown";
 import ipData from './ip_backend.json';
 
+// readings the server downsamples the history to in total, shared by the 7 channels, so about 2000 points
+// per channel, enough for a chart as wide as the screen
+const HISTORY_MAX_POINTS = 14000;
+
 const ChartsHistory = () => {
   const ip = ipData.ip;
   const queryParameters = new URLSearchParams(window.location.search)
@@ -50,6 +54,7 @@ const ChartsHistory = () => {
             {
               startDate: startDateParam,
               endDate: endDateParam,
+              max_points: HISTORY_MAX_POINTS,
             }
           );
           const data = response.data;
@@ -73,6 +78,7 @@ const ChartsHistory = () => {
         {
           startDate: dateRangeOut[0],
           endDate: dateRangeOut[1],
+          max_points: HISTORY_MAX_POINTS,
         }
       );
       const data = response.data;